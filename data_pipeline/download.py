@@ -7,9 +7,11 @@ import ftplib
 import os
 import logging
 import re
+import shutil
 from .utils import IniParser
 from .utils import post_process
 from .utils import Monitor
+from .helper.esearch import EsearchWindow
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -18,6 +20,14 @@ logger = logging.getLogger(__name__)
 class Download(IniParser):
     ''' Handle data file downloads '''
 
+    def __init__(self, full=False):
+        '''
+        @type  full: bool
+        @keyword full: Download all the records for incremental sections rather than
+        those added since the last run (see L{EsearchWindow}).
+        '''
+        self.full = full
+
     def download(self, url, dir_path, file_name=None, **kwargs):
         if file_name is None:
             file_name = self._url_to_file_name(url)
@@ -26,6 +36,8 @@ class Download(IniParser):
 
         if url.startswith("ftp://"):
             success = FTPDownload.download(url, dir_path, file_name, **kwargs)
+        elif url.startswith("file://"):
+            success = LocalDownload.download(url, dir_path, file_name)
         elif 'emsembl_mart' in kwargs:
             success = MartDownload.download(url, dir_path, file_name, **kwargs)
         else:
@@ -59,16 +71,47 @@ class Download(IniParser):
                 success = self.download(section['location'], dir_path, file_name=fname,
                                         tax=section['taxonomy'], attrs=section['attrs'],
                                         query_filter=qfilter, emsembl_mart=True)
+            elif 'files_regex' in section:
+                success = self.download_listing(section['location'], section['files_regex'], dir_path,
+                                                sub_dirs=section.get('dirs'), username=username,
+                                                password=password)
             elif 'files' in section:
                 files = section['files'].split(",")
                 for f in files:
                     success = self.download(section['location']+"/"+f.strip(), dir_path,
                                             username=username, password=password)
             elif 'http_params' in section:
-                success = self.download(section['location']+"?"+section['http_params'],
+                http_params = section['http_params']
+                if 'incremental' in section and section.getboolean('incremental'):
+                    overlap_days = int(section['edat_overlap_days']) if 'edat_overlap_days' in section else 0
+                    http_params += EsearchWindow.params(os.path.join(dir_path, fname), full=self.full,
+                                                        overlap_days=overlap_days)
+                success = self.download(section['location']+"?"+http_params,
                                         dir_path, file_name=fname, username=username, password=password)
         return success
 
+    def download_listing(self, location, files_regex, dir_path, sub_dirs=None, username=None, password=None):
+        ''' Download the files in a remote directory (or comma separated list of its
+        sub-directories) with names matching a regular expression. Files that have
+        already been downloaded are skipped. '''
+        pattern = re.compile(files_regex)
+        success = True
+        sub_dirs = [d.strip() for d in sub_dirs.split(',')] if sub_dirs is not None else ['']
+        for sub_dir in sub_dirs:
+            url = location.rstrip('/') + '/' + sub_dir if sub_dir != '' else location.rstrip('/')
+            out_dir = os.path.join(dir_path, sub_dir)
+            if url.startswith("ftp://"):
+                names = FTPDownload.listdir(url, username=username, password=password)
+            else:
+                names = LocalDownload.listdir(url)
+            for name in sorted(names):
+                if not pattern.match(name) or os.path.exists(os.path.join(out_dir, name)):
+                    continue
+                if not self.download(url + '/' + name, out_dir, file_name=name,
+                                     username=username, password=password):
+                    success = False
+        return success
+
     def _url_to_file_name(self, url):
         name = url.split('/')[-1]
         if name == '':
@@ -144,6 +187,17 @@ class FTPDownload(object):
                                    session_factory=ftplib.FTP)
         return getattr(ftp_host.stat(url_parse.path), 'st_mtime')
 
+    @classmethod
+    def listdir(cls, url, username='anonymous', password=''):
+        ''' List the names in a directory on a FTP server. '''
+        if username is None: username = 'anonymous'  # @IgnorePep8
+        url_parse = urlparse(url)
+        ftp_host = ftputil.FTPHost(url_parse.netloc, username, password,
+                                   session_factory=ftplib.FTP)
+        names = ftp_host.listdir(url_parse.path)
+        ftp_host.close()
+        return names
+
     @classmethod
     def exists(cls, url, username='anonymous', password=''):
         url_parse = urlparse(url)
@@ -152,6 +206,24 @@ class FTPDownload(object):
         return ftp_host.path.exists(url_parse.path)
 
 
+class LocalDownload(object):
+    ''' Copy files from a local directory (file:// URLs) e.g. a mirror of a FTP site. '''
+
+    @classmethod
+    def download(cls, url, dir_path, file_name):
+        path = urlparse(url).path
+        if not os.path.isfile(path):
+            logger.error("file not found: "+url)
+            return False
+        shutil.copyfile(path, os.path.join(dir_path, file_name))
+        return True
+
+    @classmethod
+    def listdir(cls, url):
+        ''' List the names in a local directory. '''
+        return os.listdir(urlparse(url).path)
+
+
 class MartDownload(object):
     ''' Biomart webservice downloads. '''
 
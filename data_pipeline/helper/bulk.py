@@ -0,0 +1,395 @@
+''' Used to build elastic bulk requests. '''
+
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.lookup_cache import LookupCache
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+
+class BulkWriter(object):
+    ''' Accumulate bulk actions in a bytes buffer and send them when the buffer
+    reaches a size in bytes, a number of documents or has been open for a time.
+
+    writer = BulkWriter(idx, idx_type)
+    for doc in docs:
+        writer.update(doc_id, {'dbxrefs': dbxrefs})
+    writer.close()
+
+    The time limit is checked as actions are added. By default each request is
+    sent with L{bulk_load} (see L{BulkIndexer}) and, unless max_docs is given, the
+    number of documents in a request is set by the L{BatchSizer} of the indexer.
+    send can be given to handle the request data and number of documents in it
+    instead (e.g. to queue it).
+    '''
+
+    def __init__(self, idx, idx_type, max_bytes=5*1024*1024, max_docs=None, max_seconds=None, send=None):
+        '''
+        @type  idx: str
+        @param idx: Default index name for the actions.
+        @type  idx_type: str
+        @param idx_type: Default index type for the actions (None if each action gives it).
+        @type  max_bytes: int
+        @keyword max_bytes: Maximum size of a request (unless a single action is larger).
+        @type  max_docs: int
+        @keyword max_docs: Maximum number of documents in a request (default adaptive).
+        @type  max_seconds: float
+        @keyword max_seconds: Maximum time an action is buffered before sending.
+        @type  send: function
+        @keyword send: Called with the request data (bytes) and number of documents.
+        '''
+        self.idx = idx
+        self.idx_type = idx_type
+        self.max_bytes = max_bytes
+        self.max_docs = max_docs
+        self.max_seconds = max_seconds
+        self.send = send
+        self.buffer = bytearray()
+        self.n_docs = 0
+        self.count = 0
+        self.n_requests = 0
+        self.start = None
+        self.last_type = idx_type
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def _meta(self, doc_id, idx, idx_type):
+        meta = {"_index": idx if idx is not None else self.idx,
+                "_type": idx_type if idx_type is not None else self.idx_type}
+        if doc_id is not None:
+            meta["_id"] = doc_id
+        self.last_type = meta["_type"]
+        return meta
+
+    def index(self, doc, doc_id=None, idx=None, idx_type=None, parent=None):
+        ''' Add an index action (the id is generated by elastic if None). '''
+        meta = self._meta(doc_id, idx, idx_type)
+        if parent is not None:
+            meta["_parent"] = parent
+        self._add({"index": meta}, doc)
+
+    def update(self, doc_id, doc, idx=None, idx_type=None, retry_on_conflict=3):
+        ''' Add a partial document update action. '''
+        meta = self._meta(doc_id, idx, idx_type)
+        meta["_retry_on_conflict"] = retry_on_conflict
+        self._add({"update": meta}, {"doc": doc})
+
+    def upsert(self, doc_id, doc, idx=None, idx_type=None, retry_on_conflict=3):
+        ''' Add a partial document update action that creates the document if missing. '''
+        meta = self._meta(doc_id, idx, idx_type)
+        meta["_retry_on_conflict"] = retry_on_conflict
+        self._add({"update": meta}, {"doc": doc, "doc_as_upsert": True})
+
+    def delete(self, doc_id, idx=None, idx_type=None, parent=None):
+        ''' Add a delete action (with the parent id for a child doc). '''
+        meta = self._meta(doc_id, idx, idx_type)
+        if parent is not None:
+            meta["_parent"] = parent
+        self._add({"delete": meta})
+
+    def _add(self, action, source=None):
+        data = json.dumps(action).encode() + b'\n'
+        if source is not None:
+            data += json.dumps(source).encode() + b'\n'
+        if self.n_docs > 0 and len(self.buffer) + len(data) > self.max_bytes:
+            self.flush()
+        if self.n_docs == 0:
+            self.start = time.time()
+        self.buffer += data
+        self.n_docs += 1
+        max_docs = self.max_docs if self.max_docs is not None else BulkIndexer.get().sizer.size
+        if (self.n_docs >= max_docs or len(self.buffer) >= self.max_bytes or
+           (self.max_seconds is not None and time.time() - self.start >= self.max_seconds)):
+            self.flush()
+
+    def flush(self):
+        ''' Send the buffered actions. '''
+        if self.n_docs == 0:
+            return
+        data = bytes(self.buffer)
+        if self.send is not None:
+            self.send(data, self.n_docs)
+        else:
+            bulk_load(self.idx, self.idx_type if self.idx_type is not None else self.last_type, data, self.n_docs)
+        self.count += self.n_docs
+        self.n_requests += 1
+        self.buffer = bytearray()
+        self.n_docs = 0
+
+    def close(self):
+        ''' Send any remaining actions.
+        @return: Number of documents sent.
+        '''
+        self.flush()
+        return self.count
+
+
+class BatchSizer(object):
+    ''' Adjust the number of documents in a bulk request toward a target request
+    latency. The size is halved when the cluster rejects requests (429), reduced in
+    proportion when a request is slower than the target and grown by 10% when a
+    (near full) request takes less than half the target. '''
+
+    def __init__(self, size=1000, min_size=50, max_size=10000, target_seconds=1.0):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.lock = threading.Lock()
+
+    def update(self, n_docs, seconds, rejected=False):
+        ''' Update the size from the response to a request of n_docs. '''
+        with self.lock:
+            if rejected:
+                self.size = max(self.min_size, self.size // 2)
+            elif seconds > self.target_seconds:
+                self.size = max(self.min_size, int(self.size * self.target_seconds / seconds))
+            elif seconds < self.target_seconds / 2 and n_docs >= self.size // 2:
+                self.size = min(self.max_size, self.size + max(1, self.size // 10))
+        return self.size
+
+
+class BulkIndexer(object):
+    ''' Send bulk requests from a pool of threads so that requests are in flight
+    while the next ones are built. Requests are put on a bounded queue so that a
+    producer blocks when the cluster falls behind.
+
+    with BulkIndexer(workers=4):
+        Gene.gene2ensembl_parse(gene2ens, idx, idx_type)
+
+    While an indexer is active L{bulk_load} (and so L{BulkWriter}) sends requests
+    through it. This is set for a section of the ini file with bulk_workers (see
+    L{data_pipeline.utils.process_wrapper}). Otherwise requests are sent in the calling
+    thread by a shared indexer with no workers.
+
+    Each response is checked and the items rejected by the cluster (429, 503) or
+    updates with version conflicts (409) are sent again with an exponential backoff.
+    Items that fail otherwise, or still fail after the retries, fail the load: the
+    error is raised by L{bulk_load}, L{join} or L{close}. Updates of documents that
+    are missing (404) are only counted.
+    '''
+
+    active = None
+    _default = None
+    # request and item statuses that are retried
+    RETRY_STATUS = (429, 503)
+    # item statuses retried for updates (version conflicts)
+    RETRY_UPDATE_STATUS = (409,)
+
+    def __init__(self, workers=4, queue_size=None, retries=5, backoff=0.5, sizer=None):
+        '''
+        @type  workers: int
+        @keyword workers: Number of requests in flight (0 to send in the calling thread).
+        @type  queue_size: int
+        @keyword queue_size: Number of requests waiting to be sent (default 2 x workers).
+        @type  retries: int
+        @keyword retries: Number of times failed items are retried.
+        @type  backoff: float
+        @keyword backoff: Seconds before the first retry, doubled for each retry.
+        @type  sizer: BatchSizer
+        @keyword sizer: Used to set the number of documents in a request.
+        '''
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size if queue_size is not None else max(1, workers * 2))
+        self.retries = retries
+        self.backoff = backoff
+        self.sizer = sizer if sizer is not None else BatchSizer()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.error = None
+        self.stats = {"batches": 0, "docs": 0, "failed": 0, "missing": 0, "retried": 0, "seconds": 0.0,
+                      "max_seconds": 0.0}
+        self.start_time = time.time()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(raise_error=exc_type is None)
+
+    @classmethod
+    def get(cls):
+        ''' Get the active indexer or the shared indexer that sends in the calling thread. '''
+        if cls.active is not None:
+            return cls.active
+        if cls._default is None:
+            cls._default = cls(workers=0)
+        return cls._default
+
+    def start(self):
+        ''' Start the threads and make this the active indexer. '''
+        self.start_time = time.time()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name='bulk-' + str(i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        BulkIndexer.active = self
+        return self
+
+    def bulk_load(self, idx, idx_type, json_data, n_docs=None):
+        ''' Queue a bulk request (same arguments as the elastic Loader bulk_load). This
+        blocks while the queue is full. '''
+        if self.error is not None:
+            raise PipelineError('Bulk load failed: ' + repr(self.error))
+        if len(self.threads) == 0:
+            self._send(idx, idx_type, json_data, n_docs)
+        else:
+            self.queue.put((idx, idx_type, json_data, n_docs))
+
+    def load(self, docs, idx, idx_type):
+        ''' Index a list of docs (as the elastic JSONLoader load), using the _id of a doc if given. '''
+        writer = BulkWriter(idx, idx_type, send=lambda data, n_docs: self.bulk_load(idx, idx_type, data, n_docs))
+        for doc in docs:
+            doc_id = doc.pop('_id', None)
+            writer.index(doc, doc_id=doc_id)
+        return writer.close()
+
+    def join(self):
+        ''' Wait for the queued requests to be sent. '''
+        if len(self.threads) > 0:
+            self.queue.join()
+        if self.error is not None:
+            raise PipelineError('Bulk load failed: ' + repr(self.error))
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self._send(*item)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    @classmethod
+    def _split_actions(cls, data):
+        ''' Split bulk request data into the action (and source) lines for each item. '''
+        actions = []
+        lines = iter(data.split(b'\n'))
+        for line in lines:
+            if line.strip() == b'':
+                continue
+            if 'delete' in json.loads(line.decode()):
+                actions.append(line + b'\n')
+            else:
+                actions.append(line + b'\n' + next(lines) + b'\n')
+        return actions
+
+    def _send(self, idx, idx_type, json_data, n_docs):
+        ''' Send a bulk request, retrying the items that are rejected.
+        @raise PipelineError: if any items failed.
+        '''
+        path = ElasticClient.path(idx, idx_type, '_bulk')
+        LookupCache.invalidate(idx)
+        data = json_data.encode() if isinstance(json_data, str) else json_data
+        pending = n_docs if n_docs is not None else len(BulkIndexer._split_actions(data))
+        (success, failed, missing, retried) = (0, 0, 0, 0)
+        error = None
+        start = time.time()
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.0))
+                retried += pending
+            t = time.time()
+            resp = ElasticClient.get().request('POST', path, data=data)
+            seconds = time.time() - t
+            if resp.status_code in BulkIndexer.RETRY_STATUS:
+                # the whole request was rejected
+                self.sizer.update(pending, seconds, rejected=True)
+                continue
+            if resp.status_code != 200:
+                raise PipelineError('Bulk load failed: ' + path + ' ' + str(resp.status_code) + ' ' + resp.text[:500])
+
+            result = resp.json()
+            actions = BulkIndexer._split_actions(data) if result.get('errors') else None
+            retry = []
+            rejected = False
+            for i, item in enumerate(result['items']):
+                (action, status) = list(item.items())[0]
+                if 'error' not in status:
+                    success += 1
+                elif (status['status'] in BulkIndexer.RETRY_STATUS or
+                      (action == 'update' and status['status'] in BulkIndexer.RETRY_UPDATE_STATUS)):
+                    rejected = rejected or status['status'] == 429
+                    retry.append(actions[i])
+                elif action == 'update' and status['status'] == 404:
+                    missing += 1
+                else:
+                    failed += 1
+                    error = status
+                    logger.warn('Bulk item failed: ' + str(status))
+            self.sizer.update(len(result['items']), seconds, rejected=rejected)
+            pending = len(retry)
+            if pending == 0:
+                break
+            data = b''.join(retry)
+
+        if pending > 0:
+            failed += pending
+            logger.warn('Bulk load ' + str(pending) + ' items still rejected after ' + str(self.retries) + ' retries')
+
+        seconds = time.time() - start
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["docs"] += success
+            self.stats["failed"] += failed
+            self.stats["missing"] += missing
+            self.stats["retried"] += retried
+            self.stats["seconds"] += seconds
+            self.stats["max_seconds"] = max(self.stats["max_seconds"], seconds)
+        logger.debug("Bulk batch " + str(success) + " docs " + str(round(seconds, 3)) + "s :: " +
+                     str(int(success / seconds) if seconds > 0 else success) + " docs/s" +
+                     (" :: retried " + str(retried) if retried > 0 else "") +
+                     (" :: failed " + str(failed) if failed > 0 else ""))
+        if failed > 0:
+            raise PipelineError('Bulk load failed: ' + path + ' ' + str(failed) + ' items failed' +
+                                (' ' + str(error)[:500] if error is not None else ' (still rejected after retries)'))
+        return (success, failed)
+
+    def close(self, raise_error=True):
+        ''' Wait for the queued requests, stop the threads and log the throughput.
+        @return: Dictionary of the batches, docs (succeeded), failed, retried, latency
+        and docs per second.
+        '''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if BulkIndexer.active is self:
+            BulkIndexer.active = None
+
+        stats = self.stats
+        time_taken = time.time() - self.start_time
+        stats["mean_seconds"] = stats["seconds"] / stats["batches"] if stats["batches"] > 0 else 0
+        stats["docs_per_second"] = stats["docs"] / time_taken if time_taken > 0 else 0
+        stats["batch_size"] = self.sizer.size
+        logger.debug("Bulk load: " + str(stats))
+        if raise_error and self.error is not None:
+            raise PipelineError('Bulk load failed: ' + repr(self.error))
+        return stats
+
+
+def bulk_load(idx, idx_type, json_data, n_docs=None):
+    ''' Send a bulk request through the active L{BulkIndexer} (or in the calling thread). '''
+    BulkIndexer.get().bulk_load(idx, idx_type, json_data, n_docs)
+
+
+def bulk_join():
+    ''' Wait for the requests queued on the active L{BulkIndexer} to be sent. '''
+    if BulkIndexer.active is not None:
+        BulkIndexer.active.join()
@@ -0,0 +1,284 @@
+''' Used to load the dbSNP VCF markers in parallel. '''
+
+import json
+import logging
+import os
+import queue
+import re
+import time
+from multiprocessing import Pool, Queue
+from elastic.management.loaders.mapping import MappingProperties
+from data_pipeline.helper.exceptions import PipelineError
+from data_pipeline.helper.bulk import BulkWriter, bulk_load, bulk_join
+from data_pipeline.helper.index_rebuild import IndexRebuild
+from data_pipeline.helper.tabix import Tabix, BgzfReader, open_lines, tbi_file
+
+logger = logging.getLogger(__name__)
+
+# set in the worker processes by L{_init_worker}
+_QUEUE = None
+_OPTIONS = None
+
+
+def _init_worker(out_queue, options):
+    global _QUEUE, _OPTIONS
+    _QUEUE = out_queue
+    _OPTIONS = options
+
+
+def _parse_shard(shard):
+    ''' Parse a shard into bulk load chunks and put them on the queue. The last
+    message for a shard has the total number of docs and finished set. '''
+    name = shard[0]
+    try:
+        count = 0
+        lines = DbSNP.shard_lines(_OPTIONS['vcf_file'], shard, regions=_OPTIONS['regions'])
+        for (json_data, n_docs) in DbSNP.bulk_chunks(lines,
+                                                     _OPTIONS['idx'], _OPTIONS['idx_type'],
+                                                     chunk_size=_OPTIONS['chunk_size']):
+            count += n_docs
+            _QUEUE.put((name, json_data, n_docs, False, None))
+        _QUEUE.put((name, None, count, True, None))
+    except Exception as e:
+        _QUEUE.put((name, None, 0, True, repr(e)))
+
+
+class DbSNP(object):
+    ''' Native loading of the dbSNP VCF markers (an alternative to the elastic
+    index_search loader).
+
+    dbSNP VCF files are BGZF compressed and have a tabix index (.tbi). The
+    virtual offset range of each chromosome is read from the index and the
+    chromosomes (shards) are parsed by a pool of worker processes. The bulk
+    load chunks they produce are loaded by the main process. The shards loaded
+    are recorded in a state file so that an interrupted load can be resumed.
+    Without a tabix index (or for a plain gzip file) the file is a single shard.
+
+    Loading can be restricted to a set of regions in which case each region is a
+    shard read from the linear index offset for its start.
+    '''
+
+    STATE_FILE = 'dbsnp_shards.json'
+
+    @classmethod
+    def marker_mapping(cls, idx, idx_type, test_mode=False):
+        ''' Load the mapping for the dbSNP marker index.
+        seqid   - chromosome
+        start   - position
+        id      - rs id
+        ref/alt - reference and alternate alleles
+        qual    - quality
+        filter  - filter
+        info    - VCF INFO field
+        '''
+        props = MappingProperties(idx_type)
+        props.add_property("seqid", "string", index="not_analyzed") \
+             .add_property("start", "integer", index="not_analyzed") \
+             .add_property("id", "string", analyzer="full_name") \
+             .add_property("ref", "string", index="no") \
+             .add_property("alt", "string", index="no") \
+             .add_property("qual", "string", index="no") \
+             .add_property("filter", "string", index="no") \
+             .add_property("info", "string", index="no") \
+             .add_property("suggest", "completion", analyzer="full_name")
+
+        ''' create index and add mapping '''
+        if not test_mode:
+            IndexRebuild.mapping(props, idx_type, idx)
+        return props
+
+    @classmethod
+    def marker_doc(cls, line):
+        ''' Get the marker doc for a VCF record (None for header lines). '''
+        if line.startswith('#') or line == '':
+            return None
+        parts = line.split('\t')
+        return {"seqid": parts[0], "start": int(parts[1]), "id": parts[2], "ref": parts[3],
+                "alt": parts[4], "qual": parts[5], "filter": parts[6], "info": parts[7],
+                "suggest": {"input": [parts[2]]}}
+
+    @classmethod
+    def bulk_chunks(cls, lines, idx, idx_type, chunk_size=5000):
+        ''' Generator of (bulk load data, number of docs) for VCF lines. Doc ids are
+        made from the chromosome, position and rs id so reloading a shard is idempotent. '''
+        chunks = []
+        writer = BulkWriter(idx, idx_type, max_docs=chunk_size,
+                            send=lambda data, n_docs: chunks.append((data, n_docs)))
+        for line in lines:
+            doc = cls.marker_doc(line)
+            if doc is None:
+                continue
+            writer.index(doc, doc_id=doc['seqid'] + '_' + str(doc['start']) + '_' + doc['id'])
+            while len(chunks) > 0:
+                yield chunks.pop(0)
+        writer.close()
+        for chunk in chunks:
+            yield chunk
+
+    @classmethod
+    def shards(cls, vcf_file, regions=None):
+        ''' Get the (name, start, end, region) shards of a VCF file. With a tabix index these
+        are the virtual offsets of each chromosome or, if regions are given, the offsets from
+        which to read each region. '''
+        tbi = tbi_file(vcf_file)
+        if tbi is None or not BgzfReader.is_bgzf(vcf_file):
+            logger.warn('No tabix index for ' + vcf_file + ' loading as a single shard')
+            return [('all', None, None, None)]
+        tabix = Tabix.read(tbi)
+        if regions is None:
+            return [span + (None,) for span in tabix.spans()]
+
+        shards = []
+        for region in regions:
+            (seqid, beg, end) = region
+            start = tabix.region_start(seqid, beg)
+            if start is None:
+                continue
+            shards.append((seqid + ':' + str(beg) + '-' + str(end), start, tabix.span(seqid)[1], region))
+        return shards
+
+    @classmethod
+    def shard_lines(cls, vcf_file, shard, regions=None):
+        ''' Generator of the lines in a shard (only those overlapping the regions if given). '''
+        (_name, start, end, region) = shard
+        if start is None:
+            lines = open_lines(vcf_file)
+        else:
+            lines = BgzfReader(vcf_file).lines(start, end)
+        if region is not None:
+            return cls._region_lines(lines, [region], seek=True)
+        if regions is not None:
+            return cls._region_lines(lines, regions)
+        return lines
+
+    @classmethod
+    def _region_lines(cls, lines, regions, seek=False):
+        ''' Filter VCF lines to records overlapping the regions. If seek is set the lines
+        start in the (single) region and reading stops once past the end of it. '''
+        by_seqid = {}
+        for (seqid, beg, end) in regions:
+            by_seqid.setdefault(seqid, []).append((beg, end))
+        for line in lines:
+            if line.startswith('#') or line == '':
+                continue
+            parts = line.split('\t', 4)
+            seqid_regions = by_seqid.get(parts[0])
+            if seqid_regions is None:
+                if seek:
+                    return
+                continue
+            pos = int(parts[1])
+            pos_end = pos + len(parts[3]) - 1
+            if any(pos <= end and pos_end >= beg for (beg, end) in seqid_regions):
+                yield line
+            elif seek and pos > seqid_regions[0][1]:
+                return
+
+    @classmethod
+    def parse_regions(cls, regions):
+        ''' Parse a comma separated list of regions (e.g. 1:113800000-113900000, X:100-200). '''
+        parsed = []
+        for region in regions.split(','):
+            region = region.strip()
+            if region == '':
+                continue
+            match = re.match(r'^(\S+):(\d+)-(\d+)$', region)
+            if match is None:
+                raise PipelineError('Region not recognised: ' + region)
+            parsed.append((match.group(1), int(match.group(2)), int(match.group(3))))
+        return cls.merge_regions(parsed)
+
+    @classmethod
+    def read_bed(cls, bed_file):
+        ''' Read the regions in a BED file (0-based start, end exclusive). '''
+        regions = []
+        with open(bed_file) as f:
+            for line in f:
+                if line.startswith(('#', 'track', 'browser')) or line.strip() == '':
+                    continue
+                parts = line.split('\t')
+                regions.append((parts[0], int(parts[1]) + 1, int(parts[2])))
+        return cls.merge_regions(regions)
+
+    @classmethod
+    def merge_regions(cls, regions):
+        ''' Sort regions (1-based, inclusive) and merge overlapping ones. '''
+        merged = []
+        for (seqid, beg, end) in sorted(regions):
+            if len(merged) > 0 and merged[-1][0] == seqid and beg <= merged[-1][2] + 1:
+                merged[-1] = (seqid, merged[-1][1], max(end, merged[-1][2]))
+            else:
+                merged.append((seqid, beg, end))
+        return merged
+
+    @classmethod
+    def _read_state(cls, state_file, file_stat):
+        if os.path.exists(state_file):
+            with open(state_file) as f:
+                state = json.load(f)
+            if state['file'] == file_stat:
+                return state
+        return {"file": file_stat, "shards": {}}
+
+    @classmethod
+    def load(cls, vcf_file, idx, idx_type, stage_dir, processes=4, chunk_size=5000, regions=None):
+        ''' Load the markers in a VCF file using a pool of processes to parse the shards.
+        @type  vcf_file: str
+        @param vcf_file: dbSNP VCF file (BGZF with a .tbi index or gzip).
+        @type  stage_dir: str
+        @param stage_dir: Directory for the shard state file.
+        @type  processes: int
+        @keyword processes: Number of parsing processes.
+        @type  regions: list
+        @keyword regions: Only load markers overlapping these (seqid, start, end) regions.
+        @return: Number of markers loaded.
+        '''
+        if not os.path.exists(stage_dir):
+            os.makedirs(stage_dir)
+        state_file = os.path.join(stage_dir, DbSNP.STATE_FILE)
+        stat = os.stat(vcf_file)
+        state = cls._read_state(state_file, {"name": os.path.basename(vcf_file), "size": stat.st_size,
+                                             "mtime": stat.st_mtime, "index": idx,
+                                             "regions": [list(r) for r in regions] if regions else None})
+        shards = [shard for shard in cls.shards(vcf_file, regions) if shard[0] not in state['shards']]
+        logger.debug("No. shards to load "+str(len(shards))+" (loaded "+str(len(state['shards']))+")")
+        if len(shards) == 0:
+            return 0
+
+        start = time.time()
+        count = 0
+        out_queue = Queue(maxsize=processes * 4)
+        options = {"vcf_file": vcf_file, "idx": idx, "idx_type": idx_type, "chunk_size": chunk_size,
+                   "regions": regions}
+        pool = Pool(processes=processes, initializer=_init_worker, initargs=(out_queue, options))
+        try:
+            result = pool.map_async(_parse_shard, shards, chunksize=1)
+            finished = 0
+            while finished < len(shards):
+                try:
+                    (name, json_data, n_docs, done, error) = out_queue.get(timeout=10)
+                except queue.Empty:
+                    if result.ready():
+                        result.get()
+                        raise PipelineError('Marker shard workers stopped before finishing')
+                    continue
+                if error is not None:
+                    raise PipelineError('Failed to parse shard ' + name + ': ' + error)
+                if json_data is not None:
+                    bulk_load(idx, idx_type, json_data, n_docs)
+                    count += n_docs
+                if done:
+                    # the shard is only recorded as loaded once its requests are sent
+                    bulk_join()
+                    finished += 1
+                    state['shards'][name] = n_docs
+                    with open(state_file, 'w') as f:
+                        json.dump(state, f)
+                    time_taken = time.time() - start
+                    logger.debug("Loaded shard " + name + " (" + str(n_docs) + " markers) " +
+                                 str(finished) + "/" + str(len(shards)) + " :: " +
+                                 str(int(count / time_taken)) + " markers/s")
+        finally:
+            pool.terminate()
+            pool.join()
+        return count
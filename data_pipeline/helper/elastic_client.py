@@ -0,0 +1,309 @@
+''' Used to share pooled connections to the elastic cluster. '''
+
+import gzip
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from elastic.elastic_settings import ElasticSettings
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+
+class ElasticClient(object):
+    ''' Client for the elastic REST API shared by a run of the pipeline. Requests
+    go through one session that keeps alive a pool of connections to each node and
+    are spread round robin over the nodes that are up. A node that fails to connect
+    is marked down for a time that doubles with each failure.
+
+    client = ElasticClient.get()
+    resp = client.request('GET', '/' + idx + '/_count')
+
+    The nodes are ELASTIC_NODES in the django settings or the elastic URL. Request
+    bodies are gzip compressed if ELASTIC_COMPRESS is set (this needs
+    http.compression enabled on the cluster).
+    '''
+
+    _client = None
+    _lock = threading.Lock()
+
+    def __init__(self, nodes=None, pool_size=20, compress=False, timeout=120, retry_seconds=5):
+        '''
+        @type  nodes: list
+        @keyword nodes: URLs of the nodes (default the elastic URL).
+        @type  pool_size: int
+        @keyword pool_size: Number of connections kept alive to each node.
+        @type  compress: bool
+        @keyword compress: Gzip the request bodies.
+        @type  timeout: int
+        @keyword timeout: Request timeout in seconds.
+        @type  retry_seconds: int
+        @keyword retry_seconds: Time a failed node is marked down for (doubled for each failure).
+        '''
+        self.nodes = [node.rstrip('/') for node in (nodes if nodes is not None else [ElasticSettings.url()])]
+        self.compress = compress
+        self.timeout = timeout
+        self.retry_seconds = retry_seconds
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.nodes), pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.health = {node: {"up": True, "failures": 0, "down_until": 0, "requests": 0, "seconds": 0.0}
+                       for node in self.nodes}
+        self.next_node = itertools.cycle(self.nodes)
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        ''' Get the client for this run (created on first use). '''
+        with cls._lock:
+            if cls._client is None:
+                cls._client = cls(nodes=getattr(settings, 'ELASTIC_NODES', None),
+                                  compress=getattr(settings, 'ELASTIC_COMPRESS', False))
+            return cls._client
+
+    @classmethod
+    def close(cls):
+        ''' Close the connections of the client for this run. '''
+        with cls._lock:
+            if cls._client is not None:
+                cls._client.session.close()
+                logger.debug("Elastic nodes: " + str(cls._client.health))
+                cls._client = None
+
+    def _nodes(self):
+        ''' Nodes to try in order, those up first (round robin) then those down. '''
+        with self.lock:
+            start = next(self.next_node)
+        i = self.nodes.index(start)
+        nodes = self.nodes[i:] + self.nodes[:i]
+        now = time.time()
+        return ([n for n in nodes if self.health[n]["down_until"] <= now] +
+                [n for n in nodes if self.health[n]["down_until"] > now])
+
+    def _mark(self, node, seconds=None):
+        with self.lock:
+            health = self.health[node]
+            if seconds is None:
+                health["failures"] += 1
+                health["up"] = False
+                health["down_until"] = time.time() + self.retry_seconds * 2 ** min(health["failures"] - 1, 6)
+            else:
+                health["up"] = True
+                health["failures"] = 0
+                health["down_until"] = 0
+                health["requests"] += 1
+                health["seconds"] += seconds
+
+    def request(self, method, path, data=None, params=None, timeout=None):
+        ''' Send a request to a node, trying the next node if it cannot connect. A read
+        timeout raises a L{PipelineError} rather than sending the request again.
+        @type  path: str
+        @param path: Path of the request (e.g. /idx/_search).
+        @type  data: str, bytes or dict
+        @keyword data: Request body (a dict is JSON encoded).
+        @type  timeout: int
+        @keyword timeout: Request timeout in seconds (default the client timeout).
+        @return: requests Response
+        '''
+        headers = {}
+        if isinstance(data, dict):
+            data = json.dumps(data)
+        if isinstance(data, str):
+            data = data.encode()
+        if data is not None and self.compress:
+            data = gzip.compress(data, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+
+        error = None
+        for node in self._nodes():
+            start = time.time()
+            try:
+                resp = self.session.request(method, node + path, data=data, params=params,
+                                            headers=headers,
+                                            timeout=timeout if timeout is not None else self.timeout)
+            except requests.exceptions.ConnectionError as e:
+                # includes a ConnectTimeout, tried on the next node
+                logger.warn('Elastic node failed: ' + node + ' ' + repr(e))
+                self._mark(node)
+                error = e
+                continue
+            except requests.exceptions.Timeout as e:
+                # the node may have applied the request (e.g. a bulk request without ids) so
+                # it is not sent again
+                raise PipelineError('Elastic request timed out: ' + node + path + ' ' + repr(e))
+            self._mark(node, time.time() - start)
+            return resp
+        raise PipelineError('No elastic nodes available: ' + repr(error))
+
+    def json(self, method, path, data=None, params=None, ok=(200,), timeout=None):
+        ''' Send a request and return the JSON response, raising a L{PipelineError} if
+        the status is not ok. '''
+        resp = self.request(method, path, data=data, params=params, timeout=timeout)
+        if resp.status_code not in ok:
+            raise PipelineError(method + ' ' + path + ' failed: ' + str(resp.status_code) + ' ' + resp.text[:500])
+        return resp.json()
+
+    @classmethod
+    def path(cls, idx, idx_type=None, endpoint=None):
+        ''' Build a path from an index, type and endpoint (e.g. _search). '''
+        path = '/' + idx
+        if idx_type is not None:
+            path += '/' + idx_type
+        if endpoint is not None:
+            path += '/' + endpoint
+        return path
+
+    def search(self, idx, body, idx_type=None, params=None):
+        ''' Search an index and return the response JSON. '''
+        return self.json('POST', ElasticClient.path(idx, idx_type, '_search'), data=body, params=params)
+
+    def count(self, idx, idx_type=None):
+        ''' Get the number of documents in an index (0 if it does not exist). '''
+        resp = self.request('GET', ElasticClient.path(idx, idx_type, '_count'))
+        if resp.status_code == 404:
+            return 0
+        if resp.status_code != 200:
+            raise PipelineError('Count failed: ' + idx + ' ' + resp.text[:500])
+        return resp.json()['count']
+
+    def refresh(self, idx):
+        self.request('POST', ElasticClient.path(idx, endpoint='_refresh'))
+
+    def index_exists(self, idx):
+        return self.request('HEAD', ElasticClient.path(idx)).status_code == 200
+
+    def put_mapping(self, idx, idx_type, mapping):
+        ''' Add a mapping ({"properties": ...}) for an index type. '''
+        return self.json('PUT', ElasticClient.path(idx, endpoint='_mapping/' + idx_type), data={idx_type: mapping})
+
+    @classmethod
+    def _source_params(cls, sources):
+        if sources is None:
+            return None
+        if sources is False:
+            return {"_source": "false"}
+        return {"_source": ",".join(sources)}
+
+    @classmethod
+    def _parallel(cls, func, items, workers):
+        ''' Generator of func(item) for each of the items (in order) with up to workers
+        calls running ahead of the consumer. '''
+        if workers <= 1 or len(items) <= 1:
+            for item in items:
+                yield func(item)
+            return
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque(executor.submit(func, item) for item in itertools.islice(items, workers))
+            while len(pending) > 0:
+                result = pending.popleft().result()
+                for item in itertools.islice(items, 1):
+                    pending.append(executor.submit(func, item))
+                yield result
+
+    def scroll(self, idx, idx_type=None, query=None, sources=None, size=1000, scroll='1m'):
+        ''' Generator of the hits for a query (default match_all) scrolling through them a
+        page at a time.
+        @type  sources: list
+        @keyword sources: _source fields to return or False for none.
+        @type  size: int
+        @keyword size: Number of hits per shard for each page.
+        @type  scroll: str
+        @keyword scroll: Time to keep the scroll context alive.
+        '''
+        path = ElasticClient.path(idx, idx_type, '_search')
+        body = {"query": query if query is not None else {"match_all": {}},
+                "size": size, "sort": ["_doc"]}
+        if sources is not None:
+            body["_source"] = sources
+
+        resp = self.request('POST', path, data=body, params={"scroll": scroll})
+        scroll_id = None
+        try:
+            while True:
+                if resp.status_code != 200:
+                    raise PipelineError('Scroll failed: ' + path + ' ' + resp.text[:500])
+                result = resp.json()
+                scroll_id = result.get('_scroll_id')
+                hits = result['hits']['hits']
+                if len(hits) == 0:
+                    break
+                for hit in hits:
+                    yield hit
+                resp = self.request('POST', '/_search/scroll', data={"scroll": scroll, "scroll_id": scroll_id})
+        finally:
+            if scroll_id is not None:
+                self.request('DELETE', '/_search/scroll', data={"scroll_id": [scroll_id]})
+
+    def msearch(self, idx, bodies, idx_type=None):
+        ''' Run searches in one _msearch request and return their responses. '''
+        header = {"index": idx}
+        if idx_type is not None:
+            header["type"] = idx_type
+        data = ''.join(json.dumps(header) + '\n' + json.dumps(body) + '\n' for body in bodies)
+        responses = self.json('POST', '/_msearch', data=data)['responses']
+        for resp in responses:
+            if 'error' in resp:
+                raise PipelineError('Search failed: ' + idx + ' ' + str(resp['error'])[:500])
+        return responses
+
+    def terms(self, idx, field, values, idx_type=None, sources=None, batch_size=500, per_request=4, workers=4):
+        ''' Generator of the hits for documents with a field matching any of the values.
+        The values are searched in batches, several to an _msearch request, and the
+        requests are sent in parallel as the hits are consumed. A batch that matches more
+        documents than its page holds is scrolled.
+        @type  batch_size: int
+        @keyword batch_size: Number of values (and page size) of each search.
+        @type  per_request: int
+        @keyword per_request: Number of searches in each _msearch request.
+        @type  workers: int
+        @keyword workers: Number of requests in flight.
+        '''
+        values = list(values)
+        batches = [values[i:i+batch_size] for i in range(0, len(values), batch_size)]
+        requests_batches = [batches[i:i+per_request] for i in range(0, len(batches), per_request)]
+
+        def search(request_batches):
+            bodies = []
+            for batch in request_batches:
+                body = {"query": {"bool": {"filter": {"terms": {field: batch}}}}, "size": batch_size}
+                if sources is not None:
+                    body["_source"] = sources
+                bodies.append(body)
+            return zip(request_batches, self.msearch(idx, bodies, idx_type=idx_type))
+
+        for results in ElasticClient._parallel(search, requests_batches, workers):
+            for (batch, resp) in results:
+                hits = resp['hits']
+                for hit in hits['hits']:
+                    yield hit
+                if hits['total'] > len(hits['hits']):
+                    seen = set(hit['_id'] for hit in hits['hits'])
+                    query = {"bool": {"filter": {"terms": {field: batch}}}}
+                    for hit in self.scroll(idx, idx_type=idx_type, query=query, sources=sources, size=batch_size):
+                        if hit['_id'] not in seen:
+                            yield hit
+
+    def ids(self, idx, doc_ids, idx_type=None, sources=None, batch_size=1000, workers=4):
+        ''' Generator of the documents (found) with the given ids, got in batches with
+        parallel _mget requests as the documents are consumed. '''
+        doc_ids = list(doc_ids)
+        batches = [doc_ids[i:i+batch_size] for i in range(0, len(doc_ids), batch_size)]
+        path = ElasticClient.path(idx, idx_type, '_mget')
+        params = ElasticClient._source_params(sources)
+
+        def mget(batch):
+            return self.json('POST', path, data={"ids": batch}, params=params)['docs']
+
+        for docs in ElasticClient._parallel(mget, batches, workers):
+            for doc in docs:
+                if doc.get('found'):
+                    yield doc
@@ -0,0 +1,108 @@
+''' Used to request only the PMIDs added to eutils esearch results since the last run. '''
+
+import datetime
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class EsearchWindow(object):
+    ''' Record the last successful run of an esearch download (e.g. the DISEASE
+    sections in publications.ini) so that later runs only request PMIDs with an
+    Entrez date (EDAT) in the window since then:
+
+    <download file>.run.json
+    {"last_run": "2016/05/01", "previous_run": "2016/04/24", "added": 12,
+     "window": {"mindate": "2016/04/17", "maxdate": "2016/05/08", "added": 3}}
+
+    The window is set when the esearch results are downloaded (L{params}), the
+    number of PMIDs fetched for it noted when they are staged (L{fetched}) and the
+    last run date only moves on once they have been loaded (L{record}).
+
+    Each window starts from the run before the last so that it overlaps the previous
+    window. Papers indexed with MeSH terms after their EDAT, and so missed by a MeSH
+    term search of that window, are then found by the next one. PMIDs already loaded
+    are skipped when fetching (see L{data_pipeline.utils.PostProcess.get_new_pmids}).
+    '''
+
+    DATE_FORMAT = '%Y/%m/%d'
+
+    @classmethod
+    def state_file(cls, download_file):
+        return download_file + '.run.json'
+
+    @classmethod
+    def read(cls, download_file):
+        ''' Get the run state for a download file. '''
+        state_file = cls.state_file(download_file)
+        if not os.path.exists(state_file):
+            return {}
+        with open(state_file) as f:
+            return json.load(f)
+
+    @classmethod
+    def _write(cls, download_file, state):
+        state_dir = os.path.dirname(download_file)
+        if state_dir != '' and not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        with open(cls.state_file(download_file), 'w') as f:
+            json.dump(state, f)
+
+    @classmethod
+    def params(cls, download_file, full=False, today=None, overlap_days=0):
+        ''' Get the esearch date parameters for the window since the run before the last
+        and record the window. An empty string is returned for a full sweep (no previous
+        run or full).
+        @type  download_file: str
+        @param download_file: Location of the esearch results.
+        @type  full: bool
+        @keyword full: Request all the PMIDs regardless of the last run.
+        @type  today: datetime.date
+        @keyword today: End of the window (default today).
+        @type  overlap_days: int
+        @keyword overlap_days: Start the window at least this many days before the last run.
+        '''
+        if today is None:
+            today = datetime.date.today()
+        state = cls.read(download_file)
+        maxdate = today.strftime(EsearchWindow.DATE_FORMAT)
+        if full or 'last_run' not in state:
+            state['window'] = {'maxdate': maxdate}
+            cls._write(download_file, state)
+            return ''
+
+        last_run = datetime.datetime.strptime(state['last_run'], EsearchWindow.DATE_FORMAT).date()
+        mindate = (last_run - datetime.timedelta(days=overlap_days)).strftime(EsearchWindow.DATE_FORMAT)
+        if state.get('previous_run') is not None:
+            mindate = min(mindate, state['previous_run'])
+        state['window'] = {'mindate': mindate, 'maxdate': maxdate}
+        cls._write(download_file, state)
+        logger.debug("EDAT window "+mindate+" - "+maxdate+" :: "+download_file)
+        return '&datetype=edat&mindate=' + mindate + '&maxdate=' + maxdate
+
+    @classmethod
+    def fetched(cls, download_file, added):
+        ''' Note the number of new PMIDs fetched for the window the esearch results were
+        downloaded for (the window is not recorded as run until they are loaded). '''
+        state = cls.read(download_file)
+        if 'window' not in state:
+            return
+        state['window']['added'] = added
+        cls._write(download_file, state)
+
+    @classmethod
+    def record(cls, download_file):
+        ''' Record a successful run for the window the esearch results were downloaded for,
+        once the PMIDs fetched for it have been loaded. '''
+        state = cls.read(download_file)
+        if 'window' not in state:
+            return
+        window = state.pop('window')
+        state['previous_run'] = state.get('last_run')
+        state['last_run'] = window['maxdate']
+        state['added'] = window.get('added')
+        cls._write(download_file, state)
+        logger.debug("No. PMIDs added for EDAT window " + window.get('mindate', '*') + " - " +
+                     window['maxdate'] + ": " + str(state['added']))
@@ -2,12 +2,17 @@
 
 import logging
 from builtins import classmethod
-from elastic.search import ElasticQuery, Search
-from elastic.query import Query, TermsFilter
 from elastic.management.loaders.mapping import MappingProperties
 from elastic.management.loaders.loader import Loader
 from data_pipeline.helper.exceptions import PipelineError
-import json
+from data_pipeline.helper.bulk import BulkWriter, bulk_join
+from data_pipeline.helper.pmid_index import PmidIndex
+from data_pipeline.helper.pubs import Pubs
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.gene_id_map import GeneIdMap
+from data_pipeline.helper.gene_history import GeneHistory
+from data_pipeline.helper.lookup_cache import LookupCache
+from data_pipeline.helper.index_rebuild import IndexRebuild
 from configparser import SectionProxy
 
 logger = logging.getLogger(__name__)
@@ -25,8 +30,10 @@ class Gene(object):
     '''
 
     @classmethod
-    def gene_mapping(cls, idx, idx_type, test_mode=False):
-        ''' Load the mapping for the gene index. '''
+    def gene_mapping(cls, idx, idx_type, test_mode=False, links_type=None):
+        ''' Load the mapping for the gene index. If links_type is given the mapping for
+        the gene-publication links (child docs of the genes, see L{gene_pub_parse}) is
+        loaded first, as Elasticsearch (2.x) will not add a _parent to an existing type. '''
         props = MappingProperties(idx_type)
         props.add_property("symbol", "string", analyzer="full_name") \
              .add_property("synonyms", "string", analyzer="full_name") \
@@ -38,6 +45,7 @@ class Gene(object):
              .add_property("description", "string") \
              .add_property("biotype", "string") \
              .add_property("pmids", "string") \
+             .add_property("pmid_count", "integer") \
              .add_property("suggest", "completion", analyzer="full_name")
 
         dbxref_props = cls._get_nested_prop("dbxrefs", "ensembl")
@@ -52,12 +60,18 @@ class Gene(object):
         props.add_properties(tags)
 
         ''' create index and add mapping '''
-        load = Loader()
-        options = {"indexName": idx, "shards": 5}
         if not test_mode:
-            load.mapping(props, idx_type, analyzer=Loader.KEYWORD_ANALYZER, **options)
+            if links_type is not None:
+                IndexRebuild.mapping(cls._gene_pub_links_mapping(links_type, idx_type), links_type, idx)
+            IndexRebuild.mapping(props, idx_type, idx)
         return props
 
+    @classmethod
+    def _gene_pub_links_mapping(cls, links_type, gene_idx_type):
+        links_props = MappingProperties(links_type, gene_idx_type)
+        links_props.add_property("pmid", "integer")
+        return links_props
+
     @classmethod
     def _get_nested_prop(cls, nested_name, prop_name):
         org_props = MappingProperties(nested_name)
@@ -119,6 +133,18 @@ class Gene(object):
     @classmethod
     def gene2ensembl_parse(cls, gene2ens, idx, idx_type):
         ''' Parse gene2ensembl file from NCBI and add entrez to gene index. '''
+        genes = cls._gene2ensembl(gene2ens)
+        hits = ElasticClient.get().ids(idx, list(genes.keys()), idx_type=idx_type, sources=False)
+
+        writer = BulkWriter(idx, idx_type)
+        for hit in hits:
+            ens_id = hit['_id']
+            writer.update(ens_id, genes[ens_id], idx_type=hit['_type'])
+        writer.close()
+
+    @classmethod
+    def _gene2ensembl(cls, gene2ens):
+        ''' Get an ensembl:{'dbxrefs': {'entrez': ...}} dictionary from gene2ensembl. '''
         genes = {}
         for gene in gene2ens:
             if gene.startswith('9606\t'):
@@ -128,28 +154,38 @@ class Gene(object):
 #                 prot_acc = parts[5]
                 if ens_id not in genes:
                     genes[ens_id] = {'dbxrefs': {'entrez': gene_id}}
-
-        query = ElasticQuery(Query.ids(list(genes.keys())))
-        docs = Search(query, idx=idx, idx_type=idx_type, size=80000).search().docs
-
-        chunk_size = 450
-        for i in range(0, len(docs), chunk_size):
-            docs_chunk = docs[i:i+chunk_size]
-            json_data = ''
-            for doc in docs_chunk:
-                ens_id = doc._meta['_id']
-                idx_type = doc.type()
-                doc_data = {"update": {"_id": ens_id, "_type": idx_type,
-                                       "_index": idx, "_retry_on_conflict": 3}}
-                json_data += json.dumps(doc_data) + '\n'
-                json_data += json.dumps({'doc': genes[ens_id]}) + '\n'
-            if json_data != '':
-                Loader().bulk_load(idx, idx_type, json_data)
+        return genes
 
     @classmethod
     def ensmart_gene_parse(cls, ensmart_f, idx, idx_type):
         ''' For those gene docs missing a dbxrefs.entrez use Ensembl Mart to
         fill in. '''
+        genes = cls._ensmart_genes(ensmart_f)
+
+        '''  search for the entrez ids '''
+        hits = ElasticClient.get().ids(idx, list(genes.keys()), idx_type=idx_type, sources=['dbxrefs'])
+        writer = BulkWriter(idx, idx_type)
+        for hit in hits:
+            ens_id = hit['_id']
+            if cls._entrez_conflict(ens_id, hit['_source'].get('dbxrefs', {}), genes[ens_id]):
+                continue
+            writer.update(ens_id, genes[ens_id], idx_type=hit['_type'])
+        writer.close()
+
+    @classmethod
+    def _entrez_conflict(cls, ens_id, dbxrefs, gene):
+        ''' Check if an Ensembl Mart entrez id differs from that of a gene doc. '''
+        if ('entrez' in gene['dbxrefs'] and
+            'entrez' in dbxrefs and
+           dbxrefs['entrez'] != gene['dbxrefs']['entrez']):
+            logger.warn('Multiple entrez ids for ensembl id: '+ens_id)
+            return True
+        return False
+
+    @classmethod
+    def _ensmart_genes(cls, ensmart_f):
+        ''' Get an ensembl:{'dbxrefs': {...}} dictionary of the entrez, swissprot and
+        trembl ids from Ensembl Mart. '''
         genes = {}
         for ensmart in ensmart_f:
             parts = ensmart.split('\t')
@@ -173,34 +209,7 @@ class Gene(object):
                     genes[ens_id]['dbxrefs'].update({'swissprot': swissprot})
                 if trembl != '':
                     genes[ens_id]['dbxrefs'].update({'trembl': trembl})
-
-        '''  search for the entrez ids '''
-        query = ElasticQuery(Query.ids(list(genes.keys())))
-        docs = Search(query, idx=idx, idx_type=idx_type, size=80000).search().docs
-        chunk_size = 450
-        for i in range(0, len(docs), chunk_size):
-            docs_chunk = docs[i:i+chunk_size]
-            json_data = ''
-            for doc in docs_chunk:
-                ens_id = doc._meta['_id']
-                if 'dbxrefs' in doc.__dict__:
-                    dbxrefs = getattr(doc, 'dbxrefs')
-                else:
-                    dbxrefs = {}
-
-                if ('entrez' in genes[ens_id]['dbxrefs'] and
-                    'entrez' in dbxrefs and
-                   dbxrefs['entrez'] != genes[ens_id]['dbxrefs']['entrez']):
-                    logger.warn('Multiple entrez ids for ensembl id: '+ens_id)
-                    continue
-
-                idx_type = doc.type()
-                doc_data = {"update": {"_id": ens_id, "_type": idx_type,
-                                       "_index": idx, "_retry_on_conflict": 3}}
-                json_data += json.dumps(doc_data) + '\n'
-                json_data += json.dumps({'doc': genes[ens_id]}) + '\n'
-            if json_data != '':
-                Loader().bulk_load(idx, idx_type, json_data)
+        return genes
 
     @classmethod
     def _add_to_dbxref(cls, gene, db, dbxref):
@@ -218,6 +227,21 @@ class Gene(object):
     @classmethod
     def ensmart_homolog_parse(cls, ensmart_f, attrs, idx, idx_type):
         ''' Add homolog information. '''
+        genes = cls._ensmart_homologs(ensmart_f, attrs)
+
+        '''  search for the entrez ids '''
+        hits = ElasticClient.get().ids(idx, list(genes.keys()), idx_type=idx_type, sources=['dbxrefs'])
+        writer = BulkWriter(idx, idx_type)
+        for hit in hits:
+            ens_id = hit['_id']
+            dbxrefs = hit['_source'].get('dbxrefs', {})
+            dbxrefs['orthologs'] = genes[ens_id]
+            writer.update(ens_id, {'dbxrefs': dbxrefs}, idx_type=hit['_type'])
+        writer.close()
+
+    @classmethod
+    def _ensmart_homologs(cls, ensmart_f, attrs):
+        ''' Get an ensembl:{<organism>: {"ensembl": ...}} dictionary of orthologs from Ensembl Mart. '''
         genes = {}
         homologs = [a.strip().replace('_homolog_ensembl_gene', '') for a in attrs.split(',')
                     if a.strip() != 'ensembl_gene_id']
@@ -233,33 +257,16 @@ class Gene(object):
                     dbxrefs[homologs[i-1]] = {"ensembl": parts[i].strip()}
             if len(dbxrefs) > 0:
                 genes[ens_id] = dbxrefs
+        return genes
 
-        '''  search for the entrez ids '''
-        query = ElasticQuery(Query.ids(list(genes.keys())))
-        docs = Search(query, idx=idx, idx_type=idx_type, size=80000).search().docs
-        chunk_size = 450
-        for i in range(0, len(docs), chunk_size):
-            docs_chunk = docs[i:i+chunk_size]
-            json_data = ''
-            for doc in docs_chunk:
-                ens_id = doc._meta['_id']
-                if 'dbxrefs' in doc.__dict__:
-                    dbxrefs = getattr(doc, 'dbxrefs')
-                else:
-                    dbxrefs = {}
-                dbxrefs['orthologs'] = genes[ens_id]
-                idx_type = doc.type()
-                doc_data = {"update": {"_id": ens_id, "_type": idx_type,
-                                       "_index": idx, "_retry_on_conflict": 3}}
-                json_data += json.dumps(doc_data) + '\n'
-                json_data += json.dumps({'doc': {'dbxrefs': dbxrefs}}) + '\n'
-            if json_data != '':
-                Loader().bulk_load(idx, idx_type, json_data)
-
-    @classmethod
-    def gene_info_parse(cls, gene_infos, idx):
+    @classmethod
+    def gene_info_parse(cls, gene_infos, idx, idx_type='gene'):
         ''' Parse gene_info file from NCBI and add info to gene index. '''
+        cls._update_gene(cls._gene_infos(gene_infos), idx, idx_type)
 
+    @classmethod
+    def _gene_infos(cls, gene_infos):
+        ''' Get an entrez:{synonyms, dbxrefs, description, suggest} dictionary from gene_info. '''
         # tax_id GeneID Symbol LocusTag Synonyms dbXrefs chromosome map_location description type_of_gene
         # Symbol_from_nomenclature_authority Full_name_from_nomenclature_authority Nomenclature_status
         # Other_designations Modification_date]
@@ -278,12 +285,33 @@ class Gene(object):
                 gene['suggest']["input"] = suggests
                 gene['suggest']["weight"] = 50
                 genes[parts[1]] = gene
+        return genes
 
-        cls._update_gene(genes, idx)
+    @classmethod
+    def gene_pub_parse(cls, gene_pubs, idx, pub_idx=None, pub_idx_type=None, cache_dir=None,
+                       links_type=None, gene_idx_type='gene'):
+        ''' Parse gene2pubmed file from NCBI and add PMIDs to gene index. If a publication
+        index is given the ensembl ids of the genes are also added to the publication docs.
+        If links_type is given the gene-publication links are indexed as child docs of the
+        genes (see L{gene_pub_links}) and only the number of PMIDs (pmid_count) is added to
+        the gene docs, clearing any pmids array loaded before. The links mapping is created
+        with the gene mapping (see L{gene_mapping}). '''
+        genes = cls._gene_pubs(gene_pubs)
+        if links_type is not None:
+            cls._check_gene_pub_links_mapping(idx, links_type)
+            entrez_ensembl = cls._update_gene({entrez: {"pmid_count": len(set(gene["pmids"])), "pmids": None}
+                                               for entrez, gene in genes.items()}, idx, gene_idx_type)
+            cls._clear_gene_pmids(idx, gene_idx_type)
+            cls._load_gene_pub_links(genes, entrez_ensembl, idx, links_type)
+        else:
+            entrez_ensembl = cls._update_gene(genes, idx, gene_idx_type)
+        if pub_idx is not None and ElasticClient.get().index_exists(pub_idx):
+            cls._update_pub_genes(cls._pmid_genes(genes, entrez_ensembl), pub_idx, pub_idx_type,
+                                  cache_dir=cache_dir)
 
     @classmethod
-    def gene_pub_parse(cls, gene_pubs, idx):
-        ''' Parse gene2pubmed file from NCBI and add PMIDs to gene index. '''
+    def _gene_pubs(cls, gene_pubs):
+        ''' Get an entrez:{"pmids": [...]} dictionary from gene2pubmed. '''
         genes = {}
         for gene_pub in gene_pubs:
             if not gene_pub.startswith('9606\t'):
@@ -294,93 +322,172 @@ class Gene(object):
                 genes[parts[1]]["pmids"].append(pmid)
             else:
                 genes[parts[1]] = {"pmids": [pmid]}
-        cls._update_gene(genes, idx)
+        return genes
+
+    @classmethod
+    def _check_gene_pub_links_mapping(cls, idx, links_type):
+        ''' Check the links mapping was created with the gene mapping. '''
+        resp = ElasticClient.get().request('GET', ElasticClient.path(idx, endpoint='_mapping/' + links_type))
+        if resp.status_code != 200 or len(resp.json()) == 0:
+            raise PipelineError('No mapping for the gene publication links ' + links_type + ' in ' + idx +
+                                ' (set pub_links_type in the gene mapping section)')
+
+    @classmethod
+    def _clear_gene_pmids(cls, idx, gene_idx_type):
+        ''' Clear the pmids arrays left on gene docs (loaded before the links were used). '''
+        bulk_join()
+        client = ElasticClient.get()
+        client.refresh(idx)
+        writer = BulkWriter(idx, gene_idx_type)
+        for hit in client.scroll(idx, idx_type=gene_idx_type, query={"exists": {"field": "pmids"}}, sources=False):
+            writer.update(hit['_id'], {"pmids": None})
+        count = writer.close()
+        if count > 0:
+            logger.debug("No. gene docs with pmids cleared "+str(count))
+
+    @classmethod
+    def _load_gene_pub_links(cls, genes, entrez_ensembl, idx, links_type):
+        ''' Index a child doc (routed to the parent gene) for each gene-publication link
+        and delete the links loaded before that are no longer in gene2pubmed. '''
+        link_ids = set()
+        writer = BulkWriter(idx, links_type)
+        for entrez, ens_ids in entrez_ensembl.items():
+            for ens_id in ens_ids:
+                for pmid in set(genes[entrez]["pmids"]):
+                    link_ids.add(ens_id + '_' + pmid)
+                    writer.index({"pmid": int(pmid)}, doc_id=ens_id + '_' + pmid, parent=ens_id)
+        count = writer.close()
+        logger.debug("No. gene publication links "+str(count))
+        cls._delete_gene_pub_links(idx, links_type, link_ids)
+
+    @classmethod
+    def _delete_gene_pub_links(cls, idx, links_type, link_ids):
+        ''' Delete the gene publication links not in a set of link ids (<ensembl id>_<pmid>). '''
+        bulk_join()
+        client = ElasticClient.get()
+        client.refresh(idx)
+        writer = BulkWriter(idx, links_type)
+        for hit in client.scroll(idx, idx_type=links_type, sources=False):
+            if hit['_id'] not in link_ids:
+                writer.delete(hit['_id'], parent=hit['_id'].rsplit('_', 1)[0])
+        count = writer.close()
+        if count > 0:
+            logger.debug("No. gene publication links deleted "+str(count))
+
+    @classmethod
+    def gene_pub_links(cls, idx, links_type, ens_id, start=0, size=100):
+        ''' Get a page of the PMIDs linked to a gene (most recent first).
+        @type  ens_id: str
+        @param ens_id: Ensembl id of the gene.
+        @type  start: int
+        @keyword start: Offset of the first link.
+        @type  size: int
+        @keyword size: Page size.
+        @return: (total number of links, list of PMIDs)
+        '''
+        body = {"query": {"term": {"_parent": ens_id}}, "_source": ["pmid"],
+                "sort": [{"pmid": "desc"}], "from": start, "size": size}
+        hits = ElasticClient.get().search(idx, body, idx_type=links_type, params={"routing": ens_id})['hits']
+        return (hits['total'], [hit['_source']['pmid'] for hit in hits['hits']])
+
+    @classmethod
+    def _pmid_genes(cls, genes, entrez_ensembl):
+        ''' Get a PMID:[ensembl ids] dictionary from the gene PMIDs (entrez:{"pmids": [...]})
+        and an entrez:ensembl dictionary. '''
+        pmid_genes = {}
+        for entrez, ens_ids in entrez_ensembl.items():
+            if entrez not in genes:
+                continue
+            for pmid in genes[entrez]["pmids"]:
+                pmid_genes.setdefault(pmid, set()).update(ens_ids)
+        return {pmid: sorted(ens_ids) for pmid, ens_ids in pmid_genes.items()}
+
+    @classmethod
+    def _update_pub_genes(cls, pmid_genes, pub_idx, pub_idx_type, cache_dir=None):
+        ''' Add the genes to the publication docs that are in the index with a partial update.
+        Publications fetched or indexed again after this have no genes until the gene2pubmed
+        section is loaded again. '''
+        ElasticClient.get().put_mapping(pub_idx, pub_idx_type, {"properties": Pubs.GENES_MAPPING})
+
+        pmids = list(pmid_genes.keys())
+        pmids = [pmid for pmid, f in zip(pmids, PmidIndex.load(pub_idx, cache_dir=cache_dir,
+                                                               idx_type=pub_idx_type).contains(pmids)) if f]
+        writer = BulkWriter(pub_idx, pub_idx_type)
+        for pmid in pmids:
+            writer.update(pmid, {'genes': pmid_genes[pmid]})
+        writer.close()
+        logger.debug("No. publications updated with genes "+str(len(pmids)))
 
     @classmethod
     def gene_history_parse(cls, gene_his, idx, idx_type):
         ''' Parse gene_history file from NCBI and load. '''
-        json_data = ''
-        line_num = 0
+        writer = BulkWriter(idx, idx_type)
         for gene_his in gene_his:
             if gene_his.startswith('9606\t'):
                 parts = gene_his.strip().split('\t')
 
-                row_obj = {"index": {"_index": idx, "_type": idx_type}}
                 if parts[1] != "-":
                     row = {"geneid": int(parts[1]), "discontinued_geneid": int(parts[2]),
                            "discontinued_symbol": parts[3], "discontinue_date": parts[4]}
                 else:
                     row = {"discontinued_geneid": int(parts[2]),
                            "discontinued_symbol": parts[3], "discontinue_date": parts[4]}
-                json_data += json.dumps(row_obj) + '\n'
-                json_data += json.dumps(row) + '\n'
-                line_num += 1
-
-                if(line_num > 5000):
-                    line_num = 0
-                    print('.', end="", flush=True)
-                    Loader().bulk_load(idx, idx_type, json_data)
-                    json_data = ''
-        if line_num > 0:
-            Loader().bulk_load(idx, idx_type, json_data)
+                writer.index(row)
+        writer.close()
 
     @classmethod
     def gene_mgi_parse(cls, gene_pubs, idx):
         ''' Parse Ensembl and MGI data from JAX. '''
+        orthogenes_mgi = cls._gene_mgi(gene_pubs)
+        writer = BulkWriter(idx, None)
+        hits = ElasticClient.get().terms(idx, "dbxrefs.orthologs.mmusculus.ensembl", orthogenes_mgi.keys(),
+                                         sources=['dbxrefs.orthologs.mmusculus'])
+        for hit in hits:
+            ens_id = hit['_id']
+            idx_type = hit['_type']
+            mm = hit['_source']['dbxrefs']['orthologs']['mmusculus']
+            mm['MGI'] = orthogenes_mgi[mm['ensembl']]
+            dbxrefs = {"dbxrefs": {'orthologs': {"mmusculus": mm}}}
+            writer.update(ens_id, dbxrefs, idx_type=idx_type)
+        writer.close()
+
+    @classmethod
+    def _gene_mgi(cls, gene_mgis):
+        ''' Get a mouse ensembl:MGI id dictionary from the JAX MRK_ENSEMBL report. '''
         orthogenes_mgi = {}
-        for gene_mgi in gene_pubs:
+        for gene_mgi in gene_mgis:
             parts = gene_mgi.split('\t')
             if 'MGI:' not in parts[0]:
                 raise PipelineError('MGI not found '+parts[0])
             if 'ENSMUSG' not in parts[5]:
                 raise PipelineError('ENSMUSG not found '+parts[5])
             orthogenes_mgi[parts[5]] = parts[0].replace('MGI:', '')
+        return orthogenes_mgi
 
-        orthogene_keys = list(orthogenes_mgi.keys())
-        chunk_size = 450
-        for i in range(0, len(orthogene_keys), chunk_size):
-            chunk_gene_keys = orthogene_keys[i:i+chunk_size]
-            json_data = ''
-            query = ElasticQuery.filtered(Query.match_all(),
-                                          TermsFilter.get_terms_filter("dbxrefs.orthologs.mmusculus.ensembl",
-                                                                       chunk_gene_keys))
-            docs = Search(query, idx=idx, size=chunk_size).search().docs
-            for doc in docs:
-                ens_id = doc.doc_id()
-                idx_type = doc.type()
-                mm = getattr(doc, 'dbxrefs')['orthologs']['mmusculus']
-                mm['MGI'] = orthogenes_mgi[mm['ensembl']]
-                dbxrefs = {"dbxrefs": {'orthologs': {"mmusculus": mm}}}
-                doc_data = {"update": {"_id": ens_id, "_type": idx_type,
-                                       "_index": idx, "_retry_on_conflict": 3}}
-                json_data += json.dumps(doc_data) + '\n'
-                json_data += json.dumps({'doc': dbxrefs}) + '\n'
-
-            if json_data != '':
-                Loader().bulk_load(idx, idx_type, json_data)
-
-    @classmethod
-    def _update_gene(cls, genes, idx):
-        ''' Use genes data to update the index. '''
-        gene_keys = list(genes.keys())
-        chunk_size = 450
-        for i in range(0, len(genes), chunk_size):
-            chunk_gene_keys = gene_keys[i:i+chunk_size]
-            json_data = ''
-
-            query = ElasticQuery.filtered(Query.match_all(),
-                                          TermsFilter.get_terms_filter("dbxrefs.entrez", chunk_gene_keys))
-            docs = Search(query, idx=idx, size=chunk_size).search().docs
-            for doc in docs:
-                ens_id = doc._meta['_id']
-                idx_type = doc.type()
-                entrez = getattr(doc, 'dbxrefs')['entrez']
-                doc_data = {"update": {"_id": ens_id, "_type": idx_type,
-                                       "_index": idx, "_retry_on_conflict": 3}}
-                json_data += json.dumps(doc_data) + '\n'
-                json_data += json.dumps({'doc': genes[entrez]}) + '\n'
-            if json_data != '':
-                Loader().bulk_load(idx, idx_type, json_data)
+    @classmethod
+    def _update_gene(cls, genes, idx, idx_type='gene'):
+        ''' Use genes data to update the index. Returns an entrez:[ensembl ids] dictionary
+        of the docs updated. '''
+        id_map = GeneIdMap.active
+        if id_map is not None:
+            entrez_ensembl = id_map.entrez_ensembls(genes.keys())
+            writer = BulkWriter(idx, idx_type)
+            for entrez, ens_ids in entrez_ensembl.items():
+                for ens_id in ens_ids:
+                    writer.update(ens_id, genes[entrez])
+            writer.close()
+            return entrez_ensembl
+
+        entrez_ensembl = {}
+        writer = BulkWriter(idx, None)
+        hits = ElasticClient.get().terms(idx, "dbxrefs.entrez", genes.keys(), sources=['dbxrefs.entrez'])
+        for hit in hits:
+            ens_id = hit['_id']
+            entrez = hit['_source']['dbxrefs']['entrez']
+            writer.update(ens_id, genes[entrez], idx_type=hit['_type'])
+            entrez_ensembl.setdefault(entrez, []).append(ens_id)
+        writer.close()
+        return entrez_ensembl
 
     @classmethod
     def _set_dbxrefs(cls, entrez, dbxrefs, gi):
@@ -402,41 +509,43 @@ class Gene(object):
     @classmethod
     def _entrez_ensembl_lookup(cls, gene_sets, section, config=None):
         ''' Get an entrez:ensembl id dictionary. '''
-        (newgene_ids, discontinued_ids) = Gene._check_gene_history(gene_sets, config)
-        replaced_gene_sets = Gene._replace_oldids_with_newids(gene_sets, newgene_ids, discontinued_ids)
-        equery = ElasticQuery.filtered(Query.match_all(),
-                                       TermsFilter.get_terms_filter("dbxrefs.entrez", replaced_gene_sets),
+        if GeneHistory.active is not None:
+            replaced_gene_sets = GeneHistory.active.remap(gene_sets)
+        else:
+            (newgene_ids, discontinued_ids) = Gene._check_gene_history(gene_sets, config)
+            replaced_gene_sets = Gene._replace_oldids_with_newids(gene_sets, newgene_ids, discontinued_ids)
+        if GeneIdMap.active is not None:
+            return GeneIdMap.active.entrez_ensembl(replaced_gene_sets)
+        hits = LookupCache.get().terms(section['index'], "dbxrefs.entrez", replaced_gene_sets,
                                        sources=['dbxrefs.ensembl', 'dbxrefs.entrez'])
-
-        docs = Search(equery, idx=section['index'], size=len(replaced_gene_sets)).search().docs
-        return {getattr(doc, 'dbxrefs')['entrez']: doc.doc_id() for doc in docs}
+        return {hit['_source']['dbxrefs']['entrez']: hit['_id'] for hit in hits}
 
     @classmethod
     def _ensembl_entrez_lookup(cls, ensembl_gene_sets, section):
         ''' Get an ensembl:entrez id dictionary. '''
-        equery = ElasticQuery.filtered(Query.match_all(),
-                                       TermsFilter.get_terms_filter("dbxrefs.ensembl", ensembl_gene_sets),
+        if GeneIdMap.active is not None:
+            return GeneIdMap.active.ensembl_entrez(ensembl_gene_sets)
+        hits = LookupCache.get().terms(section['index'], "dbxrefs.ensembl", ensembl_gene_sets,
                                        sources=['dbxrefs.ensembl', 'dbxrefs.entrez'])
-
-        docs = Search(equery, idx=section['index'], size=len(ensembl_gene_sets)).search().docs
-        return {doc.doc_id(): getattr(doc, 'dbxrefs')['entrez'] for doc in docs}
+        return {hit['_id']: hit['_source']['dbxrefs']['entrez'] for hit in hits}
 
     @classmethod
     def _check_gene_history(cls, gene_sets, config):
-        '''find a way to handle this better'''
+        ''' Get the (discontinued:new gene id dictionary, discontinued gene ids) of the gene
+        ids. Chains of changes are followed with the active L{GeneHistory}, otherwise the
+        gene history index is searched for a single change. '''
+        if GeneHistory.active is not None:
+            return GeneHistory.active.changes(gene_sets)
 
         section = config['GENE_HISTORY']
-        query = ElasticQuery.filtered(Query.match_all(),
-                                      TermsFilter.get_terms_filter("discontinued_geneid", gene_sets),
-                                      sources=['geneid', 'discontinued_geneid'])
-        docs = Search(query, idx=section['index'], idx_type=section['index_type'],
-                      size=len(gene_sets)).search().docs
+        hits = LookupCache.get().terms(section['index'], "discontinued_geneid", gene_sets,
+                                       idx_type=section['index_type'], sources=['geneid', 'discontinued_geneid'])
 
         newgene_ids = {}
         discountinued_geneids = []
-        for doc in docs:
-            geneid = getattr(doc, 'geneid')
-            discontinued_geneid = getattr(doc, 'discontinued_geneid')
+        for hit in hits:
+            geneid = hit['_source'].get('geneid')
+            discontinued_geneid = hit['_source'].get('discontinued_geneid')
             if geneid is None:
                 discountinued_geneids.append(str(discontinued_geneid))
             else:
@@ -445,11 +554,10 @@ class Gene(object):
 
     @classmethod
     def _replace_oldids_with_newids(cls, gene_sets, new_gene_sets, discontinued_ids=None):
-        replaced_genesets = [new_gene_sets[gene_id] if gene_id in new_gene_sets else gene_id for gene_id in gene_sets]
-
-        if discontinued_ids:
-            for gene_id in discontinued_ids:
-                if gene_id in gene_sets:
-                    logger.debug('removed gene id ' + str(gene_id))
-                    replaced_genesets.remove(gene_id)
+        ''' Replace the gene ids that have changed and remove those discontinued. '''
+        discontinued_ids = set(discontinued_ids) if discontinued_ids else set()
+        replaced_genesets = [new_gene_sets.get(gene_id, gene_id) for gene_id in gene_sets
+                             if gene_id not in discontinued_ids]
+        if len(replaced_genesets) < len(gene_sets):
+            logger.debug('removed ' + str(len(gene_sets) - len(replaced_genesets)) + ' discontinued gene ids')
         return replaced_genesets
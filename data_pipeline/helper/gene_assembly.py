@@ -0,0 +1,193 @@
+''' Used to assemble complete gene documents from the gene downloads. '''
+
+import gzip
+import logging
+import os
+from collections import OrderedDict
+from data_pipeline.helper.bulk import BulkWriter
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.exceptions import PipelineError
+from data_pipeline.helper.gene import Gene
+
+logger = logging.getLogger(__name__)
+
+
+class GeneAssembly(object):
+    ''' Join the gene downloads on their ensembl and entrez ids locally and index
+    each gene doc once, rather than indexing the Ensembl genes and then updating
+    them from each of the other downloads in turn.
+
+    The downloads are applied in the order of the sections. Each section is
+    recognised by its pipeline hook (e.g. gene2ensembl_parse) and is parsed and
+    merged as that hook would update the index: ensembl keyed data (gene2ensembl,
+    Ensembl Mart genes and homologs) is added to the doc with that id and entrez
+    keyed data (gene_info, gene2pubmed) to the docs with that dbxrefs.entrez. The
+    merge follows an elastic partial update (objects are merged, other values
+    replaced) and an Ensembl Mart entrez id that conflicts with that of a doc is
+    not added.
+
+    [GENE_ASSEMBLY]
+    load: gene_assembly
+    sections: ENSEMBL_GENE, GENE2ENSEMBL, ENSMART_GENE, GENE_INFO, GENE_PUBS, ENSMART_HOMOLOG, ENSEMBL2MGI
+    '''
+
+    def __init__(self, gene_list):
+        '''
+        @type  gene_list: dict
+        @param gene_list: Ensembl genes ({"docs": [...]}, see L{Gene.ensembl_gene_parse}).
+        '''
+        self.docs = OrderedDict()
+        for doc in gene_list['docs']:
+            doc = dict(doc)
+            self.docs[doc.pop('_id')] = doc
+        # gene2pubmed PMIDs and the entrez:[ensembl ids] of the docs they were added to
+        self.gene_pubs = None
+        self.entrez_ensembl = None
+        self.pub_section = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    @classmethod
+    def merge(cls, doc, update):
+        ''' Merge a partial update into a doc (objects are merged and other values replaced). '''
+        for key, value in update.items():
+            if isinstance(value, dict) and isinstance(doc.get(key), dict):
+                cls.merge(doc[key], value)
+            elif isinstance(value, dict):
+                doc[key] = cls.merge({}, value)
+            else:
+                doc[key] = value
+        return doc
+
+    def _update_ensembl(self, genes):
+        ''' Merge ensembl keyed updates into the docs. '''
+        count = 0
+        for ens_id, update in genes.items():
+            if ens_id in self.docs:
+                GeneAssembly.merge(self.docs[ens_id], update)
+                count += 1
+        return count
+
+    def _update_entrez(self, genes):
+        ''' Merge entrez keyed updates into the docs with that entrez id (see L{Gene._update_gene}).
+        @return: entrez:[ensembl ids] dictionary of the docs updated.
+        '''
+        entrez_ensembl = {}
+        for ens_id, doc in self.docs.items():
+            entrez = doc.get('dbxrefs', {}).get('entrez')
+            if entrez is not None and entrez in genes:
+                GeneAssembly.merge(doc, genes[entrez])
+                entrez_ensembl.setdefault(entrez, []).append(ens_id)
+        return entrez_ensembl
+
+    def gene2ensembl(self, gene2ens):
+        return self._update_ensembl(Gene._gene2ensembl(gene2ens))
+
+    def ensmart_gene(self, ensmart_f):
+        genes = Gene._ensmart_genes(ensmart_f)
+        genes = {ens_id: gene for ens_id, gene in genes.items()
+                 if ens_id in self.docs and
+                 not Gene._entrez_conflict(ens_id, self.docs[ens_id].get('dbxrefs', {}), gene)}
+        return self._update_ensembl(genes)
+
+    def gene_info(self, gene_infos):
+        return len(self._update_entrez(Gene._gene_infos(gene_infos)))
+
+    def gene_pub(self, gene_pubs, links=False):
+        ''' Add the PMIDs (or if links is set the number of PMIDs) to the docs. '''
+        self.gene_pubs = Gene._gene_pubs(gene_pubs)
+        if links:
+            self.entrez_ensembl = self._update_entrez({entrez: {"pmid_count": len(set(gene["pmids"]))}
+                                                       for entrez, gene in self.gene_pubs.items()})
+        else:
+            self.entrez_ensembl = self._update_entrez(self.gene_pubs)
+        return len(self.entrez_ensembl)
+
+    def ensmart_homolog(self, ensmart_f, attrs):
+        return self._update_ensembl({ens_id: {'dbxrefs': {'orthologs': orthologs}}
+                                     for ens_id, orthologs in Gene._ensmart_homologs(ensmart_f, attrs).items()})
+
+    def gene_mgi(self, gene_mgis):
+        orthogenes_mgi = Gene._gene_mgi(gene_mgis)
+        count = 0
+        for doc in self.docs.values():
+            mm = doc.get('dbxrefs', {}).get('orthologs', {}).get('mmusculus')
+            if mm is not None and mm.get('ensembl') in orthogenes_mgi:
+                mm['MGI'] = orthogenes_mgi[mm['ensembl']]
+                count += 1
+        return count
+
+    @classmethod
+    def _open(cls, file_name):
+        if not os.path.exists(file_name):
+            raise PipelineError('File does not exist: ' + file_name)
+        opener = gzip.open if file_name.endswith('.gz') else open
+        return opener(file_name, 'rt')
+
+    @classmethod
+    def _download_file(cls, download_dir, section_name, section):
+        name = section['output'] if 'output' in section else section['files'].strip()
+        return os.path.join(download_dir, section_name, name)
+
+    @classmethod
+    def build(cls, config, sections, download_dir):
+        ''' Assemble the gene docs from the downloads of the sections (in order).
+        @type  config: ConfigParser
+        @param config: Pipeline configuration.
+        @type  sections: list
+        @param sections: Names of the gene sections, the first being the Ensembl genes.
+        @type  download_dir: str
+        @param download_dir: The DOWNLOAD directory.
+        '''
+        assembly = None
+        for section_name in sections:
+            section = config[section_name]
+            hook = section['stage'] if 'stage' in section else section.get('load')
+            with cls._open(cls._download_file(download_dir, section_name, section)) as f:
+                if hook == 'ensembl_gene_parse':
+                    assembly = cls(Gene.ensembl_gene_parse(f))
+                    count = len(assembly)
+                elif assembly is None:
+                    raise PipelineError('The first gene assembly section should be the Ensembl genes: ' +
+                                        section_name)
+                elif hook == 'gene2ensembl_parse':
+                    count = assembly.gene2ensembl(f)
+                elif hook == 'ensmart_gene_parse':
+                    count = assembly.ensmart_gene(f)
+                elif hook == 'gene_info_parse':
+                    count = assembly.gene_info(f)
+                elif hook == 'gene_pub_parse':
+                    assembly.pub_section = section
+                    count = assembly.gene_pub(f, links='pub_links_type' in section)
+                elif hook == 'ensmart_homolog_parse':
+                    count = assembly.ensmart_homolog(f, section['attrs'])
+                elif hook == 'gene_mgi_parse':
+                    count = assembly.gene_mgi(f)
+                else:
+                    raise PipelineError('Gene assembly section not recognised: ' + section_name)
+            logger.debug("Gene assembly " + section_name + ": " + str(count) + " genes")
+        return assembly
+
+    def load(self, idx, idx_type):
+        ''' Index the gene docs in a single bulk pass. '''
+        writer = BulkWriter(idx, idx_type)
+        for ens_id, doc in self.docs.items():
+            writer.index(doc, doc_id=ens_id)
+        count = writer.close()
+        logger.debug("No. genes indexed " + str(count))
+        return count
+
+    def load_pubs(self, idx, cache_dir=None, gene_idx_type='gene'):
+        ''' Index the gene-publication links and add the genes to the publication docs
+        as configured in the gene2pubmed section (see L{Gene.gene_pub_parse}). '''
+        if self.gene_pubs is None:
+            return
+        section = self.pub_section
+        if 'pub_links_type' in section:
+            Gene._load_gene_pub_links(self.gene_pubs, self.entrez_ensembl, idx, section['pub_links_type'])
+        pub_idx = section['pub_index'] if 'pub_index' in section else None
+        if pub_idx is not None and ElasticClient.get().index_exists(pub_idx):
+            pub_idx_type = section['pub_index_type'] if 'pub_index_type' in section else 'publication'
+            Gene._update_pub_genes(Gene._pmid_genes(self.gene_pubs, self.entrez_ensembl), pub_idx, pub_idx_type,
+                                   cache_dir=cache_dir)
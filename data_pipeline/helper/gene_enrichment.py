@@ -0,0 +1,195 @@
+''' Pathway over-representation (enrichment) tests using bitset encoded gene sets. '''
+
+import glob
+import json
+import logging
+import os
+import time
+import numpy as np
+from data_pipeline.helper.scroll import Scroll
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+# number of bits set in each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class GeneEnrichment(object):
+    ''' Gene set enrichment over the staged pathway_genesets (L{GenePathways}).
+
+    Each gene set is encoded as a row of a packed bitset matrix (one bit per gene
+    in the gene universe). The matrix is persisted to a memory-mapped file so that
+    it is built once and can be shared:
+
+    <dir>/genesets.npy   - packed bitset matrix (n_genesets x ceil(n_genes/8))
+    <dir>/genesets.json  - gene universe, gene set names and sources
+
+    Over-representation is tested with the hypergeometric upper tail P(X >= k)
+    for batches of query gene lists at a time.
+    '''
+
+    MATRIX_FILE = 'genesets.npy'
+    META_FILE = 'genesets.json'
+
+    def __init__(self, genes, names, sources, matrix):
+        self.genes = genes
+        self.names = names
+        self.sources = sources
+        self.matrix = matrix
+        self.gene_index = {gene: i for i, gene in enumerate(genes)}
+        self.set_sizes = POPCOUNT[matrix].sum(axis=1, dtype=np.int64)
+        # log factorials used for the hypergeometric probabilities
+        self.log_fact = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, len(genes) + 1)))))
+
+    @classmethod
+    def gene_universe(cls, idx, idx_type):
+        ''' Get the gene universe (sorted ensembl ids) from the gene index. '''
+        return sorted(Scroll.ids(idx, idx_type=idx_type))
+
+    @classmethod
+    def build(cls, genes, stage_files, out_dir):
+        ''' Encode the gene sets in the staged pathway JSON files as a packed bitset
+        matrix and save it to out_dir.
+        @type  genes: list
+        @param genes: Gene universe (ensembl ids).
+        @type  stage_files: list
+        @param stage_files: Staged pathway_genesets JSON files.
+        @type  out_dir: str
+        @param out_dir: Directory to write the matrix and metadata to.
+        '''
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        gene_index = {gene: i for i, gene in enumerate(genes)}
+
+        names = []
+        sources = []
+        rows = []
+        for stage_file in stage_files:
+            with open(stage_file, encoding='utf-8') as json_file:
+                docs = json.load(json_file)['docs']
+            for doc in docs:
+                names.append(doc['pathway_name'])
+                sources.append(doc['source'])
+                rows.append([gene_index[g] for g in doc['gene_sets'] if g in gene_index])
+
+        n_bytes = (len(genes) + 7) // 8
+        matrix = np.lib.format.open_memmap(os.path.join(out_dir, cls.MATRIX_FILE), mode='w+',
+                                           dtype=np.uint8, shape=(len(rows), n_bytes))
+        for i, row in enumerate(rows):
+            bits = np.zeros(n_bytes * 8, dtype=np.bool_)
+            bits[row] = True
+            matrix[i] = np.packbits(bits)
+        matrix.flush()
+        del matrix
+
+        with open(os.path.join(out_dir, cls.META_FILE), 'w', encoding='utf-8') as meta_file:
+            json.dump({"genes": genes, "names": names, "sources": sources}, meta_file)
+        logger.debug("Encoded " + str(len(rows)) + " gene sets over " + str(len(genes)) + " genes")
+        return cls.load(out_dir)
+
+    @classmethod
+    def load(cls, out_dir):
+        ''' Load the memory-mapped gene set matrix saved by L{build}. '''
+        meta_file_path = os.path.join(out_dir, cls.META_FILE)
+        if not os.path.exists(meta_file_path):
+            raise PipelineError('Gene set matrix not found in ' + out_dir)
+        with open(meta_file_path, encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        matrix = np.load(os.path.join(out_dir, cls.MATRIX_FILE), mmap_mode='r')
+        return cls(meta['genes'], meta['names'], meta['sources'], matrix)
+
+    @classmethod
+    def stage_files(cls, stage_dir):
+        ''' List the staged pathway_genesets JSON files (see L{GenePathways}). '''
+        return sorted(f for f in glob.glob(os.path.join(stage_dir, '*.gmt.json')))
+
+    def encode(self, gene_lists):
+        ''' Encode query gene lists as an unpacked (n_lists x n_genes) 0/1 matrix.
+        Genes not in the universe are ignored. '''
+        queries = np.zeros((len(gene_lists), len(self.genes)), dtype=np.float32)
+        for i, gene_list in enumerate(gene_lists):
+            cols = [self.gene_index[g] for g in gene_list if g in self.gene_index]
+            queries[i, cols] = 1
+        return queries
+
+    def hypergeometric(self, gene_lists, batch_size=256, chunk_size=2000):
+        ''' Test each query gene list for over-representation in each gene set.
+        @type  gene_lists: list
+        @param gene_lists: List of query gene lists (ensembl ids).
+        @type  batch_size: int
+        @keyword batch_size: Number of query lists tested together.
+        @type  chunk_size: int
+        @keyword chunk_size: Number of gene sets unpacked at a time.
+        @return: (p-values, overlaps) arrays of shape (n_lists x n_genesets).
+        '''
+        n_sets = self.matrix.shape[0]
+        pvalues = np.ones((len(gene_lists), n_sets), dtype=np.float64)
+        overlaps = np.zeros((len(gene_lists), n_sets), dtype=np.int64)
+
+        for j in range(0, n_sets, chunk_size):
+            sets = np.unpackbits(self.matrix[j:j+chunk_size], axis=1)[:, :len(self.genes)]
+            sets = sets.astype(np.float32).T
+            set_sizes = self.set_sizes[j:j+chunk_size]
+            for i in range(0, len(gene_lists), batch_size):
+                queries = self.encode(gene_lists[i:i+batch_size])
+                query_sizes = queries.sum(axis=1).astype(np.int64)
+                k = np.rint(queries.dot(sets)).astype(np.int64)
+                overlaps[i:i+batch_size, j:j+chunk_size] = k
+                pvalues[i:i+batch_size, j:j+chunk_size] = self._upper_tail(k, query_sizes, set_sizes)
+        return (pvalues, overlaps)
+
+    def _log_choose(self, n, k):
+        return self.log_fact[n] - self.log_fact[k] - self.log_fact[n - k]
+
+    def _upper_tail(self, k, query_sizes, set_sizes, tol=1e-12):
+        ''' Hypergeometric P(X >= k) for arrays of overlaps k (queries x sets). '''
+        N = len(self.genes)
+        n = np.broadcast_to(query_sizes[:, None], k.shape)
+        K = np.broadcast_to(set_sizes[None, :], k.shape)
+        upper = np.minimum(n, K)
+        mode = ((n + 1) * (K + 1)) // (N + 2)
+        log_denom = self._log_choose(N, n)
+
+        pvalues = np.zeros(k.shape, dtype=np.float64)
+        i = k.copy()
+        active = i <= upper
+        while active.any():
+            valid = active & (n - i <= N - K)
+            ii = np.where(valid, i, 0)
+            ni = np.where(valid, n - ii, 0)
+            terms = np.exp(self._log_choose(np.where(valid, K, 0), ii) +
+                           self._log_choose(np.where(valid, N - K, 0), ni) -
+                           log_denom)
+            terms = np.where(valid, terms, 0.0)
+            pvalues += terms
+            # past the mode the terms decrease so stop once they are negligible
+            converged = (i > mode) & (terms <= pvalues * tol)
+            i += 1
+            active &= (i <= upper) & ~converged
+        pvalues[k == 0] = 1.0
+        return np.minimum(pvalues, 1.0)
+
+    def top(self, gene_list, n=10):
+        ''' Get the n most enriched gene sets for a single gene list. '''
+        (pvalues, overlaps) = self.hypergeometric([gene_list])
+        order = np.argsort(pvalues[0])[:n]
+        return [{"name": self.names[j], "source": self.sources[j], "overlap": int(overlaps[0, j]),
+                 "size": int(self.set_sizes[j]), "pvalue": float(pvalues[0, j])} for j in order]
+
+    @classmethod
+    def benchmark(cls, enrichment, n_queries=1000, query_size=200, batch_size=256, seed=1):
+        ''' Time the hypergeometric tests for random query gene lists drawn from
+        the gene universe. '''
+        rng = np.random.RandomState(seed)
+        query_size = min(query_size, len(enrichment.genes))
+        gene_lists = [[enrichment.genes[g] for g in rng.choice(len(enrichment.genes), query_size, replace=False)]
+                      for _ in range(n_queries)]
+        start = time.time()
+        enrichment.hypergeometric(gene_lists, batch_size=batch_size)
+        time_taken = time.time() - start
+        stats = {"queries": n_queries, "query_size": query_size, "genesets": enrichment.matrix.shape[0],
+                 "genes": len(enrichment.genes), "seconds": time_taken,
+                 "queries_per_second": n_queries / time_taken if time_taken > 0 else None}
+        logger.debug(json.dumps(stats))
+        return stats
@@ -0,0 +1,178 @@
+''' Used to resolve discontinued Entrez gene ids to their current gene id. '''
+
+import gzip
+import json
+import logging
+import os
+import numpy as np
+from data_pipeline.helper.gene_id_map import GeneIdMap
+
+logger = logging.getLogger(__name__)
+
+
+class GeneHistory(object):
+    ''' Resolve discontinued gene ids using the NCBI gene_history file (tax_id,
+    GeneID, Discontinued_GeneID, Discontinued_Symbol, Discontinue_Date).
+
+    The discontinued to current GeneID pairs are held as sorted integer arrays with
+    chains (a current id itself later discontinued) collapsed so that each id maps
+    to the id that is live now, or 0 if the chain ends in an id discontinued with no
+    replacement or in a cycle. The arrays are saved and memory-mapped:
+
+    <dir>/gene_history_old.npy  - sorted discontinued gene ids
+    <dir>/gene_history_new.npy  - current gene id for each (0 if discontinued)
+    <dir>/gene_history.json     - checksum of the gene_history file
+
+    While a resolver is active the gene id conversions in L{Gene} use it rather than
+    searching the gene history index. This is set for a section of the ini file with
+    gene_history, the section of the gene_history download (see
+    L{data_pipeline.utils.process_wrapper}). If that is not in the pipeline directory
+    the gene history index is searched.
+    '''
+
+    FILES = {'old': 'gene_history_old.npy', 'new': 'gene_history_new.npy'}
+    META_FILE = 'gene_history.json'
+
+    active = None
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def __len__(self):
+        return len(self.old)
+
+    def __enter__(self):
+        GeneHistory.active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if GeneHistory.active is self:
+            GeneHistory.active = None
+
+    @classmethod
+    def parse(cls, history_f, tax_id='9606'):
+        ''' Parse the GeneID and Discontinued_GeneID columns of gene_history lines. If a
+        gene id is discontinued more than once a replacement is kept over none. '''
+        rows = {}
+        prefix = tax_id + '\t'
+        for line in history_f:
+            if not line.startswith(prefix):
+                continue
+            parts = line.split('\t')
+            new_id = int(parts[1]) if parts[1] != '-' else 0
+            old_id = int(parts[2])
+            if rows.get(old_id, 0) == 0:
+                rows[old_id] = new_id
+
+        old = np.fromiter(rows.keys(), dtype=np.uint32, count=len(rows))
+        new = np.fromiter(rows.values(), dtype=np.uint32, count=len(rows))
+        order = np.argsort(old)
+        old = old[order]
+        return cls(old, cls._collapse(old, new[order]))
+
+    @classmethod
+    def _collapse(cls, old, new, max_depth=64):
+        ''' Follow chains so that each discontinued id maps to an id that is live (or 0).
+        Each step follows the chains already collapsed, so the length followed doubles.
+        Ids in, or leading to, a cycle are left unresolved and mapped to 0. '''
+        new = new.copy()
+        for _ in range(max_depth):
+            (pos, found) = cls._search(old, new)
+            found &= new != 0
+            if not found.any():
+                return new
+            new[found] = new[pos[found]]
+        (pos, found) = cls._search(old, new)
+        found &= new != 0
+        logger.warn('Gene history cycles, ' + str(int(found.sum())) + ' gene ids discontinued: ' +
+                    ', '.join(str(g) for g in old[found][:20].tolist()))
+        new[found] = 0
+        return new
+
+    @classmethod
+    def _search(cls, old, gene_ids):
+        pos = np.searchsorted(old, gene_ids)
+        pos[pos == len(old)] = 0
+        if len(old) == 0:
+            return (pos, np.zeros(len(gene_ids), dtype=np.bool_))
+        return (pos, old[pos] == gene_ids)
+
+    @classmethod
+    def _file_meta(cls, history_file):
+        return {"file": os.path.basename(history_file), "md5": GeneIdMap._checksum(history_file)}
+
+    def save(self, out_dir, meta):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for name, file_name in GeneHistory.FILES.items():
+            np.save(os.path.join(out_dir, file_name), getattr(self, name))
+        with open(os.path.join(out_dir, GeneHistory.META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, out_dir, history_file):
+        ''' Load the memory-mapped arrays, building them if they are missing or the
+        gene_history file (checksum) has changed since they were saved. '''
+        meta = cls._file_meta(history_file)
+        meta_file = os.path.join(out_dir, GeneHistory.META_FILE)
+        rebuild = True
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                rebuild = json.load(f) != meta
+        if rebuild:
+            opener = gzip.open if history_file.endswith('.gz') else open
+            with opener(history_file, 'rt') as history_f:
+                cls.parse(history_f).save(out_dir, meta)
+            logger.debug("Saved gene history to " + out_dir)
+        arrays = {name: np.load(os.path.join(out_dir, file_name), mmap_mode='r')
+                  for name, file_name in GeneHistory.FILES.items()}
+        return cls(arrays['old'], arrays['new'])
+
+    @classmethod
+    def for_section(cls, config, section_name, base_dir):
+        ''' Load the resolver for the gene_history download of a section (saved in STAGE).
+        @return: The resolver or None if the download is not in the pipeline directory.
+        '''
+        section = config[section_name]
+        history_file = os.path.join(base_dir, 'DOWNLOAD', section_name, section['files'].strip())
+        if not os.path.exists(history_file):
+            logger.warn('Gene history file does not exist, searching the gene history index: ' + history_file)
+            return None
+        return cls.load(os.path.join(base_dir, 'STAGE', section_name), history_file)
+
+    def resolve(self, gene_ids):
+        ''' Resolve gene ids to their current gene id.
+        @type  gene_ids: list
+        @param gene_ids: Entrez gene ids.
+        @return: (current gene ids array, discontinued boolean array). The current id is
+        the same as the given id if it has not been discontinued and 0 if it has no
+        replacement (or is not an integer).
+        '''
+        gene_ints = np.array([int(g) if g.isdigit() else 0 for g in gene_ids], dtype=np.uint32)
+        (pos, found) = GeneHistory._search(self.old, gene_ints)
+        found &= gene_ints != 0
+        current = np.where(found, self.new[pos], gene_ints) if len(self.old) > 0 else gene_ints
+        return (current, found)
+
+    def remap(self, gene_ids):
+        ''' Replace discontinued gene ids with their current id and remove those with no
+        replacement. '''
+        (current, found) = self.resolve(gene_ids)
+        return [str(c) if f else gene_id
+                for gene_id, c, f in zip(gene_ids, current.tolist(), found.tolist()) if not f or c != 0]
+
+    def changes(self, gene_ids):
+        ''' Get the (new gene ids, discontinued gene ids) of a list of gene ids as
+        returned by L{Gene._check_gene_history}. '''
+        (current, found) = self.resolve(gene_ids)
+        new_gene_ids = {}
+        discontinued_ids = []
+        for gene_id, c, f in zip(gene_ids, current.tolist(), found.tolist()):
+            if not f:
+                continue
+            if c == 0:
+                discontinued_ids.append(gene_id)
+            else:
+                new_gene_ids[gene_id] = str(c)
+        return (new_gene_ids, discontinued_ids)
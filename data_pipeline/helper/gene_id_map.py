@@ -0,0 +1,282 @@
+''' Used to map between Entrez, Ensembl and symbol gene ids locally. '''
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+
+class GeneIdMap(object):
+    ''' Map between Entrez, Ensembl and symbol gene ids without searching the gene
+    index. The map is built from the staged Ensembl genes, gene2ensembl (with the
+    entrez ids missing from it filled in from Ensembl Mart as when loading) and the
+    gene_info symbols. Keys are held as sorted arrays, the Entrez and symbol keys with
+    offsets into an array of the (indices of the) ensembl ids for each key. The arrays
+    are saved and memory-mapped so that processes share the pages:
+
+    <dir>/gene_ensembl.npy          - sorted ensembl ids
+    <dir>/gene_ens_entrez.npy       - entrez id of each ensembl id (0 if none)
+    <dir>/gene_entrez.npy           - sorted entrez ids
+    <dir>/gene_entrez_offsets.npy   - start of the ensembl ids of each entrez id
+    <dir>/gene_entrez_ens.npy       - indices of the ensembl ids of the entrez ids
+    <dir>/gene_symbol*.npy          - the same for the symbols
+    <dir>/gene_id_map.json          - checksums of the source files
+
+    The map is rebuilt if the checksum of a source file changes. While a map is
+    active the gene id conversions in L{Gene} use it. This is set for a section of
+    the ini file with gene_id_map, the gene sections the map is built from (see
+    L{data_pipeline.utils.process_wrapper}). These must be the files loaded into the
+    gene index, if they are not in the pipeline directory the index is searched:
+
+    gene_id_map: ENSEMBL_GENE, GENE2ENSEMBL, ENSMART_GENE, GENE_INFO
+    '''
+
+    FILES = {'ensembl': 'gene_ensembl.npy', 'ens_entrez': 'gene_ens_entrez.npy',
+             'entrez': 'gene_entrez.npy', 'entrez_offsets': 'gene_entrez_offsets.npy',
+             'entrez_ens': 'gene_entrez_ens.npy',
+             'symbol': 'gene_symbol.npy', 'symbol_offsets': 'gene_symbol_offsets.npy',
+             'symbol_ens': 'gene_symbol_ens.npy'}
+    META_FILE = 'gene_id_map.json'
+    MAP_DIR = 'GENE_ID_MAP'
+
+    active = None
+
+    def __init__(self, **arrays):
+        for name in GeneIdMap.FILES:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.ensembl)
+
+    def __enter__(self):
+        GeneIdMap.active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if GeneIdMap.active is self:
+            GeneIdMap.active = None
+
+    @classmethod
+    def _keys(cls, pairs, dtype):
+        ''' Get the sorted unique keys, offsets and values of (key, value) pairs. '''
+        pairs = sorted(set(pairs))
+        keys = np.array([p[0] for p in pairs], dtype=dtype)
+        (keys, starts) = np.unique(keys, return_index=True)
+        offsets = np.append(starts, len(pairs)).astype(np.uint32)
+        return (keys, offsets, np.array([p[1] for p in pairs], dtype=np.uint32))
+
+    @classmethod
+    def parse(cls, genes, entrez=None, symbols=None):
+        ''' Build the map.
+        @type  genes: dict
+        @param genes: ensembl:symbol dictionary of the Ensembl genes.
+        @type  entrez: dict
+        @keyword entrez: ensembl:entrez dictionary.
+        @type  symbols: dict
+        @keyword symbols: entrez:symbol dictionary.
+        '''
+        entrez = {ens_id: e for ens_id, e in (entrez or {}).items() if e is not None and e.isdigit()}
+        symbols = symbols or {}
+        ens_ids = sorted(genes)
+        ens_entrez = np.array([int(entrez.get(ens_id, 0)) for ens_id in ens_ids], dtype=np.uint32)
+
+        entrez_pairs = []
+        symbol_pairs = []
+        for i, ens_id in enumerate(ens_ids):
+            if genes[ens_id]:
+                symbol_pairs.append((genes[ens_id], i))
+            if ens_id in entrez:
+                entrez_pairs.append((int(entrez[ens_id]), i))
+                if entrez[ens_id] in symbols:
+                    symbol_pairs.append((symbols[entrez[ens_id]], i))
+
+        (entrez_keys, entrez_offsets, entrez_ens) = cls._keys(entrez_pairs, np.uint32)
+        (symbol_keys, symbol_offsets, symbol_ens) = cls._keys(symbol_pairs, np.str_)
+        return cls(ensembl=np.array(ens_ids, dtype=np.str_), ens_entrez=ens_entrez,
+                   entrez=entrez_keys, entrez_offsets=entrez_offsets, entrez_ens=entrez_ens,
+                   symbol=symbol_keys, symbol_offsets=symbol_offsets, symbol_ens=symbol_ens)
+
+    @classmethod
+    def _gene2ensembl(cls, gene2ens):
+        ''' Get an ensembl:entrez dictionary from gene2ensembl (the first entrez id is used). '''
+        entrez = {}
+        for line in gene2ens:
+            if line.startswith('9606\t'):
+                parts = line.split('\t')
+                entrez.setdefault(parts[2], parts[1])
+        return entrez
+
+    @classmethod
+    def _ensmart_entrez(cls, ensmart_f):
+        ''' Get an ensembl:entrez dictionary from Ensembl Mart (None if there is more than one). '''
+        entrez = {}
+        for line in ensmart_f:
+            parts = line.split('\t')
+            if len(parts) < 2 or parts[1].strip() == '':
+                continue
+            if parts[0] in entrez and entrez[parts[0]] != parts[1]:
+                entrez[parts[0]] = None
+            else:
+                entrez[parts[0]] = parts[1]
+        return entrez
+
+    @classmethod
+    def _gene_info_symbols(cls, gene_infos):
+        ''' Get an entrez:symbol dictionary from gene_info. '''
+        return {parts[1]: parts[2] for parts in (line.split('\t', 3) for line in gene_infos
+                                                 if line.startswith('9606\t'))}
+
+    @classmethod
+    def _open(cls, file_name):
+        opener = gzip.open if file_name.endswith('.gz') else open
+        return opener(file_name, 'rt')
+
+    @classmethod
+    def sources(cls, config, sections, base_dir):
+        ''' Get the (hook, file) of each gene section. For the Ensembl genes this is the
+        staged JSON and for the others the download. '''
+        sources = []
+        for section_name in sections:
+            section = config[section_name.strip()]
+            hook = section['stage'] if 'stage' in section else section.get('load')
+            file_name = section['output'] if 'output' in section else section['files'].strip()
+            if hook == 'ensembl_gene_parse':
+                file_name = os.path.join(base_dir, 'STAGE', section_name.strip(), file_name + '.json')
+            else:
+                file_name = os.path.join(base_dir, 'DOWNLOAD', section_name.strip(), file_name)
+            sources.append((hook, file_name))
+        return sources
+
+    @classmethod
+    def build_files(cls, sources):
+        ''' Build the map from the (hook, file) sources. '''
+        genes = None
+        entrez = {}
+        ensmart = {}
+        symbols = {}
+        for (hook, file_name) in sources:
+            with cls._open(file_name) as f:
+                if hook == 'ensembl_gene_parse':
+                    genes = {doc['_id']: doc.get('symbol') for doc in json.load(f)['docs']}
+                elif hook == 'gene2ensembl_parse':
+                    for ens_id, e in cls._gene2ensembl(f).items():
+                        entrez.setdefault(ens_id, e)
+                elif hook == 'ensmart_gene_parse':
+                    ensmart.update(cls._ensmart_entrez(f))
+                elif hook == 'gene_info_parse':
+                    symbols.update(cls._gene_info_symbols(f))
+                else:
+                    raise PipelineError('Gene id map source not recognised: ' + file_name)
+        if genes is None:
+            raise PipelineError('Gene id map needs the staged Ensembl genes')
+        # Ensembl Mart only fills in the genes without a gene2ensembl entrez id
+        for ens_id, e in ensmart.items():
+            if ens_id not in entrez and e is not None:
+                entrez[ens_id] = e
+        return cls.parse(genes, entrez=entrez, symbols=symbols)
+
+    @classmethod
+    def _checksum(cls, file_name):
+        md5 = hashlib.md5()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    def save(self, out_dir, meta):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for name, file_name in GeneIdMap.FILES.items():
+            np.save(os.path.join(out_dir, file_name), getattr(self, name))
+        with open(os.path.join(out_dir, GeneIdMap.META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, out_dir):
+        ''' Load the memory-mapped arrays. '''
+        if not os.path.exists(os.path.join(out_dir, GeneIdMap.META_FILE)):
+            raise PipelineError('Gene id map not found in ' + out_dir)
+        return cls(**{name: np.load(os.path.join(out_dir, file_name), mmap_mode='r')
+                      for name, file_name in GeneIdMap.FILES.items()})
+
+    @classmethod
+    def for_sections(cls, config, sections, base_dir):
+        ''' Load the map of the gene sections, building it if it is missing or a source
+        file has changed.
+        @type  sections: list
+        @param sections: Names of the gene sections.
+        @type  base_dir: str
+        @param base_dir: Pipeline directory (the map is saved in STAGE/GENE_ID_MAP).
+        @return: The map or None if the source files are not in the pipeline directory
+        (the gene index is then searched).
+        '''
+        sources = cls.sources(config, sections, base_dir)
+        missing = [file_name for (hook, file_name) in sources if not os.path.exists(file_name)]
+        if len(missing) > 0:
+            logger.warn('Gene id map sources do not exist, searching the gene index: ' + ', '.join(missing))
+            return None
+        meta = {"sources": [[hook, os.path.basename(file_name), cls._checksum(file_name)]
+                            for (hook, file_name) in sources]}
+        out_dir = os.path.join(base_dir, 'STAGE', GeneIdMap.MAP_DIR)
+        meta_file = os.path.join(out_dir, GeneIdMap.META_FILE)
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                if json.load(f) == meta:
+                    return cls.load(out_dir)
+        id_map = cls.build_files(sources)
+        id_map.save(out_dir, meta)
+        logger.debug("Saved gene id map of " + str(len(id_map)) + " genes to " + out_dir)
+        return cls.load(out_dir)
+
+    @classmethod
+    def _search(cls, keys, values):
+        pos = np.searchsorted(keys, values)
+        pos[pos == len(keys)] = 0
+        if len(keys) == 0:
+            return (pos, np.zeros(len(values), dtype=np.bool_))
+        return (pos, keys[pos] == values)
+
+    @classmethod
+    def _entrez_ints(cls, entrez_ids):
+        return np.array([int(e) if e.isdigit() else 0 for e in entrez_ids], dtype=np.uint32)
+
+    def _lookup(self, keys, offsets, values, query, query_keys):
+        ''' Get a query:[ensembl ids] dictionary for the query keys found. '''
+        (pos, found) = GeneIdMap._search(keys, query_keys)
+        ens_ids = {}
+        for q, p in zip(np.asarray(query, dtype=object)[found], pos[found]):
+            ens_ids[q] = self.ensembl[values[offsets[p]:offsets[p + 1]]].tolist()
+        return ens_ids
+
+    def entrez_ensembls(self, entrez_ids):
+        ''' Get an entrez:[ensembl ids] dictionary. '''
+        entrez_ids = list(set(entrez_ids))
+        return self._lookup(self.entrez, self.entrez_offsets, self.entrez_ens, entrez_ids,
+                            GeneIdMap._entrez_ints(entrez_ids))
+
+    def entrez_ensembl(self, entrez_ids):
+        ''' Get an entrez:ensembl id dictionary (the first ensembl id if there is more than one). '''
+        entrez_ids = list(set(entrez_ids))
+        entrez_ints = GeneIdMap._entrez_ints(entrez_ids)
+        (pos, found) = GeneIdMap._search(self.entrez, entrez_ints)
+        first = self.ensembl[self.entrez_ens[self.entrez_offsets[pos[found]]]]
+        return dict(zip(np.asarray(entrez_ids, dtype=object)[found].tolist(), first.tolist()))
+
+    def ensembl_entrez(self, ens_ids):
+        ''' Get an ensembl:entrez id dictionary of the ensembl ids with an entrez id. '''
+        ens_ids = list(set(ens_ids))
+        (pos, found) = GeneIdMap._search(self.ensembl, np.asarray(ens_ids, dtype=np.str_))
+        entrez = np.where(found, self.ens_entrez[pos], 0) if len(self.ensembl) > 0 else np.zeros(len(ens_ids))
+        found &= entrez != 0
+        return dict(zip(np.asarray(ens_ids, dtype=object)[found].tolist(), entrez[found].astype(str).tolist()))
+
+    def symbol_ensembls(self, symbols):
+        ''' Get a symbol:[ensembl ids] dictionary. '''
+        symbols = list(set(symbols))
+        return self._lookup(self.symbol, self.symbol_offsets, self.symbol_ens, symbols,
+                            np.asarray(symbols, dtype=np.str_))
@@ -6,6 +6,7 @@ from elastic.management.loaders.mapping import MappingProperties
 from elastic.management.loaders.loader import Loader
 import json
 from data_pipeline.helper.gene import Gene
+from data_pipeline.helper.bulk import BulkWriter
 
 logger = logging.getLogger(__name__)
 
@@ -16,7 +17,15 @@ class GenePathways(Gene):
 
     The pathway_genesets index type is currently built by parsing the following:
     1. Refer section [MSIGDB] in download.ini for source files
+
+    While staging, a gene keyed inverted index (gene_pathways.json) is also written so that
+    the pathways for a gene can be retrieved with a single get by ensembl id:
+    {"_id": "ENSG00000134242", "pathways": ["KEGG_...", "REACTOME_..."],
+     "sources": {"kegg": 1, "reactome": 1}, "count": 2}
     '''
+
+    GENE_PATHWAYS_FILE = 'gene_pathways.json'
+
     @classmethod
     def gene_pathway_parse(cls, download_files, stage_output_file, section, config=None):
         ''' Function to delegate parsing of gene pathway files based on the file formats eg: gmt - genematrix  '''
@@ -28,10 +37,13 @@ class GenePathways(Gene):
         abs_path_staging_dir = os.path.dirname(stage_output_file)
         source = None
         is_public = True if section['is_public'] == 1 else False
+        gene_pathways = {}
         for file in download_files:
             stage_output_file = abs_path_staging_dir + '/' + os.path.basename(file) + '.json'
             source = cls._get_pathway_source(file)
-            cls._process_pathway(file, stage_output_file, section, source, is_public, config)
+            cls._process_pathway(file, stage_output_file, section, source, is_public, config,
+                                 gene_pathways=gene_pathways)
+        cls._write_gene_pathways(gene_pathways, os.path.join(abs_path_staging_dir, cls.GENE_PATHWAYS_FILE))
 
     @classmethod
     def _get_pathway_source(cls, file):
@@ -50,7 +62,8 @@ class GenePathways(Gene):
         return(source)
 
     @classmethod
-    def _process_pathway(cls, download_file, stage_output_file, section, source, is_public, config=None):
+    def _process_pathway(cls, download_file, stage_output_file, section, source, is_public, config=None,
+                         gene_pathways=None):
         '''Function to parse the pathway input files eg: kegg, reactome, go
         INPUT file format:
         Pathway name \t Pathyway url \t List of entrez ids
@@ -59,6 +72,7 @@ class GenePathways(Gene):
         2068    2071    25885    284119    2965    2966    2967    2968    4331
 
         The entrez ids are converted to ensembl ids and logs are written to track the conversion rates (LESS/MORE/EQUAL)
+        If gene_pathways is given the converted gene sets are added to this gene keyed inverted index.
         '''
         json_target_file_path = stage_output_file.replace(".out", ".json")
         json_target_file = open(json_target_file_path, mode='w', encoding='utf-8')
@@ -94,6 +108,8 @@ class GenePathways(Gene):
                 path_object["gene_sets"] = converted_genesets
                 path_object["source"] = source
                 path_object["is_public"] = is_public
+                if gene_pathways is not None:
+                    cls._add_gene_pathways(gene_pathways, pathway_name, source, converted_genesets)
                 json_target_file.write(json.dumps(path_object))
                 count += 1
                 if row_count == count:
@@ -126,3 +142,70 @@ class GenePathways(Gene):
         options = {"indexName": idx, "shards": 1}
         status = load.mapping(pathway_mapping, idx_type, **options)
         return status
+
+    @classmethod
+    def _add_gene_pathways(cls, gene_pathways, pathway_name, source, ensembl_ids):
+        '''Add a pathway to the gene keyed inverted index for each of the genes in the set.'''
+        for ens_id in set(ensembl_ids):
+            if ens_id not in gene_pathways:
+                gene_pathways[ens_id] = {"pathways": [], "sources": {}, "count": 0}
+            gene_pathway = gene_pathways[ens_id]
+            gene_pathway["pathways"].append(pathway_name)
+            gene_pathway["sources"][source] = gene_pathway["sources"].get(source, 0) + 1
+            gene_pathway["count"] += 1
+
+    @classmethod
+    def _write_gene_pathways(cls, gene_pathways, json_target_file_path):
+        '''Write the gene keyed inverted index as a JSON file of docs that use the ensembl id as the _id'''
+        count = 0
+        with open(json_target_file_path, mode='w', encoding='utf-8') as json_target_file:
+            json_target_file.write('{"docs":[\n')
+            for ens_id in sorted(gene_pathways):
+                if count > 0:
+                    json_target_file.write(',\n')
+                doc = {"_id": ens_id}
+                doc.update(gene_pathways[ens_id])
+                json_target_file.write(json.dumps(doc))
+                count += 1
+            json_target_file.write('\n]}')
+        logger.debug("No. genes in gene pathway index " + str(count))
+        logger.debug("Json written to " + json_target_file_path)
+
+    @classmethod
+    def gene_pathway_index_load(cls, stage_dir, section):
+        '''Load the gene keyed inverted index. If gene_pathway_index_type is set in the section this is
+        loaded as its own index type. If gene_pathway_update_type is set the gene docs of that type are
+        updated with a pathways object.'''
+        json_file_path = os.path.join(stage_dir, cls.GENE_PATHWAYS_FILE)
+        if not os.path.exists(json_file_path):
+            logger.error('File does not exist: ' + json_file_path)
+            return
+
+        idx = section['index']
+        with open(json_file_path, encoding='utf-8') as json_file:
+            docs = json.load(json_file)['docs']
+        if 'gene_pathway_index_type' in section:
+            idx_type = section['gene_pathway_index_type']
+            cls._load_gene_pathway_mappings(idx, idx_type)
+            writer = BulkWriter(idx, idx_type)
+            for doc in docs:
+                writer.index(doc, doc_id=doc.pop('_id'))
+            writer.close()
+        elif 'gene_pathway_update_type' in section:
+            idx_type = section['gene_pathway_update_type']
+            writer = BulkWriter(idx, idx_type)
+            for doc in docs:
+                ens_id = doc.pop('_id')
+                writer.update(ens_id, {'pathways': doc})
+            writer.close()
+
+    @classmethod
+    def _load_gene_pathway_mappings(cls, idx, idx_type):
+        '''Load the elastic mappings for the gene keyed pathway index type'''
+        gene_pathway_mapping = MappingProperties(idx_type)
+        gene_pathway_mapping.add_property("pathways", "string", index="not_analyzed")
+        gene_pathway_mapping.add_property("sources", "object")
+        gene_pathway_mapping.add_property("count", "integer")
+        load = Loader()
+        options = {"indexName": idx, "shards": 1}
+        return load.mapping(gene_pathway_mapping, idx_type, **options)
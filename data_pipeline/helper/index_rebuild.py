@@ -0,0 +1,230 @@
+''' Used to rebuild an index as a new version behind an alias. '''
+
+import logging
+import re
+import time
+from elastic.management.loaders.loader import Loader
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.exceptions import PipelineError
+from data_pipeline.helper.lookup_cache import LookupCache
+
+logger = logging.getLogger(__name__)
+
+
+class IndexRebuild(object):
+    ''' Load a group of sections into a new versioned index (<alias>_<YYYYmmddHHMMSS>)
+    and swap the alias (the index name of the sections) over to it once they are all
+    loaded. The alias is moved for the whole index so the group has to include every
+    section loading the index (see L{members}).
+
+    While loading, an index template gives the new index no replicas and disables
+    refresh however it is created (e.g. by the elastic index_search command). The
+    index is refreshed after each section so that the later sections can look up the
+    documents of the earlier ones. When the load finishes the index is force merged
+    and given back its replicas and refresh interval. The alias is then moved from
+    the previous version to the new one in a single _aliases request. The previous
+    versions (keep_versions) are kept for L{rollback} and older ones deleted. If the
+    load fails the new index is deleted and the alias left as it was.
+
+    This is set with a section of the ini file (see
+    L{data_pipeline.load.IndexLoad.rebuild}) with the options:
+
+    rebuild       - sections to load in order (a parent section, e.g. DISEASE, for
+                    all of its DISEASE:: sections)
+    index         - the alias
+    shards        - number of shards of the new index
+    replicas      - number of replicas restored after the load (default 1)
+    refresh       - refresh interval restored after the load (default 1s)
+    keep_versions - number of previous versions kept (default 1)
+    '''
+
+    LOAD_SETTINGS = {"number_of_replicas": 0, "refresh_interval": "-1"}
+    VERSION_FORMAT = '%Y%m%d%H%M%S'
+
+    active = None
+
+    def __init__(self, section, sections):
+        '''
+        @type  section: SectionProxy
+        @param section: Section with the rebuild options.
+        @type  sections: list
+        @param sections: Sections (SectionProxy) loaded into the new index.
+        '''
+        self.section = section
+        self.sections = sections
+        self.alias = section['index']
+        self.shards = int(section['shards']) if 'shards' in section else 5
+        self.replicas = int(section['replicas']) if 'replicas' in section else 1
+        self.refresh = section['refresh'] if 'refresh' in section else '1s'
+        self.keep_versions = int(section['keep_versions']) if 'keep_versions' in section else 1
+        self.idx = None
+        self.raw_index = {}
+        self.finished = []
+
+    @classmethod
+    def is_rebuild(cls, section):
+        ''' Check if a section defines a rebuild. '''
+        return 'rebuild' in section
+
+    @classmethod
+    def members(cls, config, section_name):
+        ''' Get the names of the sections to load in a rebuild (the parent sections
+        inherited, see L{data_pipeline.utils.IniParser._inherit_section}). Raises a
+        L{PipelineError} if another section loads the index, other than those joined by
+        a member (listed in its sections option, e.g. GENE_ASSEMBLY) or those joining
+        members (e.g. DISEASE_BATCH). '''
+        alias = config[section_name]['index']
+        names = config.sections()
+        members = []
+        for name in [n.strip() for n in config[section_name]['rebuild'].split(',')]:
+            children = [n for n in names if n.startswith(name + '::')]
+            if len(children) == 0 and name not in config:
+                raise PipelineError('Rebuild section ' + name + ' not found')
+            members.extend(children if len(children) > 0 else [name])
+
+        def joins(name):
+            return [n.strip() for n in config[name]['sections'].split(',')] if 'sections' in config[name] else []
+
+        loaded = set(members) | set(n.split('::', maxsplit=1)[0] for n in members)
+        joined = loaded | set(n for name in members for n in joins(name))
+        parents = set(n.split('::', maxsplit=1)[0] for n in names if '::' in n)
+        missing = [n for n in names if n not in parents and n not in joined and
+                   n.split('::', maxsplit=1)[0] not in joined and not cls.is_rebuild(config[n]) and
+                   config[n].get('index') == alias and
+                   # e.g. DISEASE_BATCH joining the loaded DISEASE sections
+                   (len(joins(n)) == 0 or not set(joins(n)) <= loaded)]
+        if len(missing) > 0:
+            raise PipelineError('Sections also loading ' + alias + ' are not in the rebuild: ' + ', '.join(missing))
+        return members
+
+    def __enter__(self):
+        client = ElasticClient.get()
+        if len(IndexRebuild.aliased(self.alias)) == 0 and client.index_exists(self.alias):
+            raise PipelineError('Index ' + self.alias + ' exists so cannot be used as an alias (reindex it ' +
+                                'into a versioned index first)')
+        idx = IndexRebuild.version_name(self.alias)
+        if client.index_exists(idx):
+            raise PipelineError('Index ' + idx + ' already exists')
+        self.idx = idx
+        # applies the load settings to the new index however it is created
+        client.json('PUT', '/_template/' + self._template_name(),
+                    data={"template": self.idx, "order": 100,
+                          "settings": {"index": dict(IndexRebuild.LOAD_SETTINGS, number_of_shards=self.shards)}})
+        # the index of the sections is the new index while loading
+        for section in self.sections:
+            self.raw_index[section.name] = section.parser.get(section.name, 'index', raw=True)
+            section['index'] = self.idx
+        IndexRebuild.active = self
+        logger.debug("Rebuilding " + self.alias + " in " + self.idx)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            ElasticClient.get().request('DELETE', '/_template/' + self._template_name())
+            if exc_type is None:
+                self.finish()
+            elif self.idx is not None:
+                logger.warn("Rebuild of " + self.alias + " failed, deleting " + self.idx)
+                ElasticClient.get().request('DELETE', ElasticClient.path(self.idx))
+        finally:
+            for name, raw_index in self.raw_index.items():
+                self.section.parser.set(name, 'index', raw_index)
+            if IndexRebuild.active is self:
+                IndexRebuild.active = None
+
+    def _template_name(self):
+        return self.alias + '_rebuild'
+
+    def section_loaded(self):
+        ''' Refresh the new index so that the documents of a loaded section can be searched. '''
+        if ElasticClient.get().index_exists(self.idx):
+            ElasticClient.get().refresh(self.idx)
+
+    @classmethod
+    def version_name(cls, alias, now=None):
+        return alias + '_' + time.strftime(IndexRebuild.VERSION_FORMAT, now if now is not None else time.localtime())
+
+    @classmethod
+    def versions(cls, alias, indices):
+        ''' Get the (sorted, oldest first) versions of an alias in a list of index names. '''
+        pattern = re.compile(re.escape(alias) + r'_\d{14}$')
+        return sorted(idx for idx in indices if pattern.match(idx))
+
+    @classmethod
+    def to_delete(cls, versions, current, keep_versions):
+        ''' Get the versions to delete keeping the current version and the keep_versions
+        before it (versions after it, e.g. after a rollback, are kept). '''
+        older = [v for v in versions if v < current]
+        return older[:max(len(older) - keep_versions, 0)]
+
+    @classmethod
+    def aliased(cls, alias):
+        ''' Get the indices the alias points to. '''
+        resp = ElasticClient.get().request('GET', '/_alias/' + alias)
+        if resp.status_code == 404:
+            return []
+        if resp.status_code != 200:
+            raise PipelineError('Get alias failed: ' + alias + ' ' + resp.text[:500])
+        return sorted(idx for idx, v in resp.json().items() if alias in v.get('aliases', {}))
+
+    @classmethod
+    def _indices(cls, alias):
+        return list(ElasticClient.get().json('GET', ElasticClient.path(alias + '_*', endpoint='_aliases')).keys())
+
+    @classmethod
+    def swap(cls, alias, idx):
+        ''' Point the alias at an index (removing it from others) in one request. '''
+        actions = [{"remove": {"index": old, "alias": alias}} for old in cls.aliased(alias) if old != idx]
+        actions.append({"add": {"index": idx, "alias": alias}})
+        ElasticClient.get().json('POST', '/_aliases', data={"actions": actions})
+        LookupCache.reset()
+        logger.debug("Alias " + alias + " -> " + idx)
+
+    def finish(self, merge_timeout=3600):
+        ''' Optimise the loaded index, restore its settings and swap the alias to it. '''
+        client = ElasticClient.get()
+        if not client.index_exists(self.idx):
+            raise PipelineError('Rebuild did not create ' + self.idx)
+        client.refresh(self.idx)
+        client.json('POST', ElasticClient.path(self.idx, endpoint='_forcemerge'),
+                    params={"max_num_segments": 1}, timeout=merge_timeout)
+        client.json('PUT', ElasticClient.path(self.idx, endpoint='_settings'),
+                    data={"index": {"number_of_replicas": self.replicas, "refresh_interval": self.refresh}})
+        client.json('GET', '/_cluster/health/' + self.idx, params={"wait_for_status": "yellow", "timeout": "10m"},
+                    timeout=660)
+        IndexRebuild.swap(self.alias, self.idx)
+
+        versions = IndexRebuild.versions(self.alias, IndexRebuild._indices(self.alias))
+        for old in IndexRebuild.to_delete(versions, self.idx, self.keep_versions):
+            logger.debug("Deleting old version " + old)
+            client.json('DELETE', ElasticClient.path(old))
+
+    @classmethod
+    def rollback(cls, alias):
+        ''' Swap the alias back to the version before the one it points to. '''
+        current = cls.aliased(alias)
+        versions = cls.versions(alias, cls._indices(alias))
+        previous = [v for v in versions if len(current) == 0 or v < min(current)]
+        if len(previous) == 0:
+            raise PipelineError('No previous version of ' + alias + ' to roll back to')
+        cls.swap(alias, previous[-1])
+        return previous[-1]
+
+    @classmethod
+    def create(cls, idx):
+        ''' Create an index (the index template sets the shards and load settings if it
+        is being rebuilt). '''
+        ElasticClient.get().json('PUT', ElasticClient.path(idx))
+
+    @classmethod
+    def mapping(cls, props, idx_type, idx, shards=5):
+        ''' Create an index and add a mapping with the elastic Loader (which defines the
+        analyzers), using the shards of the rebuild if the index is being rebuilt. '''
+        rebuild = cls.active
+        if rebuild is not None and rebuild.idx == idx:
+            shards = rebuild.shards
+        Loader().mapping(props, idx_type, analyzer=Loader.KEYWORD_ANALYZER, indexName=idx, shards=shards)
+        if rebuild is not None and rebuild.idx == idx:
+            # in case the Loader set the replicas or refresh interval
+            ElasticClient.get().json('PUT', ElasticClient.path(idx, endpoint='_settings'),
+                                     data={"index": IndexRebuild.LOAD_SETTINGS})
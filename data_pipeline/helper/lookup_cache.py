@@ -0,0 +1,163 @@
+''' Used to cache the elastic lookups repeated within a pipeline run. '''
+
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+
+class LookupCache(object):
+    ''' Memoize read-only lookups for a run of the pipeline (e.g. the gene history and
+    entrez to ensembl conversions repeated for each pathway file).
+
+    Entries are kept in least recently used order and evicted once their (JSON)
+    size passes a memory cap. Terms lookups are cached for each value, keyed by
+    index, type, field and sources, so a later lookup only searches for the values
+    not seen before:
+
+    hits = LookupCache.get().terms(idx, "dbxrefs.entrez", entrez_ids, sources=['dbxrefs.entrez'])
+
+    The cached hits are shared so must not be modified. A write to an index
+    invalidates the entries for it (see L{invalidate}). Entries are kept for the
+    concrete indices of a name so that writes to an index invalidate the lookups
+    made through its alias and the reverse.
+    The memory cap is LOOKUP_CACHE_BYTES in the django settings.
+    '''
+
+    _cache = None
+    _lock = threading.Lock()
+
+    def __init__(self, max_bytes=128*1024*1024):
+        '''
+        @type  max_bytes: int
+        @keyword max_bytes: Memory cap (the size of the cached hits as JSON).
+        '''
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.indices = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls):
+        ''' Get the cache for this run (created on first use). '''
+        with cls._lock:
+            if cls._cache is None:
+                cls._cache = cls(max_bytes=getattr(settings, 'LOOKUP_CACHE_BYTES', 128*1024*1024))
+            return cls._cache
+
+    @classmethod
+    def close(cls):
+        ''' Drop the cache for this run. '''
+        with cls._lock:
+            if cls._cache is not None:
+                logger.debug("Lookup cache: " + str(cls._cache.stats))
+                cls._cache = None
+
+    @classmethod
+    def invalidate(cls, idx):
+        ''' Invalidate the entries for an index or alias (they are left to be evicted).
+        This is called for each bulk request and for the loads made with the elastic
+        commands (e.g. index_search). '''
+        cache = cls._cache
+        if cache is not None:
+            names = cache._concrete(idx)
+            with cache.lock:
+                for name in names:
+                    cache.generations[name] = cache.generations.get(name, 0) + 1
+
+    @classmethod
+    def reset(cls):
+        ''' Invalidate all the entries and the resolved aliases (e.g. when an alias is moved). '''
+        cache = cls._cache
+        if cache is not None:
+            with cache.lock:
+                cache.entries.clear()
+                cache.indices.clear()
+                cache.stats["bytes"] = 0
+
+    def _concrete(self, idx):
+        ''' Get the concrete indices of an index or alias (resolved once). '''
+        names = self.indices.get(idx)
+        if names is None:
+            resp = ElasticClient.get().request('GET', ElasticClient.path(idx, endpoint='_settings'))
+            names = tuple(sorted(resp.json().keys())) if resp.status_code == 200 else (idx,)
+            with self.lock:
+                self.indices[idx] = names
+        return names
+
+    def _key(self, idx, *parts):
+        names = self._concrete(idx)
+        return (idx, tuple(self.generations.get(name, 0) for name in names)) + parts
+
+    def _get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self.entries[key][0]
+            self.stats["misses"] += 1
+            return None
+
+    def _put(self, key, value):
+        size = len(json.dumps(value))
+        with self.lock:
+            if key in self.entries:
+                self.stats["bytes"] -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.stats["bytes"] += size
+            while self.stats["bytes"] > self.max_bytes and len(self.entries) > 0:
+                (_key, (_value, evicted_size)) = self.entries.popitem(last=False)
+                self.stats["bytes"] -= evicted_size
+                self.stats["evictions"] += 1
+
+    @classmethod
+    def _fingerprint(cls, obj):
+        return hashlib.md5(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def _field_values(cls, source, field):
+        ''' Get the values of a (dotted) field in a document source. '''
+        value = source
+        for name in field.split('.'):
+            if not isinstance(value, dict) or name not in value:
+                return []
+            value = value[name]
+        return value if isinstance(value, list) else [value]
+
+    def terms(self, idx, field, values, idx_type=None, sources=None):
+        ''' Get the hits for documents with a field matching any of the values (see
+        L{ElasticClient.terms}). The hits for values already looked up are taken from
+        the cache and only the others are searched.
+        @type  sources: list
+        @keyword sources: _source fields to return (these must include the field).
+        '''
+        if sources is not None and (sources is False or field not in sources):
+            raise PipelineError('Cached terms lookups need the field in the sources: ' + field)
+        fingerprint = LookupCache._fingerprint(sources)
+        hits = {}
+        missing = []
+        for value in set(str(v) for v in values):
+            cached = self._get(self._key(idx, idx_type, 'terms', field, fingerprint, value))
+            if cached is None:
+                missing.append(value)
+            else:
+                hits.update((hit['_index'] + '/' + hit['_type'] + '/' + hit['_id'], hit) for hit in cached)
+
+        if len(missing) > 0:
+            value_hits = {value: [] for value in missing}
+            for hit in ElasticClient.get().terms(idx, field, missing, idx_type=idx_type, sources=sources):
+                hits[hit['_index'] + '/' + hit['_type'] + '/' + hit['_id']] = hit
+                for value in LookupCache._field_values(hit.get('_source', {}), field):
+                    if str(value) in value_hits:
+                        value_hits[str(value)].append(hit)
+            for value, v_hits in value_hits.items():
+                self._put(self._key(idx, idx_type, 'terms', field, fingerprint, value), v_hits)
+        return list(hits.values())
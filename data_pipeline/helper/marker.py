@@ -1,8 +1,9 @@
 from elastic.management.loaders.mapping import MappingProperties
-from elastic.management.loaders.loader import Loader, JSONLoader
-from elastic.query import TermsFilter, Query
-from elastic.search import ElasticQuery, Search
+from elastic.management.loaders.loader import Loader
 from elastic.elastic_settings import ElasticSettings
+from data_pipeline.helper.stages import StagedPipeline
+from data_pipeline.helper.bulk import BulkWriter
+from data_pipeline.helper.lookup_cache import LookupCache
 import logging
 
 logger = logging.getLogger(__name__)
@@ -43,119 +44,143 @@ class ImmunoChip(object):
         return props
 
     @classmethod
-    def immunochip_mysql_2_idx(cls, ic_f, idx_name, idx_type):
-        ''' Parse and load data for immunochip markers. '''
+    def immunochip_mysql_2_idx(cls, ic_f, idx_name, idx_type, resolver=None, chunk_size=450, maxsize=4):
+        ''' Parse and load data for immunochip markers. Parsing, checking the rs id's
+        (L{check_rs_ids}) and loading run as overlapping stages (L{StagedPipeline}) on
+        batches of chunk_size docs. '''
+        def resolve(docs):
+            cls.check_rs_ids([doc['id'] for doc in docs if 'id' in doc], docs, resolver=resolver)
+            return docs
+
+        def load(docs):
+            writer = BulkWriter(idx_name, idx_type)
+            for doc in docs:
+                writer.index(doc)
+            writer.close()
+            return docs
+
+        stages = StagedPipeline([('resolve', resolve), ('load', load)], maxsize=maxsize)
+        return stages.run(cls._ic_batches(ic_f, chunk_size))
+
+    @classmethod
+    def _ic_batches(cls, ic_f, chunk_size):
+        ''' Generator of batches of chunk_size immunochip marker docs. '''
         new_docs = []
-        chunk_size = 450
-        count = 0
-        current_marker_ids = []
         for ic in ic_f:
             parts = ic.strip().split('\t')
             if parts[0] == 'ilmn_id':
                 continue
-
-            doc = {}
-            doc['allele_a'] = parts[1]
-            doc['allele_b'] = parts[2]
-
-            syns = set()
-            syns.add(parts[0])
-            current_marker_id = ''
-            for m_id in parts[3:8]:
-                if m_id != '\\N' and m_id != 'AMBIG':
-                    current_marker_id = m_id
-                    syns.add(m_id)
-                else:
-                    current_marker_id = ''
-            if current_marker_id in syns:
-                syns.remove(current_marker_id)
-
-            suggests = []
-            if len(syns) > 0:
-                doc['synonyms'] = list(syns)
-                suggests.extend(list(syns))
-            if current_marker_id != '':
-                doc['id'] = current_marker_id
-                current_marker_ids.append(current_marker_id)
-            doc['build_info'] = [{'build': '36', 'position': parts[8], 'seqid': parts[9]},
-                                 {'build': '37', 'position': parts[10], 'seqid': parts[11]},
-                                 {'build': '38', 'position': parts[12], 'seqid': parts[13]}]
-            if parts[14] != '\\N':
-                doc['is_par'] = parts[14]  # pseudoautosomal
-
-            if parts[18] != '\\N':         # use marker_mart_141 if present
-                doc['internal_id'] = int(parts[18])
-            else:
-                doc['internal_id'] = int(parts[15])
-            doc['name'] = parts[16]
-            if parts[17] != '\\N':
-                doc['strand'] = parts[17]
-            suggests.append(doc['name'])
-
-            doc['suggest'] = {}
-            doc['suggest']["input"] = suggests
-            new_docs.append(doc)
-
-            if count > chunk_size:
-                # check id's are current dbsnp rs id's
-                cls.check_rs_ids(current_marker_ids, new_docs)
-                JSONLoader().load(new_docs, idx_name, idx_type)
-
+            new_docs.append(cls._ic_doc(parts))
+            if len(new_docs) == chunk_size:
+                yield new_docs
                 new_docs = []
-                current_marker_ids = []
-                count = 0
-            count += 1
         if len(new_docs) > 0:
-            JSONLoader().load(new_docs, idx_name, idx_type)
+            yield new_docs
+
+    @classmethod
+    def _ic_doc(cls, parts):
+        ''' Get the marker doc for an immunochip row. '''
+        doc = {}
+        doc['allele_a'] = parts[1]
+        doc['allele_b'] = parts[2]
+
+        syns = set()
+        syns.add(parts[0])
+        current_marker_id = ''
+        for m_id in parts[3:8]:
+            if m_id != '\\N' and m_id != 'AMBIG':
+                current_marker_id = m_id
+                syns.add(m_id)
+            else:
+                current_marker_id = ''
+        if current_marker_id in syns:
+            syns.remove(current_marker_id)
+
+        suggests = []
+        if len(syns) > 0:
+            doc['synonyms'] = list(syns)
+            suggests.extend(list(syns))
+        if current_marker_id != '':
+            doc['id'] = current_marker_id
+        doc['build_info'] = [{'build': '36', 'position': parts[8], 'seqid': parts[9]},
+                             {'build': '37', 'position': parts[10], 'seqid': parts[11]},
+                             {'build': '38', 'position': parts[12], 'seqid': parts[13]}]
+        if parts[14] != '\\N':
+            doc['is_par'] = parts[14]  # pseudoautosomal
+
+        if parts[18] != '\\N':         # use marker_mart_141 if present
+            doc['internal_id'] = int(parts[18])
+        else:
+            doc['internal_id'] = int(parts[15])
+        doc['name'] = parts[16]
+        if parts[17] != '\\N':
+            doc['strand'] = parts[17]
+        suggests.append(doc['name'])
+
+        doc['suggest'] = {}
+        doc['suggest']["input"] = suggests
+        return doc
 
     @classmethod
-    def check_rs_ids(cls, current_marker_ids, new_docs):
+    def check_rs_ids(cls, current_marker_ids, new_docs, resolver=None):
         ''' Check id's in immunochip docs are current in dbsnp. If not then
-        move the id to the synonym fields. '''
-        terms_filter = TermsFilter.get_terms_filter("id", current_marker_ids)
-        query = ElasticQuery.filtered(Query.match_all(), terms_filter, sources='id')
-        elastic = Search(query, idx=ElasticSettings.idx('MARKER', idx_type='MARKER'), size=len(current_marker_ids))
-        marker_docs = elastic.search().docs
-
-        not_current_marker_ids = []
-        for m_id in current_marker_ids:
-            if not cls._contains_id(marker_docs, m_id):
-                not_current_marker_ids.append(m_id)
-        if len(not_current_marker_ids) == 0:
-            return
+        move the id to the synonym fields. If a L{RsMergeResolver} is given merged
+        id's are resolved locally rather than by searching the marker indices. '''
+        if resolver is not None:
+            rshistory = cls._resolve_rs_ids(current_marker_ids, resolver)
+            not_current_marker_ids = list(rshistory.keys())
+        else:
+            hits = LookupCache.get().terms(ElasticSettings.idx('MARKER', idx_type='MARKER'), "id",
+                                           current_marker_ids, sources=['id'])
+            marker_ids = set(hit['_source']['id'] for hit in hits)
+            not_current_marker_ids = [m_id for m_id in current_marker_ids if m_id not in marker_ids]
+            if len(not_current_marker_ids) == 0:
+                return
+            rshistory = cls._search_rs_history(not_current_marker_ids)
+
+        docs_by_id = {}
+        for n_doc in new_docs:
+            if 'id' in n_doc:
+                docs_by_id.setdefault(n_doc['id'], []).append(n_doc)
+
+        for m_id in not_current_marker_ids:
+            # no longer a current marker id so move to synonym
+            for n_doc in docs_by_id.get(m_id, []):
+                logger.debug("Marker no longer current: "+m_id)
+                if rshistory.get(m_id) is not None:
+                    n_doc['id'] = rshistory[m_id]
+                    n_doc['internal_id'] = int(rshistory[m_id].replace('rs', ''))
+                else:
+                    del n_doc['id']
+                synonyms = n_doc.setdefault('synonyms', [])
+                if m_id not in synonyms:
+                    synonyms.append(m_id)
 
+    @classmethod
+    def _search_rs_history(cls, not_current_marker_ids):
         ''' check rshigh if the marker id has merged, see docs:
         www.ncbi.nlm.nih.gov/projects/SNP/snp_db_table_description.cgi?t=RsMergeArch
         '''
-        terms_filter = TermsFilter.get_terms_filter("rshigh", not_current_marker_ids)
-        query = ElasticQuery.filtered(Query.match_all(), terms_filter, sources=['rscurrent', 'rshigh', "build_id"])
-        elastic = Search(query, idx=ElasticSettings.idx('MARKER', idx_type='HISTORY'), size=len(current_marker_ids))
-        history_docs = elastic.search().docs
+        hits = LookupCache.get().terms(ElasticSettings.idx('MARKER', idx_type='HISTORY'), "rshigh",
+                                       not_current_marker_ids, sources=['rscurrent', 'rshigh', "build_id"])
         rshistory = {}
-        for h_doc in history_docs:
-            if getattr(h_doc, 'build_id') < 142:
-                logger.error("MARKER MERGE BUILD < 142: " + getattr(h_doc, 'rshigh') + ' build: ' +
-                             str(getattr(h_doc, 'build_id')))
-            if getattr(h_doc, 'rscurrent') != 'rs':
-                rshistory[getattr(h_doc, 'rshigh')] = getattr(h_doc, 'rscurrent')
-
-        for m_id in not_current_marker_ids:
-            # no longer a current marker id so move to synonym
-            for n_doc in new_docs:
-                if 'id' in n_doc and n_doc['id'] == m_id:
-                    logger.debug("Marker no longer current: "+m_id)
-                    if m_id in rshistory:
-                        n_doc['id'] = rshistory[m_id]
-                        n_doc['internal_id'] = int(rshistory[m_id].replace('rs', ''))
-                    else:
-                        del n_doc['id']
-                    if m_id not in n_doc['synonyms']:
-                        n_doc['synonyms'] = m_id
+        for hit in hits:
+            h_doc = hit['_source']
+            if h_doc['build_id'] < 142:
+                logger.error("MARKER MERGE BUILD < 142: " + h_doc['rshigh'] + ' build: ' + str(h_doc['build_id']))
+            if h_doc['rscurrent'] != 'rs':
+                rshistory[h_doc['rshigh']] = h_doc['rscurrent']
+        return rshistory
 
     @classmethod
-    def _contains_id(cls, docs, mid):
-        ''' Check for id in the elasticsearch docs. '''
-        for doc in docs:
-            if getattr(doc, 'id') == mid:
-                return True
-        return False
+    def _resolve_rs_ids(cls, marker_ids, resolver):
+        ''' Get a dictionary of the merged rs id's and their current rs id (None if
+        merged without a current id) using a L{RsMergeResolver}. '''
+        rs_ids = [m_id for m_id in set(marker_ids) if m_id.startswith('rs') and m_id[2:].isdigit()]
+        (current, merged, build) = resolver.resolve(rs_ids)
+        rshistory = {}
+        for i in merged.nonzero()[0]:
+            if build[i] < 142:
+                logger.error("MARKER MERGE BUILD < 142: " + rs_ids[i] + ' build: ' + str(build[i]))
+            rshistory[rs_ids[i]] = 'rs' + str(current[i]) if current[i] != 0 else None
+        return rshistory
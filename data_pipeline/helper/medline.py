@@ -0,0 +1,170 @@
+''' Used to build publication documents from the MEDLINE/PubMed baseline and update files. '''
+
+import gzip
+import json
+import logging
+import os
+import re
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+from data_pipeline.helper.pubs import Pubs
+
+logger = logging.getLogger(__name__)
+
+# PMIDs to keep when parsing in worker processes (set by L{_init_worker})
+_PMIDS = None
+
+
+def _init_worker(pmids):
+    global _PMIDS
+    _PMIDS = pmids
+
+
+def _parse_worker(file_name):
+    return Medline.parse_file(file_name, _PMIDS)
+
+
+class Medline(object):
+    ''' Parse the MEDLINE baseline and daily update XML files from
+    ftp://ftp.ncbi.nlm.nih.gov/pubmed/ as an alternative to fetching each PMID from
+    eutils (L{Pubs.fetch_details}).
+
+    Files are parsed in parallel, one file per process, and the records filtered to a set
+    of PMIDs (e.g. those in gene2pubmed). Results are applied in file order (baseline then
+    update files) so that later revisions of a citation replace earlier ones and
+    DeleteCitation entries remove them. The names of the files staged are recorded as
+    processed once they have been loaded (L{record_processed}) so that later runs only
+    parse the new daily update files.
+    '''
+
+    DIRS = ['baseline', 'updatefiles']
+    FILE_PATTERN = re.compile(r'.*\.xml(\.gz)?$')
+    PROCESSED_FILE = 'processed_files.txt'
+    STAGED_FILE = 'staged_files.txt'
+    DELETED_FILE = 'deleted_pmids.txt'
+
+    @classmethod
+    def list_files(cls, download_dir):
+        ''' List the baseline files followed by the update files in order. '''
+        files = []
+        for sub_dir in Medline.DIRS:
+            dir_path = os.path.join(download_dir, sub_dir)
+            if not os.path.isdir(dir_path):
+                continue
+            files.extend(os.path.join(dir_path, f) for f in sorted(os.listdir(dir_path))
+                         if Medline.FILE_PATTERN.match(f))
+        return files
+
+    @classmethod
+    def parse_file(cls, file_name, pmids=None):
+        ''' Parse a MEDLINE XML file.
+        @type  file_name: str
+        @param file_name: MEDLINE XML file (optionally gzipped).
+        @type  pmids: set
+        @keyword pmids: Only return records for these PMIDs.
+        @return: (file_name, list of publication objects, list of deleted PMIDs)
+        '''
+        pub_objs = []
+        deleted = []
+        opener = gzip.open if file_name.endswith('.gz') else open
+        with opener(file_name, 'rb') as f:
+            depth = 0
+            root = None
+            for event, elem in ET.iterparse(f, events=('start', 'end')):
+                if event == 'start':
+                    if root is None:
+                        root = elem
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth != 1:
+                    continue
+
+                if elem.tag in Pubs.ARTICLE_TAGS or elem.tag == 'MedlineCitation':
+                    pmid = elem.findtext('PMID') or elem.findtext('*/PMID')
+                    if pmids is None or pmid in pmids:
+                        if elem.tag == 'MedlineCitation':
+                            pub_objs.append(Pubs._parse_pubmed_record(elem))
+                        else:
+                            pub_objs.append(Pubs._parse_pubmed_article(elem))
+                elif elem.tag == 'DeleteCitation':
+                    deleted.extend(p.text for p in elem.iter('PMID')
+                                   if pmids is None or p.text in pmids)
+                root.clear()
+        return (file_name, pub_objs, deleted)
+
+    @classmethod
+    def parse(cls, download_dir, stage_file, pmids=None, processes=4, source='auto'):
+        ''' Parse the MEDLINE files that have not already been processed and write the
+        publication documents to the stage file (see L{Pubs.fetch_details} for the format).
+        The PMIDs deleted by the update files are written to deleted_pmids.txt and the
+        names of the files parsed to staged_files.txt.
+        '''
+        stage_dir = os.path.dirname(stage_file)
+        processed_file = os.path.join(stage_dir, Medline.PROCESSED_FILE)
+        processed = set()
+        if os.path.exists(processed_file):
+            with open(processed_file) as f:
+                processed = set(line.strip() for line in f)
+
+        files = [f for f in cls.list_files(download_dir) if os.path.basename(f) not in processed]
+        logger.debug("No. of MEDLINE files to parse "+str(len(files)))
+
+        docs = {}
+        deleted = set()
+        pool = Pool(processes=processes, initializer=_init_worker, initargs=(pmids,))
+        try:
+            for (file_name, pub_objs, deleted_pmids) in pool.imap(_parse_worker, files):
+                for pub_obj in pub_objs:
+                    docs[pub_obj['pmid']] = pub_obj
+                    deleted.discard(pub_obj['pmid'])
+                for pmid in deleted_pmids:
+                    docs.pop(pmid, None)
+                    deleted.add(pmid)
+                logger.debug(os.path.basename(file_name)+" :: "+str(len(pub_objs))+" records, " +
+                             str(len(deleted_pmids))+" deleted")
+        finally:
+            pool.close()
+            pool.join()
+
+        with open(stage_file, mode='w', encoding='utf-8') as f:
+            f.write('{"mapping": ')
+            f.write(json.dumps({"properties": Pubs.MAPPING}))
+            f.write(',\n"docs":[\n')
+            count = 0
+            for pmid in sorted(docs, key=int):
+                pub_obj = docs[pmid]
+                if source is not None:
+                    pub_obj['tags'] = {'source': source}
+                if count > 0:
+                    f.write(',\n')
+                f.write(json.dumps(pub_obj))
+                count += 1
+            f.write('\n]}')
+
+        with open(os.path.join(stage_dir, Medline.DELETED_FILE), 'w') as f:
+            for pmid in sorted(deleted, key=int):
+                f.write(pmid + '\n')
+
+        with open(os.path.join(stage_dir, Medline.STAGED_FILE), 'w') as f:
+            for file_name in files:
+                f.write(os.path.basename(file_name) + '\n')
+        logger.debug("No. publications staged "+str(count)+" deleted "+str(len(deleted)))
+        return (count, len(deleted))
+
+    @classmethod
+    def record_processed(cls, stage_dir):
+        ''' Add the files staged by the last L{parse} to the processed files. This is
+        called once the staged publications have been loaded and the deleted ones
+        removed, so that files are parsed again if either fails. '''
+        staged_file = os.path.join(stage_dir, Medline.STAGED_FILE)
+        if not os.path.exists(staged_file):
+            return 0
+        with open(staged_file) as f:
+            files = [line.strip() for line in f if line.strip() != '']
+        with open(os.path.join(stage_dir, Medline.PROCESSED_FILE), 'a') as f:
+            for file_name in files:
+                f.write(file_name + '\n')
+        os.remove(staged_file)
+        logger.debug("No. MEDLINE files processed "+str(len(files)))
+        return len(files)
@@ -0,0 +1,149 @@
+''' Used to find the PMIDs that are already in the publications index. '''
+
+import json
+import logging
+import os
+import numpy as np
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.scroll import Scroll
+
+logger = logging.getLogger(__name__)
+
+
+class PmidIndex(object):
+    ''' Sorted array of the PMIDs (document ids) in a publications index. It is
+    built once per run from a scroll of the document ids and saved between runs:
+
+    <cache_dir>/<index>.pmids.npy   - sorted uint32 PMIDs
+    <cache_dir>/<index>.pmids.json  - state of the index when saved (L{state})
+
+    The saved array is used while the index has the same documents count and
+    uuids and rebuilt otherwise. Within a run one array is kept for each index
+    and the PMIDs loaded into the index are merged into it (see L{loaded}).
+    Membership of a list of PMIDs is a vectorized search of the sorted array.
+    '''
+
+    # PMID index for each index loaded in this process
+    _indices = {}
+
+    def __init__(self, pmids, idx=None, cache_dir=None):
+        self.pmids = np.unique(np.asarray(pmids, dtype=np.uint32))
+        self.idx = idx
+        self.cache_dir = cache_dir
+
+    def __len__(self):
+        return len(self.pmids)
+
+    @classmethod
+    def count(cls, idx, idx_type=None):
+        ''' Get the number of documents in an index (after a refresh). '''
+        client = ElasticClient.get()
+        client.refresh(idx)
+        return client.count(idx, idx_type)
+
+    @classmethod
+    def state(cls, idx, count):
+        ''' Get the state of an index to check the saved PMIDs against: the document
+        count and the uuids of the indices (an alias may be moved or an index recreated).
+        Updates of the documents (e.g. the disease tags) leave it unchanged. '''
+        settings = ElasticClient.get().json('GET', ElasticClient.path(idx, endpoint='_settings'))
+        return {"count": count,
+                "uuids": sorted(s['settings']['index']['uuid'] for s in settings.values())}
+
+    @classmethod
+    def build(cls, idx, idx_type=None):
+        ''' Build from the document ids in an index. '''
+        return cls(np.fromiter((int(pmid) for pmid in Scroll.ids(idx, idx_type=idx_type)), dtype=np.uint32))
+
+    @classmethod
+    def load(cls, idx, cache_dir=None, idx_type=None):
+        ''' Get the PMIDs of an index, the array kept for this run if it has the
+        documents count of the index or else the saved PMIDs if they are current,
+        otherwise they are built (and saved).
+        @type  idx: str
+        @param idx: Publications index name.
+        @type  cache_dir: str
+        @keyword cache_dir: Directory to save the PMIDs in (not saved if None).
+        '''
+        count = cls.count(idx, idx_type)
+        pmid_index = cls._indices.get(idx)
+        if pmid_index is not None and len(pmid_index) == count:
+            return pmid_index
+        if count == 0:
+            pmid_index = cls([], idx=idx, cache_dir=cache_dir)
+        elif cache_dir is None:
+            pmid_index = cls(cls.build(idx, idx_type).pmids, idx=idx)
+        else:
+            pmid_index = cls._load_saved(idx, count, cache_dir)
+            if pmid_index is None:
+                pmid_index = cls(cls.build(idx, idx_type).pmids, idx=idx, cache_dir=cache_dir)
+                pmid_index.save(state=cls.state(idx, count))
+        cls._indices[idx] = pmid_index
+        return pmid_index
+
+    @classmethod
+    def _load_saved(cls, idx, count, cache_dir):
+        npy_file = os.path.join(cache_dir, idx + '.pmids.npy')
+        meta_file = os.path.join(cache_dir, idx + '.pmids.json')
+        if not os.path.exists(npy_file) or not os.path.exists(meta_file):
+            return None
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta != cls.state(idx, count):
+            return None
+        pmid_index = cls(np.load(npy_file), idx=idx, cache_dir=cache_dir)
+        logger.debug("Loaded " + str(len(pmid_index)) + " PMIDs from " + npy_file)
+        return pmid_index
+
+    def save(self, state=None):
+        ''' Save the PMIDs with the state of the index (if there is a cache_dir). '''
+        if self.cache_dir is None:
+            return
+        if state is None:
+            state = PmidIndex.state(self.idx, len(self))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        npy_file = os.path.join(self.cache_dir, self.idx + '.pmids.npy')
+        np.save(npy_file, self.pmids)
+        with open(os.path.join(self.cache_dir, self.idx + '.pmids.json'), 'w') as f:
+            json.dump(state, f)
+        logger.debug("Saved " + str(len(self)) + " PMIDs to " + npy_file)
+
+    def add(self, pmids):
+        ''' Merge PMIDs into the sorted array. '''
+        new = np.setdiff1d(np.asarray([int(pmid) for pmid in pmids], dtype=np.uint32), self.pmids)
+        if len(new) > 0:
+            self.pmids = np.insert(self.pmids, np.searchsorted(self.pmids, new), new)
+        return len(new)
+
+    @classmethod
+    def loaded(cls, idx, stage_file):
+        ''' Merge the PMIDs of the documents in a staged publications file loaded into an
+        index into the array kept for the index in this run (if there is one) and save it. '''
+        pmid_index = cls._indices.get(idx)
+        if pmid_index is None:
+            return
+        with open(stage_file, encoding='utf-8') as f:
+            docs = json.load(f)['docs']
+        pmid_index.add([doc['pmid'] for doc in docs if 'pmid' in doc])
+        if pmid_index.cache_dir is not None and len(pmid_index) == cls.count(idx):
+            pmid_index.save()
+
+    @classmethod
+    def close(cls):
+        ''' Drop the PMID arrays kept for this run. '''
+        cls._indices = {}
+
+    def contains(self, pmids):
+        ''' Boolean array of the PMIDs in a list that are in the index. '''
+        query = np.asarray([int(pmid) for pmid in pmids], dtype=np.uint32)
+        if len(self.pmids) == 0:
+            return np.zeros(len(query), dtype=np.bool_)
+        pos = np.searchsorted(self.pmids, query)
+        pos[pos == len(self.pmids)] = 0
+        return self.pmids[pos] == query
+
+    def new(self, pmids):
+        ''' Get the PMIDs in a list that are not in the index (in list order). '''
+        found = self.contains(pmids)
+        return [pmid for pmid, f in zip(pmids, found) if not f]
@@ -0,0 +1,63 @@
+''' Local store of publication records fetched from NCBI eutils. '''
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PubCache(object):
+    ''' SQLite store mapping a PMID to its parsed publication document (see
+    L{Pubs._parse_pubmed_record}) and the time it was fetched. L{Pubs.fetch_details}
+    consults the cache first and only requests PMIDs that are missing or stale. '''
+
+    # maximum number of variables in an SQLite query
+    CHUNK_SIZE = 900
+
+    def __init__(self, db_file, max_age=None):
+        '''
+        @type  db_file: str
+        @param db_file: SQLite database file.
+        @type  max_age: float
+        @keyword max_age: Age in days after which a cached record is stale.
+        '''
+        db_dir = os.path.dirname(db_file)
+        if db_dir != '' and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+        self.db_file = db_file
+        self.max_age = max_age
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS publication '
+                          '(pmid INTEGER PRIMARY KEY, doc TEXT NOT NULL, fetched REAL NOT NULL)')
+        self.conn.commit()
+
+    def get(self, pmids):
+        ''' Get a PMID:document dictionary of the fresh records cached for a list of PMIDs. '''
+        oldest = 0
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age * 86400
+        pubs = {}
+        for i in range(0, len(pmids), PubCache.CHUNK_SIZE):
+            chunk = [int(pmid) for pmid in pmids[i:i+PubCache.CHUNK_SIZE]]
+            sql = 'SELECT pmid, doc FROM publication WHERE fetched >= ? AND pmid IN (%s)' % \
+                  ','.join('?' * len(chunk))
+            for (pmid, doc) in self.conn.execute(sql, [oldest] + chunk):
+                pubs[str(pmid)] = json.loads(doc)
+        return pubs
+
+    def put(self, pub_objs):
+        ''' Add or replace publication documents. '''
+        fetched = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO publication (pmid, doc, fetched) VALUES (?, ?, ?)',
+                              [(int(pub_obj['pmid']), json.dumps(pub_obj), fetched) for pub_obj in pub_objs])
+        self.conn.commit()
+
+    def count(self):
+        ''' Number of cached records. '''
+        return self.conn.execute('SELECT COUNT(*) FROM publication').fetchone()[0]
+
+    def close(self):
+        self.conn.close()
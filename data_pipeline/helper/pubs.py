@@ -2,11 +2,20 @@
 
 import json
 import requests
+from requests.packages.urllib3.exceptions import HTTPError as StreamError
 import xml.etree.ElementTree as ET
 import logging
 import re
 from .exceptions import PublicationDownloadError
 import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing
+import io
+import heapq
+from itertools import islice
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -17,8 +26,24 @@ class Pubs():
 
     DUPLICATE_PMIDS = ['22543779']
 
+    MAPPING = {
+        "_id": {"type": "integer"},
+        "pmid": {"type": "integer"},
+        "tags": {"type": "object", "index": "not_analyzed"},
+        "journal": {"type": "string"},
+        "title": {"type": "string"},
+        "date": {"type": "date"},
+        "authors": {"type": "object"},
+        "abstract": {"type": "string"},
+        "suggest": {"type": "completion"}
+    }
+    # ensembl ids of the genes linked to a publication by gene2pubmed, added by the
+    # gene build (see Gene._update_pub_genes) and not by fetching the publications
+    GENES_MAPPING = {"genes": {"type": "string", "index": "not_analyzed"}}
+
     @classmethod
-    def fetch_details(cls, pmids, filename, disease_code=None, source='auto'):
+    def fetch_details(cls, pmids, filename, disease_code=None, source='auto', api_key=None, workers=3, retries=3,
+                      parse_workers=0, cache=None, disease_codes=None):
         ''' Given a list of PMIDs fetch their details from eutils.
         http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi??db=pubmed&retmode=xml&id=<PMIDS>
         Produces a JSON file containing the publications mapping and documents.
@@ -26,110 +51,196 @@ class Pubs():
           "mapping": {"properties": {...}},
           "docs": [...]
         }
+        Chunks of PMIDs are fetched by a pool of worker threads within the NCBI
+        rate limit (3 requests/s or 10 requests/s with an API key). A failed chunk is
+        retried on its own and the documents are written in PMID order.
+        The XML is parsed incrementally from the response stream or, if parse_workers
+        is set, in a process pool so that parsing overlaps with the network requests.
+        If a L{PubCache} is given records are read from it and only the missing or
+        stale PMIDs are fetched from eutils (and then added to the cache).
+        Documents are tagged with a disease_code or, for a PMID:[disease codes] dictionary
+        (disease_codes), with the codes for each PMID.
         '''
 
         # remove known duplicate PMIDs
         pmids = [pmid for pmid in pmids if pmid not in Pubs.DUPLICATE_PMIDS]
+        pmids = sorted(set(pmids), key=int)
         chunk_size = 450
         count = 0
-        mapping = {
-            "_id": {"type": "integer"},
-            "pmid": {"type": "integer"},
-            "tags": {"type": "object", "index": "not_analyzed"},
-            "journal": {"type": "string"},
-            "title": {"type": "string"},
-            "date": {"type": "date"},
-            "authors": {"type": "object"},
-            "abstract": {"type": "string"},
-            "suggest": {"type": "completion"}
-                   }
-
+        mapping = Pubs.MAPPING
         mapping_keys = mapping.keys()
-        start = time.time()
+        cached = cache.get(pmids) if cache is not None else {}
+        fetch_pmids = [pmid for pmid in pmids if pmid not in cached]
+        logger.debug("No. publications cached "+str(len(cached))+" to fetch "+str(len(fetch_pmids)))
+        chunks = [fetch_pmids[i:i+chunk_size] for i in range(0, len(fetch_pmids), chunk_size)]
+        pmids_found = set()
+        failed_chunks = []
 
-#         pmids = [25905407, 25905392, 23369186, 24947582, 1476675, 18225448, 10250814, 25743292]
         with open(filename, mode='w', encoding='utf-8') as f:
             f.write('{"mapping": ')
             f.write(json.dumps({"properties": mapping}))
             f.write(',\n"docs":[\n')
-            for i in range(0, len(pmids), chunk_size):
-                chunk = pmids[i:i+chunk_size]
-                url = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi' \
-                      "?db=pubmed&tool=dil_publication_pipeline&email=tjc29@cimr.cam.ac.uk&retmode=xml&id=%s" % \
-                      ",".join([str(item) for item in chunk])
-
-                r = requests.get(url, timeout=25)
-                if r.status_code != 200:
-                    msg = "Status code:: "+str(r.status_code)+" URL:: "+url
-                    logger.error(msg)
-                    raise PublicationDownloadError(msg)
-                tree = ET.fromstring(r.content)
-                pubmeds = tree.findall("PubmedArticle") + tree.findall("PubmedBookArticle")
-                for pubmed in pubmeds:
-                    pub = pubmed.find('MedlineCitation')
-                    if pub is None:
-                        pub = pubmed.find('BookDocument')
-                    if count > 0:
-                        f.write(',\n')
-
-                    pub_obj = Pubs._parse_pubmed_record(pub)
-                    if disease_code is not None:
+
+            fetched = cls._fetch_chunks(chunks, failed_chunks, api_key=api_key, workers=workers,
+                                        retries=retries, parse_workers=parse_workers, cache=cache)
+            for pub_obj in cls._merge_pmid_order([cached[pmid] for pmid in pmids if pmid in cached], fetched):
+                if count > 0:
+                    f.write(',\n')
+
+                if disease_codes is not None and pub_obj['pmid'] in disease_codes:
+                    pub_obj['tags'] = {}
+                    pub_obj['tags']['disease'] = list(disease_codes[pub_obj['pmid']])
+                elif disease_code is not None:
+                    pub_obj['tags'] = {}
+                    pub_obj['tags']['disease'] = [disease_code]
+                if source is not None:
+                    if 'tags' not in pub_obj:
                         pub_obj['tags'] = {}
-                        pub_obj['tags']['disease'] = [disease_code]
-                    if source is not None:
-                        if 'tags' not in pub_obj:
-                            pub_obj['tags'] = {}
-                        pub_obj['tags']['source'] = source
-
-                    keys_not_found = [k for k in mapping_keys if k not in pub_obj]
-                    if len(keys_not_found) > 0:
-                        logger.warn("PMID: "+pub_obj['pmid']+' not found: '+str(keys_not_found))
-                    f.write(json.dumps(pub_obj))
-#                     print(pub_obj['pmid'])
-                    count += 1
-
-                time_taken = time.time() - start
-                eta = (time_taken / (i+chunk_size)) * (len(pmids) - i+chunk_size)
-                logger.debug('Retrieved '+(str(count))+' PMID records of '+str(len(pmids)) +
-                             ' :: ETA/s: '+str(int(eta)))
+                    pub_obj['tags']['source'] = source
+
+                keys_not_found = [k for k in mapping_keys if k not in pub_obj]
+                if len(keys_not_found) > 0:
+                    logger.warn("PMID: "+pub_obj['pmid']+' not found: '+str(keys_not_found))
+                f.write(json.dumps(pub_obj))
+                pmids_found.add(pub_obj['pmid'])
+                count += 1
 
             f.write('\n]}')
         logger.debug("No. publications downloaded "+str(count))
         if count != len(pmids):
+            missing = [pmid for pmid in pmids if pmid not in pmids_found]
             msg = "No. publications "+str(count)+" does not match the number of requested PMIDs ="+str(len(pmids))
+            if len(failed_chunks) > 0:
+                msg += " :: failed chunks="+str(len(failed_chunks))
+            msg += " :: missing PMIDs="+",".join(missing)
             logger.error(msg)
             raise PublicationDownloadError(msg)
 
+    @classmethod
+    def _fetch_chunks(cls, chunks, failed_chunks, api_key=None, workers=3, retries=3, parse_workers=0, cache=None):
+        ''' Generator of the publication objects for chunks of PMIDs in chunk order. Chunks that
+        fail after retrying are added to failed_chunks. '''
+        start = time.time()
+        count = 0
+        rate_limiter = RateLimiter(Pubs.API_KEY_RATE if api_key else Pubs.RATE)
+        session = requests.Session()
+        parse_pool = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers > 0 else None
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                # keep a bounded number of chunks in flight, results are returned in chunk order
+                futures = deque()
+                chunks_iter = iter(chunks)
+                for chunk in islice(chunks_iter, workers * 2):
+                    futures.append((chunk, executor.submit(cls._efetch, chunk, session, rate_limiter,
+                                                           api_key, retries, parse_pool)))
+                nchunks = 0
+                while futures:
+                    (chunk, future) = futures.popleft()
+                    for next_chunk in islice(chunks_iter, 1):
+                        futures.append((next_chunk, executor.submit(cls._efetch, next_chunk, session,
+                                                                    rate_limiter, api_key, retries, parse_pool)))
+                    try:
+                        pub_objs = future.result()
+                    except PublicationDownloadError as e:
+                        logger.error(str(e))
+                        failed_chunks.append(chunk)
+                        continue
+
+                    if cache is not None:
+                        cache.put(pub_objs)
+                    for pub_obj in pub_objs:
+                        yield pub_obj
+                    count += len(pub_objs)
+
+                    nchunks += 1
+                    time_taken = time.time() - start
+                    eta = (time_taken / nchunks) * (len(chunks) - nchunks)
+                    logger.debug('Retrieved '+(str(count))+' PMID records in chunk '+str(nchunks) +
+                                 ' of '+str(len(chunks))+' :: ETA/s: '+str(int(eta)))
+        finally:
+            session.close()
+            if parse_pool is not None:
+                parse_pool.shutdown()
+
+    @classmethod
+    def _merge_pmid_order(cls, *pub_lists):
+        ''' Merge iterables of publication objects, each in PMID order, into PMID order. '''
+        decorated = [((int(pub_obj['pmid']), i, n, pub_obj) for n, pub_obj in enumerate(pub_list))
+                     for i, pub_list in enumerate(pub_lists)]
+        for (_pmid, _i, _n, pub_obj) in heapq.merge(*decorated):
+            yield pub_obj
+
+    # NCBI eutils requests per second without and with an API key
+    RATE = 3
+    API_KEY_RATE = 10
+    EFETCH_URL = 'http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi' \
+                 '?db=pubmed&tool=dil_publication_pipeline&email=tjc29@cimr.cam.ac.uk&retmode=xml'
+
+    @classmethod
+    def _efetch(cls, chunk, session, rate_limiter, api_key=None, retries=3, parse_pool=None):
+        ''' Fetch and parse a chunk of PMIDs, retrying with a backoff on failure. Errors
+        reading the response stream (urllib3) are retried as for the request errors. If
+        the parse pool is broken the chunk is parsed in this thread. '''
+        url = Pubs.EFETCH_URL + "&id=%s" % ",".join([str(item) for item in chunk])
+        if api_key:
+            url += "&api_key=" + api_key
+        for attempt in range(retries + 1):
+            rate_limiter.wait()
+            try:
+                with closing(session.get(url, timeout=25, stream=True)) as r:
+                    if r.status_code == 200:
+                        if parse_pool is not None:
+                            return parse_pool.submit(parse_pubmed_xml, r.content).result()
+                        r.raw.decode_content = True
+                        return list(cls.iterparse(r.raw))
+                    msg = "Status code:: "+str(r.status_code)+" URL:: "+url
+            except (requests.exceptions.RequestException, StreamError, ET.ParseError) as e:
+                msg = "Error:: "+str(e)+" URL:: "+url
+            except BrokenProcessPool as e:
+                msg = "Parse pool error:: "+str(e)+" URL:: "+url
+                parse_pool = None
+            logger.warn(msg+" :: attempt "+str(attempt + 1))
+            if attempt < retries:
+                time.sleep(2 ** attempt)
+        raise PublicationDownloadError(msg)
+
+    @classmethod
+    def _parse_pubmed_article(cls, pubmed):
+        ''' Parse a PubmedArticle or PubmedBookArticle element. '''
+        pub = pubmed.find('MedlineCitation')
+        if pub is None:
+            pub = pubmed.find('BookDocument')
+        return Pubs._parse_pubmed_record(pub)
+
     @classmethod
     def _parse_pubmed_record(cls, pub):
-        pmid = pub.find('PMID').text
+        pmid = pub.findtext('PMID')
         pub_obj = {'pmid': pmid, '_id': pmid}
         article = pub.find('Article')
         if article is not None:
-            pub_obj['title'] = article.find('ArticleTitle').text
-            authors = article.find('AuthorList')
-            Pubs.get_authors(pub_obj, authors, pmid)
+            pub_obj['title'] = article.findtext('ArticleTitle')
+            Pubs.get_authors(pub_obj, article.find('AuthorList'), pmid)
             Pubs.get_abstract(pub_obj, article)
 
             journal = article.find('Journal')
-            try:
-                pub_obj['journal'] = journal.find('ISOAbbreviation').text
-            except AttributeError:
-                pub_obj['journal'] = journal.find('Title').text
-
-            pub_date = journal.find('JournalIssue').find('PubDate')
-            article_date = article.find('ArticleDate')
-            if article_date is not None:
-                pub_date = article_date
+            iso_abbreviation = journal.find('ISOAbbreviation')
+            if iso_abbreviation is not None:
+                pub_obj['journal'] = iso_abbreviation.text
+            else:
+                pub_obj['journal'] = journal.findtext('Title')
+
+            pub_date = article.find('ArticleDate')
+            if pub_date is None:
+                pub_date = journal.find('JournalIssue/PubDate')
             Pubs.get_date(pub_obj, pub_date)
         elif pub.find('Book') is not None:
-            pub_obj['title'] = pub.find('ArticleTitle').text
-            authors = pub.find('AuthorList')
-            Pubs.get_authors(pub_obj, authors, pmid)
+            pub_obj['title'] = pub.findtext('ArticleTitle')
+            Pubs.get_authors(pub_obj, pub.find('AuthorList'), pmid)
             Pubs.get_abstract(pub_obj, pub)
             pub_date = pub.find('ContributionDate')
             if pub_date is None:
-                pub_date = pub.find('Book').find('PubDate')
+                pub_date = pub.find('Book/PubDate')
 
             Pubs.get_date(pub_obj, pub_date)
 
@@ -139,7 +250,7 @@ class Pubs():
     def get_abstract(cls, pub_obj, article):
         ''' Add the abastract to the publication object. '''
         try:
-            texts = article.find('Abstract').findall('AbstractText')
+            texts = article.find('Abstract').iterfind('AbstractText')
             abstract = ''
             for t in texts:
                 label = ''
@@ -160,19 +271,21 @@ class Pubs():
         lastnames = []
         try:
             for author in authors:
+                lastname_elem = author.find('LastName')
+                if lastname_elem is None:
+                    continue
                 try:
-                    lastname = author.find('LastName').text.title()
+                    lastname = lastname_elem.text.title()
                     forename = author.find('ForeName').text.title()
                     lastnames.append(lastname)
                     if not lastname.startswith(forename+' '):
                         lastname = forename + ' ' + lastname
                     author_obj = {'name': lastname}
                 except AttributeError:
-                    if author.find('LastName') is None:
-                        continue
-                    author_obj = {'name': author.find('LastName').text}
-                if author.find('Initials') is not None:
-                    author_obj.update({'initials': author.find('Initials').text})
+                    author_obj = {'name': lastname_elem.text}
+                initials = author.find('Initials')
+                if initials is not None:
+                    author_obj.update({'initials': initials.text})
                 authors_arr.append(author_obj)
             pub_obj['authors'] = authors_arr
             if len(lastnames) > 0:
@@ -199,57 +312,107 @@ class Pubs():
               'fal': '09', 'fall': '09',
               'aut': '09', 'autumn': '09'}
 
+    # MedlineDate formats
+    # 1999 May-Jun and 1992 Summer-Fall
+    MEDLINE_DATE_MONTH_RANGE = re.compile(r'(\d{4})\s(\w{3,6})\s*-\w+')
+    # 2010 May 26-Jun 1
+    MEDLINE_DATE_DAY_RANGE = re.compile(r'(\d{4})\s(\w{3}) (\d{1,2})-')
+    # 1978-1979 and 1981 1st Quart
+    MEDLINE_DATE_QUARTER = re.compile(r'^(\d{4})\s*(-|1st|2nd|2d|3rd|4th)')
+    # 2000Jun 8-21
+    MEDLINE_DATE_MONTH = re.compile(r'^(\d{4})\s*(\w{3,6})-*')
+    QUARTERS = {'2nd': '-04-01', '2d': '-04-01', '3rd': '-07-01', '4th': '-10-01'}
+
     @classmethod
     def get_date(cls, pub_obj, pub_date):
         ''' Get the date and save to pub_obj. '''
-        if pub_date.find('Month') is not None:
-            month = pub_date.find('Month').text
-            if month.lower() in Pubs.MONTHS:
-                month = Pubs.MONTHS[month.lower()]
-            date = pub_date.find('Year').text + '-' + month
-            if pub_date.find('Day') is not None:
-                day = '%02d' % int(pub_date.find('Day').text)
-                date = date + '-' + day
+        year = pub_date.findtext('Year')
+        month = pub_date.findtext('Month')
+        if month is not None:
+            month = Pubs.MONTHS.get(month.lower(), month)
+            date = year + '-' + month
+            day = pub_date.findtext('Day')
+            if day is not None:
+                date = date + '-' + '%02d' % int(day)
             else:
                 date = date + '-01'
             pub_obj['date'] = date
-        elif pub_date.find('Year') is not None:
-            pub_obj['date'] = pub_date.find('Year').text + '-01-01'
+        elif year is not None:
+            pub_obj['date'] = year + '-01-01'
         elif pub_date.find('MedlineDate') is not None:
-            date = pub_date.find('MedlineDate').text
-
-            # 1999 May-Jun and 1992 Summer-Fall
-            p = re.compile('(\d{4})\s(\w{3,6})\s*-\w+')
-            m = p.match(date)
-            if m:
-                date = m.group(1) + '-' + Pubs.MONTHS[m.group(2).lower()] + '-01'
-            else:
-                # 2010 May 26-Jun 1
-                p = re.compile('(\d{4})\s(\w{3}) (\d{1,2})-')
-                m = p.match(date)
-                if m:
-                    day = '%02d' % int(m.group(3))
-                    date = m.group(1) + '-' + Pubs.MONTHS[m.group(2).lower()] + '-' + day
-                else:
-                    # 1978-1979 and 1981 1st Quart
-                    p = re.compile('^(\d{4})\s*(-|1st|2nd|2d|3rd|4th)')
-                    m = p.match(date)
-                    if m:
-                        if m.group(2) == '2nd' or m.group(2) == '2d':
-                            date = m.group(1) + '-04-01'
-                        elif m.group(2) == '3rd':
-                            date = m.group(1) + '-07-01'
-                        elif m.group(2) == '4th':
-                            date = m.group(1) + '-10-01'
-                        else:
-                            date = m.group(1) + '-01-01'
-                    else:
-                        # 2000Jun 8-21
-                        p = re.compile('^(\d{4})\s*(\w{3,6})-*')
-                        m = p.match(date)
-                        if m:
-                            date = m.group(1) + '-' + Pubs.MONTHS[m.group(2).lower()] + '-01'
-
-            pub_obj['date'] = date
+            pub_obj['date'] = cls._medline_date(pub_date.findtext('MedlineDate'))
         else:
             logger.warn("Date not found for PMID:"+pub_obj["pmid"])
+
+    @classmethod
+    def _medline_date(cls, date):
+        ''' Convert a free text MedlineDate to a date. '''
+        m = Pubs.MEDLINE_DATE_MONTH_RANGE.match(date)
+        if m:
+            return m.group(1) + '-' + Pubs.MONTHS[m.group(2).lower()] + '-01'
+        m = Pubs.MEDLINE_DATE_DAY_RANGE.match(date)
+        if m:
+            return m.group(1) + '-' + Pubs.MONTHS[m.group(2).lower()] + '-' + '%02d' % int(m.group(3))
+        m = Pubs.MEDLINE_DATE_QUARTER.match(date)
+        if m:
+            return m.group(1) + Pubs.QUARTERS.get(m.group(2), '-01-01')
+        m = Pubs.MEDLINE_DATE_MONTH.match(date)
+        if m:
+            return m.group(1) + '-' + Pubs.MONTHS[m.group(2).lower()] + '-01'
+        return date
+
+    ARTICLE_TAGS = ('PubmedArticle', 'PubmedBookArticle')
+
+    @classmethod
+    def iterparse(cls, source):
+        ''' Generator of publication objects parsed incrementally from eutils XML (a file
+        name or file object). Each article element is cleared once it has been parsed so
+        memory use does not grow with the size of the XML. '''
+        context = ET.iterparse(source, events=('start', 'end'))
+        root = None
+        for event, elem in context:
+            if root is None:
+                root = elem
+            if event == 'end' and elem.tag in Pubs.ARTICLE_TAGS:
+                yield cls._parse_pubmed_article(elem)
+                elem.clear()
+                root.clear()
+
+    @classmethod
+    def benchmark_parse(cls, xml_file, repeat=10):
+        ''' Measure the parsing rate (records/s) of a recorded eutils XML file. '''
+        with open(xml_file, 'rb') as f:
+            content = f.read()
+        start = time.time()
+        count = 0
+        for _ in range(repeat):
+            count += len(parse_pubmed_xml(content))
+        time_taken = time.time() - start
+        stats = {"records": count, "seconds": time_taken,
+                 "records_per_second": count / time_taken if time_taken > 0 else None}
+        logger.debug(json.dumps(stats))
+        return stats
+
+
+def parse_pubmed_xml(content):
+    ''' Parse eutils XML (bytes) into a list of publication objects. Defined at the module
+    level so it can be run in a process pool. '''
+    return list(Pubs.iterparse(io.BytesIO(content)))
+
+
+class RateLimiter(object):
+    ''' Thread safe limit on the number of requests started per second. '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        ''' Block until the next request is allowed. '''
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
@@ -0,0 +1,138 @@
+''' Used to resolve merged dbSNP rs ids to their current rs id. '''
+
+import gzip
+import json
+import logging
+import os
+import numpy as np
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+
+class RsMergeResolver(object):
+    ''' Resolve merged rs ids using the dbSNP RsMergeArch table, see:
+    www.ncbi.nlm.nih.gov/projects/SNP/snp_db_table_description.cgi?t=RsMergeArch
+
+    The rsHigh to rsCurrent pairs are held as sorted integer arrays with chains of
+    merges (rsCurrent itself later merged) collapsed so that each rsHigh maps to the
+    id that is current now. The arrays are saved and memory-mapped:
+
+    <dir>/rs_merge_high.npy     - sorted merged rs ids (rsHigh)
+    <dir>/rs_merge_current.npy  - current rs id for each rsHigh (0 if none)
+    <dir>/rs_merge_build.npy    - dbSNP build of the merge
+    <dir>/rs_merge.json         - size and modification time of the RsMergeArch file
+    '''
+
+    FILES = {'high': 'rs_merge_high.npy', 'current': 'rs_merge_current.npy', 'build': 'rs_merge_build.npy'}
+    META_FILE = 'rs_merge.json'
+
+    def __init__(self, high, current, build):
+        self.high = high
+        self.current = current
+        self.build = build
+
+    def __len__(self):
+        return len(self.high)
+
+    @classmethod
+    def parse(cls, merge_f):
+        ''' Parse the rsHigh, rsCurrent and build_id columns of RsMergeArch lines. When
+        a rs id is merged more than once the latest build is kept. '''
+        rows = {}
+        for line in merge_f:
+            parts = line.split('\t')
+            if len(parts) < 7:
+                continue
+            rs_high = int(parts[0])
+            build_id = int(parts[2])
+            rs_current = int(parts[6]) if parts[6].strip() != '' else 0
+            if rs_high not in rows or rows[rs_high][1] <= build_id:
+                rows[rs_high] = (rs_current, build_id)
+
+        high = np.fromiter(rows.keys(), dtype=np.uint32, count=len(rows))
+        current = np.fromiter((r[0] for r in rows.values()), dtype=np.uint32, count=len(rows))
+        build = np.fromiter((r[1] for r in rows.values()), dtype=np.uint16, count=len(rows))
+        order = np.argsort(high)
+        high = high[order]
+        return cls(high, cls._collapse(high, current[order]), build[order])
+
+    @classmethod
+    def _collapse(cls, high, current, max_depth=100):
+        ''' Follow merge chains so that each rsHigh maps to an id that has not itself merged. '''
+        current = current.copy()
+        for _ in range(max_depth):
+            (pos, found) = cls._search(high, current)
+            found &= current != 0
+            if not found.any():
+                return current
+            current[found] = current[pos[found]]
+        raise PipelineError('RsMergeArch merge chain longer than ' + str(max_depth))
+
+    @classmethod
+    def _search(cls, high, rs_ids):
+        pos = np.searchsorted(high, rs_ids)
+        pos[pos == len(high)] = 0
+        if len(high) == 0:
+            return (pos, np.zeros(len(rs_ids), dtype=np.bool_))
+        return (pos, high[pos] == rs_ids)
+
+    @classmethod
+    def build_file(cls, merge_file, out_dir):
+        ''' Build from a (gzipped) RsMergeArch file and save to out_dir. '''
+        opener = gzip.open if merge_file.endswith('.gz') else open
+        with opener(merge_file, 'rt') as merge_f:
+            resolver = cls.parse(merge_f)
+        resolver.save(out_dir, cls._file_stat(merge_file))
+        logger.debug("Saved " + str(len(resolver)) + " rs merges to " + out_dir)
+        return resolver
+
+    @classmethod
+    def _file_stat(cls, merge_file):
+        stat = os.stat(merge_file)
+        return {"file": os.path.basename(merge_file), "size": stat.st_size, "mtime": stat.st_mtime}
+
+    def save(self, out_dir, meta):
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for name, file_name in RsMergeResolver.FILES.items():
+            np.save(os.path.join(out_dir, file_name), getattr(self, name))
+        with open(os.path.join(out_dir, RsMergeResolver.META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, out_dir, merge_file=None):
+        ''' Load the memory-mapped arrays. If the RsMergeArch file is given and it has
+        changed since they were saved they are rebuilt. '''
+        meta_file = os.path.join(out_dir, RsMergeResolver.META_FILE)
+        if merge_file is not None:
+            if not os.path.exists(meta_file):
+                return cls.build_file(merge_file, out_dir)
+            with open(meta_file) as f:
+                if json.load(f) != cls._file_stat(merge_file):
+                    return cls.build_file(merge_file, out_dir)
+        elif not os.path.exists(meta_file):
+            raise PipelineError('RsMergeArch arrays not found in ' + out_dir)
+        arrays = {name: np.load(os.path.join(out_dir, file_name), mmap_mode='r')
+                  for name, file_name in RsMergeResolver.FILES.items()}
+        return cls(arrays['high'], arrays['current'], arrays['build'])
+
+    @classmethod
+    def rs_ints(cls, rs_ids):
+        ''' Convert rs ids (e.g. rs2476601) to an integer array. '''
+        return np.asarray([int(rs_id[2:]) if rs_id.startswith('rs') else int(rs_id) for rs_id in rs_ids],
+                          dtype=np.uint32)
+
+    def resolve(self, rs_ids):
+        ''' Resolve rs ids to their current rs id.
+        @type  rs_ids: list
+        @param rs_ids: rs ids (e.g. rs2476601).
+        @return: (current rs ids array, merged boolean array, merge build array). The current
+        id is the same as the given id if it has not merged and 0 if it merged without a
+        current id.
+        '''
+        rs_ints = RsMergeResolver.rs_ints(rs_ids)
+        (pos, merged) = RsMergeResolver._search(self.high, rs_ints)
+        current = np.where(merged, self.current[pos], rs_ints) if len(self.high) > 0 else rs_ints
+        build = np.where(merged, self.build[pos], 0) if len(self.high) > 0 else np.zeros(len(rs_ints))
+        return (current, merged, build)
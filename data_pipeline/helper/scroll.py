@@ -0,0 +1,36 @@
+''' Used to stream documents from an elastic index. '''
+
+import logging
+from data_pipeline.helper.elastic_client import ElasticClient
+
+logger = logging.getLogger(__name__)
+
+
+class Scroll(object):
+    ''' Scroll through the documents in an index rather than retrieving them
+    with a single large search. '''
+
+    @classmethod
+    def docs(cls, idx, idx_type=None, query=None, sources=None, size=1000, scroll='1m'):
+        ''' Generator of the hits for a query (default match_all) on an index.
+        @type  idx: str
+        @param idx: Index name.
+        @type  idx_type: str
+        @keyword idx_type: Index type.
+        @type  query: dict
+        @keyword query: Elastic query (e.g. {"match_all": {}}).
+        @type  sources: list
+        @keyword sources: _source fields to return or False for none.
+        @type  size: int
+        @keyword size: Number of hits per shard for each page.
+        @type  scroll: str
+        @keyword scroll: Time to keep the scroll context alive.
+        '''
+        return ElasticClient.get().scroll(idx, idx_type=idx_type, query=query, sources=sources, size=size,
+                                          scroll=scroll)
+
+    @classmethod
+    def ids(cls, idx, idx_type=None, query=None, size=5000):
+        ''' Generator of the document ids in an index. '''
+        for hit in cls.docs(idx, idx_type=idx_type, query=query, sources=False, size=size):
+            yield hit['_id']
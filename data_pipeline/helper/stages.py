@@ -0,0 +1,120 @@
+''' Used to overlap the stages (e.g. parse, transform and load) of a loader. '''
+
+import logging
+import queue
+import threading
+import time
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+
+class StagedPipeline(object):
+    ''' Run batches through a chain of stages, each in its own thread, connected by
+    bounded queues so that the stages overlap while the number of batches in flight
+    is limited. The producer (e.g. a parser generator) runs in the calling thread.
+
+    stages = StagedPipeline([('resolve', check), ('load', load)], maxsize=4)
+    stats = stages.run(parse_batches())
+
+    Each stage function is called with a batch and returns the batch passed to the
+    next stage. The number of items (len(batch)) and time spent in each stage are
+    counted.
+    '''
+
+    _END = object()
+
+    def __init__(self, stages, maxsize=4):
+        '''
+        @type  stages: list
+        @param stages: List of (name, function) tuples.
+        @type  maxsize: int
+        @keyword maxsize: Maximum number of batches waiting between stages.
+        '''
+        self.stages = stages
+        self.maxsize = maxsize
+        self.stats = {}
+        self.error = None
+        self.stop = threading.Event()
+
+    def _count(self, name, items, seconds):
+        stat = self.stats.setdefault(name, {"batches": 0, "items": 0, "seconds": 0.0})
+        stat["batches"] += 1
+        stat["items"] += items
+        stat["seconds"] += seconds
+
+    def _put(self, out_queue, item):
+        ''' Put on a queue unless the pipeline has been stopped by an error. '''
+        while not self.stop.is_set():
+            try:
+                out_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, name, func, in_queue, out_queue):
+        try:
+            while True:
+                try:
+                    batch = in_queue.get(timeout=1)
+                except queue.Empty:
+                    if self.stop.is_set():
+                        return
+                    continue
+                if batch is StagedPipeline._END:
+                    break
+                start = time.time()
+                result = func(batch)
+                self._count(name, len(batch), time.time() - start)
+                if out_queue is not None and not self._put(out_queue, result):
+                    return
+        except Exception as e:
+            self.error = (name, e)
+            self.stop.set()
+            return
+        if out_queue is not None:
+            self._put(out_queue, StagedPipeline._END)
+
+    def run(self, batches, name='parse'):
+        ''' Feed the batches from a generator through the stages.
+        @return: Dictionary of the counts for each stage (including the producer).
+        '''
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages]
+        threads = []
+        for i, (stage_name, func) in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            thread = threading.Thread(target=self._worker, args=(stage_name, func, queues[i], out_queue),
+                                      name=stage_name, daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        start = time.time()
+        try:
+            batches = iter(batches)
+            while not self.stop.is_set():
+                t = time.time()
+                try:
+                    batch = next(batches)
+                except StopIteration:
+                    break
+                self._count(name, len(batch), time.time() - t)
+                if not self._put(queues[0], batch):
+                    break
+        except Exception as e:
+            self.error = (name, e)
+            self.stop.set()
+        finally:
+            self._put(queues[0], StagedPipeline._END)
+            for thread in threads:
+                thread.join()
+
+        if self.error is not None:
+            raise PipelineError('Stage ' + self.error[0] + ' failed: ' + repr(self.error[1]))
+
+        time_taken = time.time() - start
+        for stat in self.stats.values():
+            stat["items_per_second"] = stat["items"] / stat["seconds"] if stat["seconds"] > 0 else None
+        self.stats["total"] = {"seconds": time_taken}
+        logger.debug("Stages: " + str(self.stats))
+        return self.stats
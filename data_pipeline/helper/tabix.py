@@ -0,0 +1,156 @@
+''' Used to read BGZF compressed files (e.g. dbSNP VCF) with a tabix index. '''
+
+import gzip
+import logging
+import os
+import struct
+import zlib
+from data_pipeline.helper.exceptions import PipelineError
+
+logger = logging.getLogger(__name__)
+
+
+class Tabix(object):
+    ''' Reader of a tabix (.tbi) index, see the tabix file format:
+    https://samtools.github.io/hts-specs/tabix.pdf
+
+    For each sequence (chromosome) the index holds the bins of BGZF virtual
+    offset chunks and a linear index of the first virtual offset in each
+    16kb window. A virtual offset is the offset of a compressed BGZF block
+    in the file shifted left 16 bits plus the offset in the uncompressed block.
+    '''
+
+    # bin holding the virtual offset range of all the records of a sequence
+    PSEUDO_BIN = 37450
+    LINEAR_SHIFT = 14
+
+    def __init__(self, names, bins, linear):
+        self.names = names
+        self.bins = bins
+        self.linear = linear
+
+    @classmethod
+    def read(cls, tbi_file):
+        ''' Read a .tbi file. '''
+        with gzip.open(tbi_file, 'rb') as f:
+            data = f.read()
+        if data[:4] != b'TBI\x01':
+            raise PipelineError('Not a tabix index: ' + tbi_file)
+        (n_ref, _fmt, _col_seq, _col_beg, _col_end, _meta, _skip, l_nm) = struct.unpack_from('<8i', data, 4)
+        pos = 36
+        names = [name.decode() for name in data[pos:pos + l_nm].split(b'\x00')[:n_ref]]
+        pos += l_nm
+
+        bins = []
+        linear = []
+        for _ in range(n_ref):
+            (n_bin,) = struct.unpack_from('<i', data, pos)
+            pos += 4
+            ref_bins = {}
+            for _ in range(n_bin):
+                (bin_id, n_chunk) = struct.unpack_from('<Ii', data, pos)
+                pos += 8
+                ref_bins[bin_id] = list(struct.unpack_from('<' + 'Q' * 2 * n_chunk, data, pos))
+                pos += 16 * n_chunk
+            (n_intv,) = struct.unpack_from('<i', data, pos)
+            pos += 4
+            linear.append(struct.unpack_from('<' + 'Q' * n_intv, data, pos))
+            pos += 8 * n_intv
+            bins.append(ref_bins)
+        return cls(names, bins, linear)
+
+    def span(self, name):
+        ''' Get the (start, end) virtual offsets of the records for a sequence. '''
+        ref_bins = self.bins[self.names.index(name)]
+        if Tabix.PSEUDO_BIN in ref_bins:
+            return tuple(ref_bins[Tabix.PSEUDO_BIN][:2])
+        chunks = [v for b, offsets in ref_bins.items() for v in offsets]
+        return (min(chunks[0::2]), max(chunks[1::2]))
+
+    def region_start(self, name, beg):
+        ''' Get the virtual offset to start reading from for records overlapping a
+        1-based position (from the linear index) or None if there are none. '''
+        if name not in self.names:
+            return None
+        i = self.names.index(name)
+        window = (beg - 1) >> Tabix.LINEAR_SHIFT
+        if window >= len(self.linear[i]):
+            return None
+        offset = self.linear[i][window]
+        return offset if offset != 0 else self.span(name)[0]
+
+    def spans(self):
+        ''' Get a list of (name, start, end) virtual offsets in file order. '''
+        return sorted(((name,) + self.span(name) for name in self.names), key=lambda s: s[1])
+
+
+class BgzfReader(object):
+    ''' Read lines from a BGZF file starting at a virtual offset. '''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    @classmethod
+    def is_bgzf(cls, file_name):
+        ''' Check the first block has the BGZF 'BC' extra field. '''
+        with open(file_name, 'rb') as f:
+            header = f.read(16)
+        return len(header) == 16 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+    def _blocks(self, coffset):
+        ''' Generator of (compressed offset, uncompressed data) blocks from coffset. '''
+        with open(self.file_name, 'rb') as f:
+            f.seek(coffset)
+            while True:
+                header = f.read(18)
+                if len(header) < 18:
+                    return
+                if header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+                    raise PipelineError('Invalid BGZF block at ' + str(coffset) + ' in ' + self.file_name)
+                (bsize,) = struct.unpack_from('<H', header, 16)
+                block = f.read(bsize + 1 - 18)
+                data = zlib.decompress(block[:-8], -15)
+                yield (coffset, data)
+                coffset += bsize + 1
+
+    def lines(self, start=0, end=None):
+        ''' Generator of the lines (str) beginning at or after the virtual offset start
+        and before the virtual offset end (or the end of the file). '''
+        remainder = b''
+        remainder_voffset = None
+        offset = start & 0xFFFF
+        for (coffset, data) in self._blocks(start >> 16):
+            while True:
+                nl = data.find(b'\n', offset)
+                if nl == -1:
+                    if offset < len(data):
+                        if remainder == b'':
+                            remainder_voffset = (coffset << 16) | offset
+                        remainder += data[offset:]
+                    break
+                if remainder != b'':
+                    (voffset, line) = (remainder_voffset, remainder + data[offset:nl])
+                    remainder = b''
+                else:
+                    (voffset, line) = ((coffset << 16) | offset, data[offset:nl])
+                if end is not None and voffset >= end:
+                    return
+                yield line.decode()
+                offset = nl + 1
+            offset = 0
+        if remainder != b'' and (end is None or remainder_voffset < end):
+            yield remainder.decode()
+
+
+def open_lines(file_name):
+    ''' Generator of the lines of a (gzipped) text file. '''
+    opener = gzip.open if file_name.endswith('.gz') else open
+    with opener(file_name, 'rt') as f:
+        for line in f:
+            yield line.rstrip('\n')
+
+
+def tbi_file(file_name):
+    ''' Get the tabix index file for a file if it exists. '''
+    tbi = file_name + '.tbi'
+    return tbi if os.path.exists(tbi) else None
@@ -1,9 +1,17 @@
 ''' Loaders '''
 import os
+import json
 import logging
 from .utils import IniParser
+from .stage import Stage
 from django.core.management import call_command
 from data_pipeline.utils import pre_process
+from data_pipeline.helper.bulk import BulkWriter
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.exceptions import PipelineError
+from data_pipeline.helper.index_rebuild import IndexRebuild
+from data_pipeline.helper.lookup_cache import LookupCache
+from data_pipeline.helper.pmid_index import PmidIndex
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
@@ -20,7 +28,10 @@ class IndexLoad(IniParser):
     def process_section(self, section_name, section_dir_name, base_dir_path,
                         dir_path='.', section=None, stage='load', config=None):
         ''' Overrides L{IniParser.process_section} to process a section
-        in the config file '''
+        in the config file. Returns False if a staged file is missing. '''
+        if IndexRebuild.is_rebuild(section):
+            return self.rebuild(section_name, base_dir_path, config)
+
         stage_files = []
         if 'output' in section:
             stage_file = os.path.join(base_dir_path, 'STAGE', section_dir_name,
@@ -35,7 +46,7 @@ class IndexLoad(IniParser):
                                           f.strip() + '.json')
                 stage_files.append(stage_file)
         else:
-            return
+            return True
 
         if 'index_type' in section:
             idx_type = section['index_type']
@@ -46,8 +57,67 @@ class IndexLoad(IniParser):
 
             if not os.path.exists(stage_file):
                 logger.error('File does not exist: '+stage_file)
-                return
+                return False
 
             logger.debug('Loading: '+stage_file + ' into ' + section['index'])
             print('Loading: '+stage_file + ' into ' + section['index'] + '  '+idx_type)
-            call_command('index_search', indexType=idx_type, indexJson=stage_file, indexName=section['index'])
+            if 'loader' in section and section['loader'] == 'native':
+                self.load_json(stage_file, section['index'], idx_type, id_field=section.get('id_field'))
+            else:
+                call_command('index_search', indexType=idx_type, indexJson=stage_file, indexName=section['index'])
+                LookupCache.invalidate(section['index'])
+            PmidIndex.loaded(section['index'], stage_file)
+        return True
+
+    def rebuild(self, section_name, base_dir_path, config):
+        ''' Stage and load the sections listed in the rebuild option of a section, in
+        order, into a new version of their index and swap the index (alias) to it
+        (see L{IndexRebuild}). The functions named by the loaded tag of the sections
+        are called once the new version is in use. '''
+        for name in config.sections():
+            self._inherit_section(name, config)
+        names = IndexRebuild.members(config, section_name)
+        rebuild = IndexRebuild(config[section_name], [config[name] for name in names])
+        with rebuild:
+            for name in names:
+                section = config[name]
+                section_dir_name = self._inherit_section(name, config)
+                if 'stage' in section:
+                    if not Stage().process_section(name, section_dir_name, base_dir_path,
+                                                   dir_path=os.path.join(base_dir_path, 'STAGE', section_dir_name),
+                                                   section=section, stage=Stage.__name__, config=config):
+                        raise PipelineError('Failed to stage ' + name + ' for the rebuild')
+                loaded = self.process_section(name, section_dir_name, base_dir_path,
+                                              dir_path=os.path.join(base_dir_path, 'INDEXLOAD', section_dir_name),
+                                              section=section, stage=self.__class__.__name__, config=config)
+                if not loaded and 'load' not in section:
+                    raise PipelineError('Failed to load ' + name + ' for the rebuild')
+                rebuild.section_loaded()
+        for func in rebuild.finished:
+            func()
+        return True
+
+    @classmethod
+    def load_json(cls, stage_file, idx, idx_type, id_field=None):
+        ''' Load a staged JSON file ({"mapping": {...}, "docs": [...]}) with the shared
+        L{ElasticClient} and bulk indexer rather than the elastic index_search command.
+        The document ids are the _id of a doc or the value of id_field if given. '''
+        with open(stage_file, encoding='utf-8') as f:
+            stage = json.load(f)
+
+        client = ElasticClient.get()
+        if not client.index_exists(idx):
+            IndexRebuild.create(idx)
+        if 'mapping' in stage:
+            properties = {k: v for k, v in stage['mapping']['properties'].items() if not k.startswith('_')}
+            client.put_mapping(idx, idx_type, {"properties": properties})
+
+        writer = BulkWriter(idx, idx_type)
+        for doc in stage['docs']:
+            doc_id = doc.pop('_id', None)
+            if doc_id is None and id_field is not None:
+                doc_id = doc.get(id_field)
+            writer.index(doc, doc_id=doc_id)
+        count = writer.close()
+        logger.debug('Loaded ' + str(count) + ' docs from ' + stage_file)
+        return count
@@ -0,0 +1,84 @@
+''' Command line tool for pathway enrichment tests. '''
+from django.core.management.base import BaseCommand, CommandError
+from data_pipeline.helper.gene_enrichment import GeneEnrichment
+from data_pipeline.utils import IniParser
+import json
+import os
+import logging
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    ''' Build the bitset encoded gene sets from the staged MSIGDB pathways and
+    the gene universe in the gene index, then run enrichment tests against them.
+
+    Build (after staging MSIGDB):
+    ./manage.py enrichment --dir tmp --ini download.ini --build
+
+    Test gene lists (one whitespace separated list of ensembl ids per line):
+    ./manage.py enrichment --dir tmp --ini download.ini --genes gene_lists.txt --top 10
+
+    Benchmark:
+    ./manage.py enrichment --dir tmp --ini download.ini --benchmark 1000
+    '''
+    help = "Pathway enrichment tests"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir',
+                            dest='dir',
+                            metavar="/download_path/",
+                            help='Pipeline directory.', required=True)
+        parser.add_argument('--ini',
+                            dest='ini',
+                            help='Input file defining the pipeline.', required=True)
+        parser.add_argument('--pathway_section',
+                            dest='pathway_section', default='MSIGDB',
+                            help='Section of the staged pathways [default: MSIGDB].')
+        parser.add_argument('--gene_section',
+                            dest='gene_section', default='ENSEMBL_GENE',
+                            help='Section of the gene index [default: ENSEMBL_GENE].')
+        parser.add_argument('--build',
+                            dest='build', action='store_true',
+                            help='Build the gene set bitset matrix.')
+        parser.add_argument('--genes',
+                            dest='genes',
+                            help='File of gene lists to test.')
+        parser.add_argument('--top',
+                            dest='top', type=int, default=10,
+                            help='Number of gene sets to report per gene list [default: 10].')
+        parser.add_argument('--benchmark',
+                            dest='benchmark', type=int,
+                            help='Number of random gene lists to benchmark.')
+        parser.add_argument('--query_size',
+                            dest='query_size', type=int, default=200,
+                            help='Size of the random gene lists to benchmark [default: 200].')
+
+    def handle(self, *args, **options):
+        config = IniParser().read_ini(options['ini'])
+        stage_dir = os.path.join(options['dir'], 'STAGE', options['pathway_section'])
+        out_dir = os.path.join(options['dir'], 'STAGE', 'ENRICHMENT')
+
+        if options['build']:
+            section = config[options['gene_section']]
+            stage_files = GeneEnrichment.stage_files(stage_dir)
+            if len(stage_files) == 0:
+                raise CommandError('No staged pathways found in ' + stage_dir)
+            genes = GeneEnrichment.gene_universe(section['index'], section['index_type'])
+            enrichment = GeneEnrichment.build(genes, stage_files, out_dir)
+            self.stdout.write("BUILT " + str(enrichment.matrix.shape[0]) + " GENE SETS OVER " +
+                              str(len(genes)) + " GENES")
+        else:
+            enrichment = GeneEnrichment.load(out_dir)
+
+        if options['genes']:
+            with open(options['genes']) as gene_lists_f:
+                gene_lists = [line.split() for line in gene_lists_f if line.strip() != '']
+            for gene_list in gene_lists:
+                self.stdout.write(json.dumps(enrichment.top(gene_list, n=options['top'])))
+
+        if options['benchmark']:
+            stats = GeneEnrichment.benchmark(enrichment, n_queries=options['benchmark'],
+                                             query_size=options['query_size'])
+            self.stdout.write(json.dumps(stats))
@@ -3,6 +3,10 @@ from django.core.management.base import BaseCommand, CommandError
 from data_pipeline.download import Download
 from data_pipeline.stage import Stage
 from data_pipeline.load import IndexLoad
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.index_rebuild import IndexRebuild
+from data_pipeline.helper.lookup_cache import LookupCache
+from data_pipeline.helper.pmid_index import PmidIndex
 import logging
 
 # Get an instance of a logger
@@ -28,6 +32,10 @@ class Command(BaseCommand):
     ./manage.py pipeline --dir tmp --ini download.ini --sections GENE_PUBS --steps download load
     ./manage.py pipeline --dir tmp --ini download.ini --sections ENSMART_HOMOLOG --steps download load
     ./manage.py pipeline --dir tmp --ini download.ini --sections ENSEMBL2MGI --steps download load
+    or join the gene downloads and index the gene docs in one pass (see GENE_ASSEMBLY in download.ini):
+    ./manage.py pipeline --dir tmp --ini download.ini --sections ENSEMBL_GENE,GENE2ENSEMBL,ENSMART_GENE,\
+GENE_INFO,GENE_PUBS,ENSMART_HOMOLOG,ENSEMBL2MGI --steps download
+    ./manage.py pipeline --dir tmp --ini download.ini --sections GENE_ASSEMBLY --steps load
 
     Gene Interactions:
     ./manage.py pipeline --dir tmp --ini download.ini --sections BIOPLEX --steps download stage load
@@ -35,6 +43,9 @@ class Command(BaseCommand):
     Gene Pathways/Genesets:
     ./manage.py pipeline --dir tmp --ini download.ini --sections MSIGDB --steps download stage load
 
+    Pathway enrichment gene set matrix (see the enrichment command):
+    ./manage.py enrichment --dir tmp --ini download.ini --build
+
     Update gene suggester weighting:
     python criteria_suggester.py gene
 
@@ -45,6 +56,12 @@ class Command(BaseCommand):
 
     ./manage.py pipeline --dir tmp --ini download.ini  --sections IMMUNOCHIP_MYSQL --steps load
 
+    The sections of an index can be loaded into a new version of the index and the index
+    name made an alias of it (see GENE_REBUILD and DBSNP_REBUILD in download.ini):
+    ./manage.py pipeline --dir tmp --ini download.ini --sections GENE_REBUILD --steps load
+    To swap back to the previous version:
+    ./manage.py pipeline --rollback dbsnp144 --steps load
+
     '''
     help = "Download data file(s)"
 
@@ -66,9 +83,24 @@ class Command(BaseCommand):
                             dest='steps',
                             help='Steps to run [download load]',
                             nargs='+', required=True)
+        parser.add_argument('--rollback',
+                            dest='rollback',
+                            metavar="alias",
+                            help='Swap an alias back to the previous version of a rebuilt index.')
 
     def handle(self, *args, **options):
         logger.debug(options)
+        try:
+            self._run(options)
+        finally:
+            LookupCache.close()
+            PmidIndex.close()
+            ElasticClient.close()
+
+    def _run(self, options):
+        if options['rollback']:
+            self.stdout.write("ROLLED BACK TO " + IndexRebuild.rollback(options['rollback']))
+            return options
         if 'download' in options['steps']:
             if options['ini']:
                 if not options['dir']:
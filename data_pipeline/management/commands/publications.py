@@ -3,6 +3,9 @@ from django.core.management.base import BaseCommand
 from data_pipeline.download import Download
 from data_pipeline.load import IndexLoad
 from data_pipeline.stage import Stage
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.lookup_cache import LookupCache
+from data_pipeline.helper.pmid_index import PmidIndex
 
 
 class Command(BaseCommand):
@@ -23,12 +26,20 @@ class Command(BaseCommand):
                             dest='steps',
                             help='Steps to run [download load]',
                             nargs='+', required=True)
+        parser.add_argument('--full',
+                            dest='full', action='store_true',
+                            help='Download all records for incremental sections, not just those since the last run.')
 
     def handle(self, *args, **options):
-        if 'download' in options['steps']:
-            if Download().download_ini(options['ini'], options['dir'], options['sections']):
-                self.stdout.write("DOWNLOAD COMPLETE")
-        if 'stage' in options['steps']:
-            Stage().stage(options['ini'], options['dir'], options['sections'])
-        if 'load' in options['steps']:
-            IndexLoad().load(options['ini'], options['dir'], options['sections'])
+        try:
+            if 'download' in options['steps']:
+                if Download(full=options['full']).download_ini(options['ini'], options['dir'], options['sections']):
+                    self.stdout.write("DOWNLOAD COMPLETE")
+            if 'stage' in options['steps']:
+                Stage().stage(options['ini'], options['dir'], options['sections'])
+            if 'load' in options['steps']:
+                IndexLoad().load(options['ini'], options['dir'], options['sections'])
+        finally:
+            LookupCache.close()
+            PmidIndex.close()
+            ElasticClient.close()
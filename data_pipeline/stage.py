@@ -21,7 +21,13 @@ class Stage(IniParser):
 
         ''' Overrides L{IniParser.process_section} to process a section
         in the config file '''
-        if 'output' in section:
+        if 'files_regex' in section:
+            download_dir = os.path.join(base_dir_path, 'DOWNLOAD', section_dir_name)
+            if not os.path.exists(download_dir):
+                logger.error('Directory does not exist: '+download_dir)
+                return False
+            return True
+        elif 'output' in section:
             download_file = os.path.join(base_dir_path, 'DOWNLOAD', section_dir_name,
                                          section['output'])
         elif 'files' in section:
@@ -1,7 +1,17 @@
 ''' Tests for the download module. '''
 from django.test import TestCase
 from django.core.management import call_command
-from data_pipeline.download import HTTPDownload, FTPDownload, MartDownload
+from data_pipeline.download import HTTPDownload, FTPDownload, MartDownload, Download
+from data_pipeline.helper.pubs import RateLimiter, Pubs
+from data_pipeline.helper.pub_cache import PubCache
+from data_pipeline.helper.medline import Medline
+from data_pipeline.helper.esearch import EsearchWindow
+from data_pipeline.helper.pmid_index import PmidIndex
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import configparser
+import datetime
+import threading
 from django.utils.six import StringIO
 from elastic.elastic_settings import ElasticSettings
 import os
@@ -10,6 +20,13 @@ import data_pipeline
 from data_pipeline.utils import IniParser
 from elastic.search import Search, ElasticQuery
 import shutil
+import gzip
+import json
+import time
+import tempfile
+import io
+from requests.packages.urllib3.exceptions import ProtocolError
+import xml.etree.ElementTree as ET
 
 IDX_SUFFIX = ElasticSettings.getattr('TEST')
 MY_PUB_INI_FILE = os.path.join(os.path.dirname(__file__), IDX_SUFFIX + '_test_publication.ini')
@@ -118,3 +135,273 @@ class DownloadTest(TestCase):
                                   query_filter=query_filter,
                                   tax='hsapiens_gene_ensembl', attrs=attrs),
             'Mart download')
+
+
+class RateLimiterTest(TestCase):
+
+    def test_rate(self):
+        ''' Test the eutils request rate limiter spaces out requests. '''
+        rate_limiter = RateLimiter(10)
+        start = time.time()
+        for _ in range(6):
+            rate_limiter.wait()
+        self.assertGreaterEqual(time.time() - start, 0.45)
+
+
+class PubmedParseTest(TestCase):
+    ''' Test parsing recorded eutils efetch XML. '''
+    XML_FILE = os.path.join(TEST_DATA_DIR, 'DOWNLOAD', 'PUBMED', 'efetch_test.xml')
+
+    def test_iterparse(self):
+        ''' Test the incremental parser returns each article and book article. '''
+        pubs = {pub['pmid']: pub for pub in Pubs.iterparse(self.XML_FILE)}
+        self.assertEqual(len(pubs), 5)
+        self.assertEqual(pubs['25905407']['journal'], 'Nat. Genet.')
+        self.assertEqual(pubs['25905407']['date'], '2015-04-22')
+        self.assertEqual(pubs['25905407']['authors'][0], {'name': 'John A Smith', 'initials': 'JA'})
+        self.assertEqual(pubs['1476675']['journal'], 'Journal of clinical immunology')
+        self.assertEqual(pubs['20301779']['title'], 'Celiac Disease.')
+        self.assertEqual(pubs['20301779']['date'], '2008-07-03')
+
+    def test_medline_dates(self):
+        ''' Test conversion of MedlineDate formats. '''
+        dates = {'1999 May-Jun': '1999-05-01', '1992 Summer-Fall': '1992-06-01',
+                 '2010 May 26-Jun 1': '2010-05-26', '1978-1979': '1978-01-01',
+                 '1981 3rd Quart': '1981-07-01', '2000Jun 8-21': '2000-06-01'}
+        for medline_date, date in dates.items():
+            pub_obj = {'pmid': '1'}
+            Pubs.get_date(pub_obj, ET.fromstring('<PubDate><MedlineDate>%s</MedlineDate></PubDate>' % medline_date))
+            self.assertEqual(pub_obj['date'], date, medline_date)
+
+    def test_benchmark_parse(self):
+        ''' Test the parsing benchmark on the recorded XML. '''
+        stats = Pubs.benchmark_parse(self.XML_FILE, repeat=2)
+        self.assertEqual(stats['records'], 10)
+        self.assertGreater(stats['records_per_second'], 0)
+
+    def test_efetch_stream_error(self):
+        ''' Test a chunk is fetched again when reading the response stream fails. '''
+        xml_file = self.XML_FILE
+
+        class DroppedStream(io.RawIOBase):
+            def readinto(self, b):
+                raise ProtocolError('Connection broken')
+
+        class FakeResponse(object):
+            def __init__(self, raw):
+                self.status_code = 200
+                self.raw = raw
+
+            def close(self):
+                self.raw.close()
+
+        class FakeSession(object):
+            def __init__(self):
+                self.requests = 0
+
+            def get(self, url, timeout=None, stream=False):
+                self.requests += 1
+                return FakeResponse(DroppedStream() if self.requests == 1 else open(xml_file, 'rb'))
+
+        session = FakeSession()
+        pubs = Pubs._efetch(['25905407'], session, RateLimiter(100), retries=1)
+        self.assertEqual(session.requests, 2)
+        self.assertEqual(len(pubs), 5)
+
+
+class PmidIndexTest(TestCase):
+    ''' Test the PMID membership index. '''
+
+    def test_new(self):
+        ''' Test PMIDs not in the index are found in list order. '''
+        pmid_index = PmidIndex(['25905407', '1476675', '10250814', '1476675'])
+        self.assertEqual(len(pmid_index), 3)
+        self.assertEqual(pmid_index.new(['99999999', '1476675', '1', '25905407', '30000000']),
+                         ['99999999', '1', '30000000'])
+        self.assertEqual(list(pmid_index.contains(['10250814', '10250815'])), [True, False])
+        self.assertEqual(PmidIndex([]).new(['1', '2']), ['1', '2'])
+
+    def test_add(self):
+        ''' Test loaded PMIDs are merged into the sorted array. '''
+        pmid_index = PmidIndex(['25905407', '1476675'])
+        self.assertEqual(pmid_index.add(['10250814', '1476675', '30000000']), 2)
+        self.assertEqual(list(pmid_index.pmids), [1476675, 10250814, 25905407, 30000000])
+        self.assertEqual(pmid_index.new(['10250814', '2']), ['2'])
+
+
+class PubCacheTest(TestCase):
+    ''' Test the local publication record cache. '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cache(self):
+        ''' Test records are returned by PMID and stale records are not. '''
+        cache = PubCache(os.path.join(self.tmp_dir, 'CACHE', 'pubmed_cache.db'))
+        cache.put(Pubs.iterparse(PubmedParseTest.XML_FILE))
+        self.assertEqual(cache.count(), 5)
+        pubs = cache.get(['25905407', '1476675', '123'])
+        self.assertEqual(sorted(pubs.keys()), ['1476675', '25905407'])
+        self.assertEqual(pubs['25905407']['journal'], 'Nat. Genet.')
+        cache.close()
+
+        cache = PubCache(os.path.join(self.tmp_dir, 'CACHE', 'pubmed_cache.db'), max_age=-1)
+        self.assertEqual(cache.get(['25905407']), {})
+        cache.close()
+
+    def test_fetch_disease_codes(self):
+        ''' Test cached records are tagged with the disease codes for each PMID. '''
+        cache = PubCache(os.path.join(self.tmp_dir, 'CACHE', 'pubmed_cache.db'))
+        cache.put(Pubs.iterparse(PubmedParseTest.XML_FILE))
+        stage_file = os.path.join(self.tmp_dir, 'disease_pub_batch.json')
+        disease_codes = {'25905407': ['t1d', 'ra'], '1476675': ['ms']}
+        Pubs.fetch_details(['1476675', '25905407', '1476675'], stage_file, disease_codes=disease_codes,
+                           cache=cache)
+        cache.close()
+        with open(stage_file) as f:
+            docs = json.load(f)['docs']
+        self.assertEqual([d['pmid'] for d in docs], ['1476675', '25905407'])
+        self.assertEqual(docs[0]['tags'], {'disease': ['ms'], 'source': 'auto'})
+        self.assertEqual(docs[1]['tags'], {'disease': ['t1d', 'ra'], 'source': 'auto'})
+
+
+class MedlineTest(TestCase):
+    ''' Test ingestion of the MEDLINE baseline and update files from a local mirror. '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        mirror = os.path.join(self.tmp_dir, 'mirror')
+        os.makedirs(os.path.join(mirror, 'baseline'))
+        os.makedirs(os.path.join(mirror, 'updatefiles'))
+        with open(PubmedParseTest.XML_FILE, 'rb') as f_in:
+            with gzip.open(os.path.join(mirror, 'baseline', 'pubmed18n0001.xml.gz'), 'wb') as f_out:
+                f_out.write(f_in.read())
+        with gzip.open(os.path.join(mirror, 'updatefiles', 'pubmed18n0002.xml.gz'), 'wt') as f_out:
+            f_out.write('<PubmedArticleSet><DeleteCitation><PMID Version="1">1476675</PMID>'
+                        '<PMID Version="1">999</PMID></DeleteCitation></PubmedArticleSet>')
+        self.mirror = 'file://' + mirror + '/'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_medline(self):
+        ''' Test listing download and parsing of the baseline and update files. '''
+        download_dir = os.path.join(self.tmp_dir, 'DOWNLOAD', 'PUBMED_BASELINE')
+        stage_dir = os.path.join(self.tmp_dir, 'STAGE', 'PUBMED_BASELINE')
+        os.makedirs(stage_dir)
+        Download().download_listing(self.mirror, r'\w+\.xml\.gz$', download_dir, sub_dirs='baseline, updatefiles')
+        self.assertEqual([os.path.basename(f) for f in Medline.list_files(download_dir)],
+                         ['pubmed18n0001.xml.gz', 'pubmed18n0002.xml.gz'])
+
+        stage_file = os.path.join(stage_dir, 'pubmed_medline.json')
+        (count, deleted) = Medline.parse(download_dir, stage_file, pmids={'25905407', '1476675', '20301779'},
+                                         processes=2)
+        self.assertEqual((count, deleted), (2, 1))
+        with open(stage_file) as f:
+            docs = json.load(f)['docs']
+        self.assertEqual([d['pmid'] for d in docs], ['20301779', '25905407'])
+        with open(os.path.join(stage_dir, Medline.DELETED_FILE)) as f:
+            self.assertEqual(f.read().split(), ['1476675'])
+
+        # files are parsed again until they are recorded as loaded then skipped
+        self.assertEqual(Medline.parse(download_dir, stage_file, processes=1), (4, 2))
+        self.assertEqual(Medline.record_processed(stage_dir), 2)
+        self.assertEqual(Medline.parse(download_dir, stage_file, processes=1), (0, 0))
+
+
+class EsearchHandler(BaseHTTPRequestHandler):
+    ''' Local eutils esearch stand-in returning a PMID per day since the mindate. '''
+    PMIDS = {'2016/04/01': '100', '2016/04/15': '200', '2016/05/01': '300'}
+    requests = []
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        EsearchHandler.requests.append(params)
+        mindate = params['mindate'][0] if 'mindate' in params else '0000/00/00'
+        ids = ''.join('<Id>'+pmid+'</Id>' for (edat, pmid) in sorted(EsearchHandler.PMIDS.items())
+                      if edat >= mindate)
+        body = ('<eSearchResult><IdList>'+ids+'</IdList></eSearchResult>').encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class EsearchWindowTest(TestCase):
+    ''' Test incremental EDAT windows for esearch downloads. '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), EsearchHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        EsearchHandler.requests = []
+        self.config = configparser.ConfigParser(interpolation=configparser.ExtendedInterpolation())
+        self.config.read_string("""
+[DISEASE]
+location: http://127.0.0.1:%s/esearch.fcgi
+params: db=pubmed&rettype=uilist
+incremental: true
+
+[DISEASE::T1D]
+http_params: ${DISEASE:params}&term=("Diabetes+Mellitus,+Type+1"[Mesh])
+output: disease_pub_t1d.txt
+""" % self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _download(self, full=False):
+        download = Download(full=full)
+        section_dir_name = download._inherit_section('DISEASE::T1D', self.config)
+        dir_path = os.path.join(self.tmp_dir, 'DOWNLOAD', section_dir_name)
+        self.assertTrue(download.process_section('DISEASE::T1D', section_dir_name, self.tmp_dir,
+                                                 dir_path=dir_path, section=self.config['DISEASE::T1D'],
+                                                 stage='Download', config=self.config))
+        download_file = os.path.join(dir_path, 'disease_pub_t1d.txt')
+        tree = ET.parse(download_file)
+        return (download_file, [i.text for i in tree.find('IdList').iter('Id')])
+
+    def test_windows(self):
+        ''' Test only the PMIDs since the last run are requested unless a full sweep is asked for. '''
+        (download_file, pmids) = self._download()
+        self.assertNotIn('mindate', EsearchHandler.requests[-1])
+        self.assertEqual(pmids, ['100', '200', '300'])
+
+        # not recorded until the PMIDs have been fetched
+        (download_file, pmids) = self._download()
+        self.assertNotIn('mindate', EsearchHandler.requests[-1])
+
+        state = EsearchWindow.read(download_file)
+        state['window']['maxdate'] = '2016/04/15'
+        EsearchWindow._write(download_file, state)
+        EsearchWindow.fetched(download_file, 3)
+        EsearchWindow.record(download_file)
+        (download_file, pmids) = self._download()
+        params = EsearchHandler.requests[-1]
+        self.assertEqual(params['mindate'], ['2016/04/15'])
+        self.assertEqual(params['maxdate'], [datetime.date.today().strftime(EsearchWindow.DATE_FORMAT)])
+        self.assertEqual(params['datetype'], ['edat'])
+        self.assertEqual(pmids, ['200', '300'])
+
+        # not recorded until the PMIDs have been loaded
+        EsearchWindow.fetched(download_file, 1)
+        self.assertEqual(EsearchWindow.read(download_file)['last_run'], '2016/04/15')
+        EsearchWindow.record(download_file)
+        self.assertEqual(EsearchWindow.read(download_file)['added'], 1)
+
+        # the next window overlaps the last one
+        (download_file, pmids) = self._download()
+        self.assertEqual(EsearchHandler.requests[-1]['mindate'], ['2016/04/15'])
+        self.assertEqual(pmids, ['200', '300'])
+
+        (download_file, pmids) = self._download(full=True)
+        self.assertNotIn('mindate', EsearchHandler.requests[-1])
+        self.assertEqual(pmids, ['100', '200', '300'])
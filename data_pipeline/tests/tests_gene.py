@@ -9,9 +9,15 @@ import logging
 from data_pipeline.helper.gene_interactions import GeneInteractions
 import json
 import re
+import math
+import tempfile
 from data_pipeline.helper.gene import Gene
+from data_pipeline.helper.gene_assembly import GeneAssembly
+from data_pipeline.helper.gene_id_map import GeneIdMap
+from data_pipeline.helper.gene_history import GeneHistory
 from data_pipeline.utils import IniParser
 from data_pipeline.helper.gene_pathways import GenePathways
+from data_pipeline.helper.gene_enrichment import GeneEnrichment
 from elastic.elastic_settings import ElasticSettings
 import requests
 from elastic.search import Search
@@ -206,6 +212,14 @@ class GenePathwayStagingTest(TestCase):
                          'Got right pathway name')
         self.assertEquals(len(json_data['gene_sets']), 3, "Found 3 Genes in gene_sets")
 
+        gene_pathways_file = self.test_data_dir + '/STAGE/MSIGDB/' + GenePathways.GENE_PATHWAYS_FILE
+        self.assertTrue(os.path.isfile(gene_pathways_file))
+        with open(gene_pathways_file, 'r') as f:
+            gene_pathways = json.load(f)['docs']
+        gene_pathway = [doc for doc in gene_pathways if doc['_id'] == json_data['gene_sets'][0]][0]
+        self.assertIn('REACTOME_APOPTOTIC_CLEAVAGE_OF_CELLULAR_PROTEINS', gene_pathway['pathways'])
+        self.assertEqual(gene_pathway['count'], len(gene_pathway['pathways']))
+
 
 class GeneInteractionProcessTest(TestCase):
     '''Test functions in GeneInteractions class'''
@@ -339,6 +353,62 @@ class GeneConversionTest(TestCase):
         print(replaced_gene_sets)
         self.assertEqual(replaced_gene_sets, ['85452', '26191'], "Replaced 339457 with 85452")
 
+    def test_gene_history_chains(self):
+        '''Test discontinued gene ids are resolved through chains of changes'''
+        history = GeneHistory.parse(['9606\t5\t1\tA\t2000\n', '9606\t7\t5\tB\t2001\n',
+                                     '9606\t-\t9\tC\t2000\n', '9606\t9\t3\tD\t1999\n'])
+        self.assertEqual(history.remap(['1', '2', '3', '5']), ['7', '2', '7'])
+        self.assertEqual(history.changes(['1', '3', '4']), ({'1': '7'}, ['3']))
+
+        # ids in a cycle are discontinued
+        history = GeneHistory.parse(['9606\t11\t10\tE\t2000\n', '9606\t10\t11\tF\t2001\n',
+                                     '9606\t10\t12\tG\t2001\n', '9606\t14\t13\tH\t2001\n'])
+        self.assertEqual(history.remap(['10', '12', '13', '15']), ['14', '15'])
+
+    def test__pmid_genes(self):
+        '''Test the PMID to ensembl ids map built from gene2pubmed'''
+        genes = {'26191': {'pmids': ['1', '2']}, '85452': {'pmids': ['2']}, '188': {'pmids': ['3']}}
+        entrez_ensembl = {'26191': ['ENSG00000134242'], '85452': ['ENSG00000163002', 'ENSG00000001']}
+        pmid_genes = Gene._pmid_genes(genes, entrez_ensembl)
+        self.assertEqual(pmid_genes, {'1': ['ENSG00000134242'],
+                                      '2': ['ENSG00000001', 'ENSG00000134242', 'ENSG00000163002']})
+
+    def test_gene_id_map(self):
+        '''Test the local entrez, ensembl and symbol id conversions'''
+        id_map = GeneIdMap.parse({'ENSG03': 'C', 'ENSG01': 'A', 'ENSG02': 'B'},
+                                 entrez={'ENSG01': '10', 'ENSG03': '10', 'ENSG02': '20'},
+                                 symbols={'10': 'AA'})
+        self.assertEqual(id_map.entrez_ensembl(['10', '20', '30', 'x']), {'10': 'ENSG01', '20': 'ENSG02'})
+        self.assertEqual(id_map.entrez_ensembls(['10']), {'10': ['ENSG01', 'ENSG03']})
+        self.assertEqual(id_map.ensembl_entrez(['ENSG02', 'ENSG04']), {'ENSG02': '20'})
+        self.assertEqual(id_map.symbol_ensembls(['AA', 'B']), {'AA': ['ENSG01', 'ENSG03'], 'B': ['ENSG02']})
+
+        with id_map:
+            self.assertEqual(Gene._ensembl_entrez_lookup(['ENSG01'], None), {'ENSG01': '10'})
+        self.assertIsNone(GeneIdMap.active)
+
+    def test_gene_assembly(self):
+        '''Test joining the gene downloads into gene docs'''
+        assembly = GeneAssembly({"docs": [{"_id": "ENSG01", "symbol": "A", "dbxrefs": {"ensembl": "ENSG01"}},
+                                          {"_id": "ENSG02", "symbol": "B", "dbxrefs": {"ensembl": "ENSG02"}}]})
+        self.assertEqual(assembly.gene2ensembl(['9606\t101\tENSG01\t\t\t\t\n', '10090\t5\tENSG02\t\t\t\t\n']), 1)
+        # conflicting entrez id is not added
+        self.assertEqual(assembly.ensmart_gene(['ENSG01\t999\tP1\t\n', 'ENSG02\t102\tP2\t\n']), 1)
+        assembly.gene_pub(['9606\t101\t1\n', '9606\t101\t2\n', '9606\t102\t3\n'])
+        self.assertEqual(assembly.entrez_ensembl, {'101': ['ENSG01'], '102': ['ENSG02']})
+        assembly.ensmart_homolog(['ENSG01\tENSMUSG01\t\n'], 'ensembl_gene_id, mmusculus_homolog_ensembl_gene, '
+                                                        'rnorvegicus_homolog_ensembl_gene')
+        assembly.gene_mgi(['MGI:11\tx\tx\tx\tx\tENSMUSG01\n'])
+
+        doc = assembly.docs['ENSG01']
+        self.assertEqual(doc['dbxrefs']['entrez'], '101')
+        self.assertEqual(doc['dbxrefs']['ensembl'], 'ENSG01')
+        self.assertNotIn('swissprot', doc['dbxrefs'])
+        self.assertEqual(doc['pmids'], ['1', '2'])
+        self.assertEqual(doc['dbxrefs']['orthologs']['mmusculus'], {'ensembl': 'ENSMUSG01', 'MGI': '11'})
+        self.assertEqual(assembly.docs['ENSG02']['dbxrefs']['entrez'], '102')
+        self.assertEqual(assembly.docs['ENSG02']['dbxrefs']['swissprot'], 'P2')
+
 
 class GenePathwayProcessTest(TestCase):
 
@@ -369,3 +439,50 @@ class GenePathwayProcessTest(TestCase):
         download_file_go = '/dunwich/scratch/prem/tmp/download/DOWNLOAD/MSIGDB/c5.all.v5.0.entrez.gmt'
         source = GenePathways._get_pathway_source(download_file_go)
         self.assertTrue(source == "GO", "Got back go as source")
+
+    def test__add_gene_pathways(self):
+        '''Test the gene keyed inverted index built from the pathway gene sets'''
+        gene_pathways = {}
+        GenePathways._add_gene_pathways(gene_pathways, 'KEGG_A', 'kegg', ['ENSG1', 'ENSG2', 'ENSG2'])
+        GenePathways._add_gene_pathways(gene_pathways, 'REACTOME_B', 'reactome', ['ENSG1'])
+        self.assertEqual(gene_pathways['ENSG1'], {"pathways": ['KEGG_A', 'REACTOME_B'],
+                                                  "sources": {'kegg': 1, 'reactome': 1}, "count": 2})
+        self.assertEqual(gene_pathways['ENSG2'], {"pathways": ['KEGG_A'], "sources": {'kegg': 1}, "count": 1})
+
+
+class GeneEnrichmentTest(TestCase):
+
+    def setUp(self):
+        '''Encode a small set of gene sets over a gene universe of 20 genes'''
+        self.genes = ['ENSG%02d' % i for i in range(20)]
+        self.tmp_dir = tempfile.mkdtemp()
+        stage_file = os.path.join(self.tmp_dir, 'test.gmt.json')
+        self.gene_sets = [self.genes[0:5], self.genes[3:12], self.genes[10:20] + ['ENSG_NOT_IN_UNIVERSE']]
+        with open(stage_file, 'w') as f:
+            json.dump({"docs": [{"pathway_name": "PATHWAY_" + str(i), "source": "kegg", "gene_sets": gene_set}
+                                for i, gene_set in enumerate(self.gene_sets)]}, f)
+        GeneEnrichment.build(self.genes, [stage_file], os.path.join(self.tmp_dir, 'ENRICHMENT'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hypergeometric(self):
+        '''Test the p-values and overlaps against the exact hypergeometric upper tail'''
+        enrichment = GeneEnrichment.load(os.path.join(self.tmp_dir, 'ENRICHMENT'))
+        self.assertEqual(list(enrichment.set_sizes), [5, 9, 10])
+        gene_lists = [self.genes[0:4], self.genes[2:15:2]]
+        (pvalues, overlaps) = enrichment.hypergeometric(gene_lists, batch_size=1, chunk_size=2)
+        N = len(self.genes)
+        for i, gene_list in enumerate(gene_lists):
+            for j, gene_set in enumerate(self.gene_sets):
+                K = len(set(gene_set) & set(self.genes))
+                n = len(gene_list)
+                k = len(set(gene_list) & set(gene_set))
+                self.assertEqual(overlaps[i, j], k)
+                exact = sum(self._comb(K, x) * self._comb(N - K, n - x)
+                            for x in range(k, min(n, K) + 1)) / self._comb(N, n)
+                self.assertAlmostEqual(pvalues[i, j], exact)
+        self.assertEqual(enrichment.top(self.genes[0:4], n=1)[0]['name'], 'PATHWAY_0')
+
+    def _comb(self, n, k):
+        return math.factorial(n) // (math.factorial(k) * math.factorial(n - k))
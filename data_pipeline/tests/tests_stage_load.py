@@ -9,6 +9,19 @@ from elastic.elastic_settings import ElasticSettings
 import requests
 from elastic.search import Search, ElasticQuery
 from data_pipeline.helper.gene import Gene
+from data_pipeline.helper.marker import ImmunoChip
+from data_pipeline.helper.rs_merge import RsMergeResolver
+from data_pipeline.helper.dbsnp import DbSNP
+from data_pipeline.helper.stages import StagedPipeline
+from data_pipeline.helper.bulk import BulkWriter, BulkIndexer, BatchSizer
+from data_pipeline.helper.elastic_client import ElasticClient
+from data_pipeline.helper.lookup_cache import LookupCache
+from data_pipeline.helper.index_rebuild import IndexRebuild
+from data_pipeline.helper.exceptions import PipelineError
+import io
+import configparser
+import tempfile
+import time
 import logging
 import json
 from elastic.query import Query, TermsFilter
@@ -120,6 +133,30 @@ class LoadTest(TestCase):
         docs = elastic.search().docs
         self.assertGreater(len(getattr(docs[0], "pmids")), 0)
 
+        ''' 5b. Add gene publication links and PMID counts to gene docs. '''
+        call_command('pipeline', '--steps', 'load', sections='GENE_PUBS::LINKS',
+                     dir=TEST_DATA_DIR, ini=MY_INI_FILE)
+        Search.index_refresh(idx)
+        docs = Search(ElasticQuery.query_string("PTPN22", fields=["symbol"]), idx=idx).search().docs
+        pmid_count = getattr(docs[0], "pmid_count")
+        self.assertGreater(pmid_count, 0)
+        self.assertIsNone(getattr(docs[0], "pmids", None))
+        (total, pmids) = Gene.gene_pub_links(idx, 'test_gene_pub', docs[0].doc_id(), size=5)
+        self.assertEqual(total, pmid_count)
+        self.assertEqual(len(pmids), min(5, pmid_count))
+        self.assertEqual(pmids, sorted(pmids, reverse=True))
+
+        ''' 5c. Reload the links, removing a link no longer in gene2pubmed. '''
+        writer = BulkWriter(idx, 'test_gene_pub')
+        writer.index({"pmid": 1}, doc_id=docs[0].doc_id() + '_1', parent=docs[0].doc_id())
+        writer.close()
+        call_command('pipeline', '--steps', 'load', sections='GENE_PUBS::LINKS',
+                     dir=TEST_DATA_DIR, ini=MY_INI_FILE)
+        Search.index_refresh(idx)
+        (total, pmids) = Gene.gene_pub_links(idx, 'test_gene_pub', docs[0].doc_id(), size=pmid_count + 1)
+        self.assertEqual(total, pmid_count)
+        self.assertNotIn(1, pmids)
+
         ''' 6. Add ortholog data. '''
         call_command('pipeline', '--steps', 'load', sections='ENSMART_HOMOLOG',
                      dir=TEST_DATA_DIR, ini=MY_INI_FILE)
@@ -195,3 +232,316 @@ class LoadTest(TestCase):
             self.assertTrue(k in map2, k)
             if 'type' in map1[k]:
                 self.assertEqual(map1[k]['type'], map2[k]['type'], k)
+
+
+class StagedPipelineTest(TestCase):
+
+    def test_run(self):
+        ''' Test batches pass through the stages in order and are counted. '''
+        loaded = []
+        stages = StagedPipeline([('double', lambda b: [i * 2 for i in b]),
+                                 ('load', lambda b: loaded.extend(b) or b)], maxsize=2)
+        stats = stages.run(([i, i + 1] for i in range(0, 100, 2)))
+        self.assertEqual(loaded, [i * 2 for i in range(100)])
+        for name in ['parse', 'double', 'load']:
+            self.assertEqual(stats[name]['batches'], 50)
+            self.assertEqual(stats[name]['items'], 100)
+
+    def test_error(self):
+        ''' Test a failing stage stops the pipeline. '''
+        def fail(batch):
+            raise ValueError('bad batch')
+        stages = StagedPipeline([('fail', fail), ('load', lambda b: b)], maxsize=1)
+        self.assertRaises(PipelineError, stages.run, ([i] for i in range(1000)))
+
+    def test_ic_batches(self):
+        ''' Test the immunochip rows are batched consistently including the last batch. '''
+        row = '\t'.join(['imm_1_1', 'A', 'G', '\\N', '\\N', '\\N', '\\N', 'rs1', '1', '1', '2', '1',
+                         '3', '1', '\\N', '10', 'imm_1_1', '+', '\\N'])
+        ic_f = io.StringIO('ilmn_id\n' + '\n'.join([row] * 7) + '\n')
+        batches = list(ImmunoChip._ic_batches(ic_f, 3))
+        self.assertEqual([len(b) for b in batches], [3, 3, 1])
+        self.assertEqual(batches[2][0]['id'], 'rs1')
+
+
+class ElasticClientTest(TestCase):
+
+    def test_nodes(self):
+        ''' Test a node that cannot be connected to is marked down and the next node used. '''
+        client = ElasticClient(nodes=['http://127.0.0.1:1', ElasticSettings.url()], compress=False)
+        for _ in range(3):
+            resp = client.request('GET', '/')
+            self.assertEqual(resp.status_code, 200)
+        self.assertFalse(client.health['http://127.0.0.1:1']['up'])
+        self.assertEqual(client.health['http://127.0.0.1:1']['failures'], 1)
+        self.assertEqual(client.health[ElasticSettings.url().rstrip('/')]['requests'], 3)
+        self.assertEqual(ElasticClient.path('idx', 'type', '_search'), '/idx/type/_search')
+
+    def test_parallel(self):
+        ''' Test batches run in parallel are consumed in order. '''
+        results = ElasticClient._parallel(lambda batch: [i * 2 for i in batch], [[1, 2], [3], [4, 5], [6]], 2)
+        self.assertEqual(list(results), [[2, 4], [6], [8, 10], [12]])
+        self.assertEqual(ElasticClient._source_params(False), {"_source": "false"})
+        self.assertEqual(ElasticClient._source_params(['a', 'b']), {"_source": "a,b"})
+
+
+class LookupCacheTest(TestCase):
+
+    def test_lru(self):
+        ''' Test the least recently used entries are evicted past the memory cap. '''
+        cache = LookupCache(max_bytes=30)
+        cache.indices['idx'] = ('idx_1',)
+        cache._put(cache._key('idx', 'a'), ['x' * 8])
+        cache._put(cache._key('idx', 'b'), ['y' * 8])
+        self.assertEqual(cache._get(cache._key('idx', 'a')), ['x' * 8])
+        cache._put(cache._key('idx', 'c'), ['z' * 8])
+        self.assertIsNone(cache._get(cache._key('idx', 'b')))
+        self.assertEqual(cache.stats['evictions'], 1)
+        self.assertEqual((cache.stats['hits'], cache.stats['misses']), (1, 1))
+
+        LookupCache._cache = cache
+        cache.indices['idx_1'] = ('idx_1',)
+        cache._put(cache._key('idx', 'a'), ['x' * 8])
+        LookupCache.invalidate('idx_1')
+        self.assertIsNone(cache._get(cache._key('idx', 'a')))
+        LookupCache.close()
+
+
+class IndexRebuildTest(TestCase):
+
+    def test_versions(self):
+        ''' Test the versions of an alias and those kept when a new version is loaded. '''
+        v1 = IndexRebuild.version_name('genes', time.strptime('20160101120000', IndexRebuild.VERSION_FORMAT))
+        self.assertEqual(v1, 'genes_20160101120000')
+        indices = ['genes_20160301120000', 'genes', v1, 'genes_history_20160101120000', 'genes_20160201120000']
+        versions = IndexRebuild.versions('genes', indices)
+        self.assertEqual(versions, [v1, 'genes_20160201120000', 'genes_20160301120000'])
+        self.assertEqual(IndexRebuild.to_delete(versions, 'genes_20160301120000', 1), [v1])
+        self.assertEqual(IndexRebuild.to_delete(versions, 'genes_20160301120000', 2), [])
+        self.assertEqual(IndexRebuild.to_delete(versions, 'genes_20160201120000', 0), [v1])
+
+    def test_members(self):
+        ''' Test the sections of a rebuild include all those loading the index. '''
+        config = configparser.ConfigParser()
+        config.read_string('[DEFAULT]\nIDX=pubs\n[GENE]\nindex: pubs\n[DISEASE]\nindex: pubs\n'
+                           '[DISEASE::T1D]\noutput: t1d\n[DISEASE::MS]\noutput: ms\n'
+                           '[DISEASE_BATCH]\nsections: DISEASE\nindex: pubs\n[OTHER]\nindex: other\n'
+                           '[REBUILD]\nrebuild: GENE, DISEASE\nindex: pubs\n')
+        for name in config.sections():
+            IniParser()._inherit_section(name, config)
+        self.assertEqual(IndexRebuild.members(config, 'REBUILD'), ['GENE', 'DISEASE::T1D', 'DISEASE::MS'])
+        config['REBUILD']['rebuild'] = 'DISEASE_BATCH'
+        self.assertRaises(PipelineError, IndexRebuild.members, config, 'REBUILD')
+        config['REBUILD']['rebuild'] = 'GENE, DISEASE_BATCH'
+        self.assertEqual(IndexRebuild.members(config, 'REBUILD'), ['GENE', 'DISEASE_BATCH'])
+
+
+class FakeBulkClient(object):
+    ''' Stand-in for L{ElasticClient} answering each bulk request with the next list of
+    item statuses. '''
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.sent = []
+
+    def request(self, method, path, data=None, params=None, timeout=None):
+        actions = [json.loads(action.split(b'\n')[0].decode()) for action in BulkIndexer._split_actions(data)]
+        self.sent.append(len(actions))
+        items = []
+        for action, status in zip(actions, self.statuses.pop(0)):
+            item = {"status": status}
+            if status >= 300:
+                item["error"] = {"type": "test_exception"}
+            items.append({list(action.keys())[0]: item})
+        resp = requests.models.Response()
+        resp.status_code = 200
+        resp._content = json.dumps({"errors": any('error' in list(i.values())[0] for i in items),
+                                    "items": items}).encode()
+        return resp
+
+
+class BulkWriterTest(TestCase):
+
+    def tearDown(self):
+        ElasticClient._client = None
+
+    def test_flush(self):
+        ''' Test requests are cut by the number of documents and size in bytes. '''
+        sent = []
+        writer = BulkWriter('idx', 'type', max_docs=3, max_bytes=200, send=lambda data, n: sent.append((data, n)))
+        for i in range(4):
+            writer.update(str(i), {'a': i})
+        writer.delete('4')
+        writer.upsert('5', {'b': 1})
+        writer.index({'c': 'x' * 300}, doc_id='6')
+        self.assertEqual(writer.close(), 7)
+        self.assertTrue(all(len(data) <= 200 for (data, n) in sent[:-1]))
+        self.assertEqual(sum(n for (data, n) in sent), 7)
+
+        lines = b''.join(data for (data, n) in sent).decode().splitlines()
+        self.assertEqual(json.loads(lines[0]), {"update": {"_index": "idx", "_type": "type", "_id": "0",
+                                                           "_retry_on_conflict": 3}})
+        self.assertEqual(json.loads(lines[1]), {"doc": {"a": 0}})
+        self.assertEqual(json.loads(lines[8]), {"delete": {"_index": "idx", "_type": "type", "_id": "4"}})
+        self.assertEqual(json.loads(lines[10]), {"doc": {"b": 1}, "doc_as_upsert": True})
+
+        # split into the lines for each item (to retry those that are rejected)
+        actions = BulkIndexer._split_actions(b''.join(data for (data, n) in sent))
+        self.assertEqual(len(actions), 7)
+        self.assertEqual(actions[4], b'{"delete": {"_index": "idx", "_type": "type", "_id": "4"}}\n')
+
+    def test_retry(self):
+        ''' Test rejected items are retried with a backoff and items that fail raise an error. '''
+        ElasticClient._client = FakeBulkClient([[200, 429, 429], [429, 200], [200]])
+        indexer = BulkIndexer(workers=0, backoff=0.001)
+        writer = BulkWriter('idx', 'type', send=lambda data, n: indexer.bulk_load('idx', 'type', data, n))
+        for i in range(3):
+            writer.index({'a': i}, doc_id=str(i))
+        writer.close()
+        self.assertEqual(ElasticClient._client.sent, [3, 2, 1])
+        self.assertEqual((indexer.stats['docs'], indexer.stats['retried'], indexer.stats['failed']), (3, 3, 0))
+
+        # version conflicts are only retried for updates, missing docs are not failures
+        ElasticClient._client = FakeBulkClient([[409, 409, 404], [200]])
+        writer = BulkWriter('idx', 'type', send=lambda data, n: indexer.bulk_load('idx', 'type', data, n))
+        writer.update('0', {'a': 1})
+        writer.index({'a': 2}, doc_id='1')
+        writer.update('2', {'a': 3})
+        self.assertRaises(PipelineError, writer.close)
+        self.assertEqual(ElasticClient._client.sent, [3, 1])
+        self.assertEqual((indexer.stats['failed'], indexer.stats['missing']), (1, 1))
+
+        # items still rejected after the retries fail the join (e.g. before a shard is recorded)
+        ElasticClient._client = FakeBulkClient([[429]] * 3)
+        indexer = BulkIndexer(workers=1, retries=2, backoff=0.001).start()
+        indexer.bulk_load('idx', 'type', b'{"delete": {"_id": "1"}}\n', 1)
+        self.assertRaises(PipelineError, indexer.join)
+        self.assertEqual(ElasticClient._client.sent, [1, 1, 1])
+        self.assertRaises(PipelineError, indexer.close)
+
+    def test_batch_sizer(self):
+        ''' Test the batch size grows with headroom and shrinks on rejections or slow requests. '''
+        sizer = BatchSizer(size=1000, min_size=50, max_size=1200, target_seconds=1.0)
+        self.assertEqual(sizer.update(1000, 0.2), 1100)
+        self.assertEqual(sizer.update(1100, 0.2), 1200)
+        self.assertEqual(sizer.update(10, 0.1), 1200)
+        self.assertEqual(sizer.update(1200, 2.0), 600)
+        self.assertEqual(sizer.update(600, 0.7), 600)
+        self.assertEqual(sizer.update(600, 0.1, rejected=True), 300)
+        for _ in range(5):
+            sizer.update(300, 0.1, rejected=True)
+        self.assertEqual(sizer.size, 50)
+
+
+class RsMergeResolverTest(TestCase):
+    ''' Test resolving merged rs ids from the RsMergeArch arrays. '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.merge_file = os.path.join(TEST_DATA_DIR, 'DOWNLOAD', 'RSMERGEARCH', 'rs_merge_test.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_resolve(self):
+        ''' Test merged ids resolve to the current id and are memory-mapped when loaded. '''
+        RsMergeResolver.build_file(self.merge_file, self.tmp_dir)
+        resolver = RsMergeResolver.load(self.tmp_dir, merge_file=self.merge_file)
+        self.assertEqual(len(resolver), 15)
+        (current, merged, build) = resolver.resolve(['rs60104027', 'rs2476601', 'rs140091539'])
+        self.assertEqual(list(current), [2476601, 2476601, 11383177])
+        self.assertEqual(list(merged), [True, False, True])
+        self.assertEqual(build[0], 130)
+
+    def test_chains(self):
+        ''' Test chains of merges are collapsed to the id current now. '''
+        merge_f = io.StringIO("10\t5\t130\t0\t\t\t20\t0\t\n20\t5\t131\t0\t\t\t30\t0\t\n"
+                              "30\t5\t140\t0\t\t\t40\t0\t\n50\t5\t140\t0\t\t\t\t0\t\n")
+        resolver = RsMergeResolver.parse(merge_f)
+        (current, merged, build) = resolver.resolve(['rs10', 'rs20', 'rs40', 'rs50'])
+        self.assertEqual(list(current), [40, 40, 40, 0])
+        self.assertEqual(list(merged), [True, True, False, True])
+
+    def test_check_rs_ids(self):
+        ''' Test immunochip marker ids are replaced by the current id. '''
+        resolver = RsMergeResolver.build_file(self.merge_file, self.tmp_dir)
+        new_docs = [{'id': 'rs60104027', 'synonyms': ['imm_1_1']}, {'id': 'rs2476601'}, {'id': 'rs60104027'}]
+        ImmunoChip.check_rs_ids(['rs60104027', 'rs2476601', 'rs60104027'], new_docs, resolver=resolver)
+        self.assertEqual(new_docs[0], {'id': 'rs2476601', 'internal_id': 2476601,
+                                       'synonyms': ['imm_1_1', 'rs60104027']})
+        self.assertEqual(new_docs[1], {'id': 'rs2476601'})
+        self.assertEqual(new_docs[2]['synonyms'], ['rs60104027'])
+
+
+class DbSNPTest(TestCase):
+    ''' Test the native (tabix sharded) dbSNP marker loading. '''
+    VCF_FILE = os.path.join(TEST_DATA_DIR, 'DOWNLOAD', 'DBSNP', 'dbsnp144_test_bgzf.vcf.gz')
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shards(self):
+        ''' Test the VCF is split by chromosome using the tabix index. '''
+        shards = DbSNP.shards(self.VCF_FILE)
+        self.assertEqual([s[0] for s in shards], ['1', '2', 'X'])
+        ids = {}
+        for shard in shards:
+            docs = [DbSNP.marker_doc(line) for line in DbSNP.shard_lines(self.VCF_FILE, shard)]
+            self.assertTrue(all(doc['seqid'] == shard[0] for doc in docs))
+            ids[shard[0]] = [doc['id'] for doc in docs]
+        self.assertEqual(ids['1'], ['rs775809821', 'rs768019142', 'rs2476601'])
+        self.assertEqual(len(ids['2']) + len(ids['X']), 5)
+
+        # gzip (not BGZF) files are a single shard
+        vcf_file = os.path.join(TEST_DATA_DIR, 'DOWNLOAD', 'DBSNP', 'dbsnp144_test.vcf.gz')
+        shards = DbSNP.shards(vcf_file)
+        self.assertEqual(shards, [('all', None, None, None)])
+        lines = DbSNP.shard_lines(vcf_file, shards[0])
+        self.assertEqual(len([doc for doc in map(DbSNP.marker_doc, lines) if doc is not None]), 3)
+
+    def test_regions(self):
+        ''' Test only markers in the regions are read, seeking with the tabix index. '''
+        regions = DbSNP.parse_regions('1:10050-10060, 2:191000000-205000000, 1:113834946-113834946, 7:1-100')
+        self.assertEqual(regions, [('1', 10050, 10060), ('1', 113834946, 113834946),
+                                   ('2', 191000000, 205000000), ('7', 1, 100)])
+        shards = DbSNP.shards(self.VCF_FILE, regions)
+        self.assertEqual([s[0] for s in shards], ['1:10050-10060', '1:113834946-113834946', '2:191000000-205000000'])
+        ids = [DbSNP.marker_doc(line)['id'] for shard in shards for line in DbSNP.shard_lines(self.VCF_FILE, shard)]
+        self.assertEqual(ids, ['rs768019142', 'rs2476601', 'rs7574865', 'rs3087243'])
+
+        # without the tabix index the whole file is filtered
+        vcf_file = os.path.join(TEST_DATA_DIR, 'DOWNLOAD', 'DBSNP', 'dbsnp144_test.vcf.gz')
+        shard = DbSNP.shards(vcf_file, regions)[0]
+        lines = DbSNP.shard_lines(vcf_file, shard, regions=regions)
+        self.assertEqual([DbSNP.marker_doc(line)['id'] for line in lines], ['rs768019142', 'rs2476601'])
+
+        bed_file = os.path.join(self.tmp_dir, 'regions.bed')
+        with open(bed_file, 'w') as f:
+            f.write('track name=test\n1\t10018\t10019\n1\t10019\t10030\n')
+        self.assertEqual(DbSNP.read_bed(bed_file), [('1', 10019, 10030)])
+
+    def test_load(self):
+        ''' Test the shards are loaded in parallel and not reloaded. '''
+        INI_CONFIG = IniParser().read_ini(MY_INI_FILE)
+        idx = INI_CONFIG['DBSNP']['index']
+        idx_type = 'test_marker_native'
+        self.assertEqual(DbSNP.load(self.VCF_FILE, idx, idx_type, self.tmp_dir, processes=2, chunk_size=2), 8)
+        Search.index_refresh(idx)
+        self.assertEqual(Search(idx=idx, idx_type=idx_type).get_count()['count'], 8)
+        self.assertEqual(DbSNP.load(self.VCF_FILE, idx, idx_type, self.tmp_dir, processes=2), 0)
+
+    def test_load_bulk_indexer(self):
+        ''' Test the bulk requests are sent by a L{BulkIndexer} when one is active. '''
+        INI_CONFIG = IniParser().read_ini(MY_INI_FILE)
+        idx = INI_CONFIG['DBSNP']['index']
+        idx_type = 'test_marker_bulk'
+        with BulkIndexer(workers=2) as indexer:
+            self.assertEqual(DbSNP.load(self.VCF_FILE, idx, idx_type, self.tmp_dir, processes=2, chunk_size=2), 8)
+        self.assertEqual(indexer.stats['docs'], 8)
+        self.assertEqual(indexer.stats['batches'], 5)
+        self.assertIsNone(BulkIndexer.active)
+        Search.index_refresh(idx)
+        self.assertEqual(Search(idx=idx, idx_type=idx_type).get_count()['count'], 8)
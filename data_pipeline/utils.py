@@ -2,17 +2,28 @@
 import os
 import configparser
 import time
+from contextlib import ExitStack
 import xml.etree.ElementTree as ET
 
-from elastic.search import Search, ElasticQuery
-from elastic.query import Query, TermsFilter
 from .helper.pubs import Pubs
+from .helper.pub_cache import PubCache
+from .helper.medline import Medline
+from .helper.esearch import EsearchWindow
+from .helper.pmid_index import PmidIndex
+from .helper.rs_merge import RsMergeResolver
+from .helper.dbsnp import DbSNP
+from .helper.bulk import BulkWriter, BulkIndexer
+from .helper.elastic_client import ElasticClient
+from .helper.gene_id_map import GeneIdMap
+from .helper.gene_history import GeneHistory
+from .helper.index_rebuild import IndexRebuild
+from .helper.lookup_cache import LookupCache
 import json
-from elastic.management.loaders.loader import Loader
 import re
 import gzip
 import logging
 from data_pipeline.helper.gene import Gene
+from data_pipeline.helper.gene_assembly import GeneAssembly
 from data_pipeline.helper.gene_interactions import GeneInteractions
 from data_pipeline.helper.gene_pathways import GenePathways
 from builtins import classmethod
@@ -52,23 +63,38 @@ class Monitor(object):
             self.previous = progress
 
 
-def process_wrapper(*args, **kwargs):
+def process_wrapper(*args, ini_tag=None, **kwargs):
     ''' Wrapper to call a defined function in the ini file. Depending on the
     stage (from the class L{Download}, L{Stage} or L{Load}) look for the ini
-    tag for that section. The tag defines the function name to be called. '''
+    tag for that section (unless an ini_tag is given). The tag defines the function
+    name to be called. '''
     section = kwargs['section']
-    ini_tag = None
-    if kwargs['stage'] == 'Download':
-        ini_tag = 'post'
-    elif kwargs['stage'] == 'Stage':
-        ini_tag = 'stage'
-    elif 'Load' in kwargs['stage']:
-        ini_tag = 'load'
+    if ini_tag is None:
+        if kwargs['stage'] == 'Download':
+            ini_tag = 'post'
+        elif kwargs['stage'] == 'Stage':
+            ini_tag = 'stage'
+        elif 'Load' in kwargs['stage']:
+            ini_tag = 'load'
 
     if ini_tag is not None:
         if ini_tag in section:
             post_func = getattr(globals()['PostProcess'], section[ini_tag])
-            post_func(*args, **kwargs)
+            with ExitStack() as stack:
+                if 'bulk_workers' in section:
+                    # send the bulk requests from a pool of threads
+                    stack.enter_context(BulkIndexer(workers=int(section['bulk_workers'])))
+                if 'gene_id_map' in section:
+                    # convert gene ids with a local map rather than searching the gene index
+                    id_map = GeneIdMap.for_sections(kwargs['config'], section['gene_id_map'].split(','), args[3])
+                    if id_map is not None:
+                        stack.enter_context(id_map)
+                if 'gene_history' in section:
+                    # resolve discontinued gene ids with the gene_history download
+                    history = GeneHistory.for_section(kwargs['config'], section['gene_history'], args[3])
+                    if history is not None:
+                        stack.enter_context(history)
+                post_func(*args, **kwargs)
 
 
 def post_process(func):
@@ -82,10 +108,18 @@ def post_process(func):
 
 
 def pre_process(func):
-    ''' Used as a decorator to apply L{PostProcess} functions. '''
+    ''' Used as a decorator to apply L{PostProcess} functions. The function named by
+    the loaded tag is called once the section has been loaded (e.g. to record the
+    files loaded so that they are not loaded again) or, in a rebuild, once the new
+    version of the index is in use (see L{IndexRebuild}). '''
     def wrapper(*args, **kwargs):
         process_wrapper(*args, **kwargs)
         success = func(*args, **kwargs)
+        if success:
+            if IndexRebuild.active is not None:
+                IndexRebuild.active.finished.append(lambda: process_wrapper(*args, ini_tag='loaded', **kwargs))
+            else:
+                process_wrapper(*args, ini_tag='loaded', **kwargs)
         return success
     return wrapper
 
@@ -150,7 +184,8 @@ class PostProcess(object):
         ''' Parse gene GTF file from ensembl. '''
         stage_file = cls._get_stage_file(*args, **kwargs)
         download_file = cls._get_download_file(*args, **kwargs)
-        Gene.gene_mapping(kwargs['section']['index'], kwargs['section']['index_type'])
+        section = kwargs['section']
+        Gene.gene_mapping(section['index'], section['index_type'], links_type=section.get('pub_links_type'))
         with gzip.open(download_file, 'rt') as ensembl_gene_f:
             with open(stage_file, 'w') as outfile:
                 json.dump(Gene.ensembl_gene_parse(ensembl_gene_f), outfile, indent=0)
@@ -186,15 +221,22 @@ class PostProcess(object):
         download_file = cls._get_download_file(*args, **kwargs)
         idx = kwargs['section']['index']
 
+        idx_type = kwargs['section']['index_type'] if 'index_type' in kwargs['section'] else 'gene'
         with gzip.open(download_file, 'rt') as gene_info_f:
-            Gene.gene_info_parse(gene_info_f, idx)
+            Gene.gene_info_parse(gene_info_f, idx, idx_type)
 
     @classmethod
     def gene_pub_parse(cls, *args, **kwargs):
         ''' Parse gene2pubmed file from NCBI. '''
         download_file = cls._get_download_file(*args, **kwargs)
+        section = kwargs['section']
+        pub_idx = section['pub_index'] if 'pub_index' in section else None
+        pub_idx_type = section['pub_index_type'] if 'pub_index_type' in section else 'publication'
         with gzip.open(download_file, 'rt') as gene_pub_f:
-            Gene.gene_pub_parse(gene_pub_f, kwargs['section']['index'])
+            Gene.gene_pub_parse(gene_pub_f, section['index'], pub_idx=pub_idx, pub_idx_type=pub_idx_type,
+                                cache_dir=os.path.join(args[3], 'CACHE'),
+                                links_type=section['pub_links_type'] if 'pub_links_type' in section else None,
+                                gene_idx_type=section['index_type'] if 'index_type' in section else 'gene')
 
     @classmethod
     def gene_history_parse(cls, *args, **kwargs):
@@ -210,15 +252,58 @@ class PostProcess(object):
         with open(download_file, 'rt') as gene_mgi_f:
             Gene.gene_mgi_parse(gene_mgi_f, kwargs['section']['index'])
 
+    @classmethod
+    def gene_assembly(cls, *args, **kwargs):
+        ''' Join the downloads of the gene sections into complete gene docs and index
+        them in a single pass (L{GeneAssembly}). '''
+        section = kwargs['section']
+        idx = section['index']
+        idx_type = section['index_type']
+        sections = [s.strip() for s in section['sections'].split(',') if s.strip() != '']
+        assembly = GeneAssembly.build(kwargs['config'], sections, os.path.join(args[3], 'DOWNLOAD'))
+        links_type = None
+        if assembly.pub_section is not None and 'pub_links_type' in assembly.pub_section:
+            links_type = assembly.pub_section['pub_links_type']
+        Gene.gene_mapping(idx, idx_type, links_type=links_type)
+        assembly.load(idx, idx_type)
+        assembly.load_pubs(idx, cache_dir=os.path.join(args[3], 'CACHE'), gene_idx_type=idx_type)
+
     ''' Marker downloads '''
     @classmethod
     def dbsnp_marker(cls, *args, **kwargs):
         ''' Parse dbSNP VCF and use elastic loader to index
-        (L{elastic.management.loaders.marker.MarkerManager}). '''
+        (L{elastic.management.loaders.marker.MarkerManager}) or, with the native
+        loader option, load the chromosomes in parallel (L{DbSNP}). The regions (or
+        regions_bed) option restricts loading to markers in those regions. '''
         download_file = cls._get_download_file(*args, **kwargs)
-        idx = kwargs['section']['index']
-        idx_type = kwargs['section']['index_type']
-        call_command('index_search', indexType=idx_type, indexSNP=download_file, indexName=idx)
+        section = kwargs['section']
+        idx = section['index']
+        idx_type = section['index_type']
+        regions = None
+        if 'regions' in section:
+            regions = DbSNP.parse_regions(section['regions'])
+        elif 'regions_bed' in section:
+            regions = DbSNP.read_bed(section['regions_bed'])
+
+        if regions is not None or ('loader' in section and section['loader'] == 'native'):
+            stage_dir = os.path.join(args[3], 'STAGE', args[2])
+            if IndexRebuild.active is not None:
+                # the new version has no shard state (it is keyed by index name)
+                if not ElasticClient.get().index_exists(idx):
+                    DbSNP.marker_mapping(idx, idx_type)
+            elif not os.path.exists(os.path.join(stage_dir, DbSNP.STATE_FILE)):
+                DbSNP.marker_mapping(idx, idx_type)
+            processes = int(section['load_workers']) if 'load_workers' in section else 4
+            DbSNP.load(download_file, idx, idx_type, stage_dir, processes=processes, regions=regions)
+        else:
+            call_command('index_search', indexType=idx_type, indexSNP=download_file, indexName=idx)
+            LookupCache.invalidate(idx)
+
+    @classmethod
+    def dbsnp_tbi(cls, *args, **kwargs):
+        ''' Download the tabix index (.tbi) of the dbSNP VCF. '''
+        section = kwargs['section']
+        args[0].download(section['location'] + '/' + section['files'].strip() + '.tbi', kwargs['dir_path'])
 
     @classmethod
     def dbsnp_merge(cls, *args, **kwargs):
@@ -228,58 +313,61 @@ class PostProcess(object):
         idx = kwargs['section']['index']
         idx_type = kwargs['section']['index_type']
         call_command('index_search', indexType=idx_type, indexSNPMerge=download_file, indexName=idx)
+        LookupCache.invalidate(idx)
+        RsMergeResolver.build_file(download_file, os.path.join(args[3], 'STAGE', args[2]))
 
     @classmethod
     def immunochip_mysql_2_idx(cls, *args, **kwargs):
         ''' Parse and load IC markers. '''
-        download_file = kwargs['section']['location']
-        idx = kwargs['section']['index']
-        idx_type = kwargs['section']['index_type']
+        section = kwargs['section']
+        download_file = section['location']
+        idx = section['index']
+        idx_type = section['index_type']
+        resolver = None
+        if 'rs_merge' in section:
+            # resolve merged rs ids with the RsMergeArch arrays built by dbsnp_merge
+            merge_section = kwargs['config'][section['rs_merge']]
+            resolver = RsMergeResolver.load(os.path.join(args[3], 'STAGE', section['rs_merge']),
+                                            merge_file=os.path.join(args[3], 'DOWNLOAD', section['rs_merge'],
+                                                                    merge_section['files']))
         ImmunoChip.ic_mapping(idx, idx_type)
         with open(download_file, 'rt') as ic_f:
-            ImmunoChip.immunochip_mysql_2_idx(ic_f, idx, idx_type)
+            stats = ImmunoChip.immunochip_mysql_2_idx(ic_f, idx, idx_type, resolver=resolver)
+        for name, stat in stats.items():
+            logger.debug("Immunochip " + name + ": " + str(stat))
 
     ''' Publication methods '''
     @classmethod
-    def get_new_pmids(cls, pmids, idx, disease_code=None):
-        ''' Find PMIDs in a list that are not in the elastic index. '''
-        chunk_size = 800
-        pmids_found = set()
-        pmids_found_add = pmids_found.add
-        time.sleep(5)
-
-        for i in range(0, len(pmids), chunk_size):
-            pmids_slice = pmids[i:i+chunk_size]
-            terms_filter = TermsFilter.get_terms_filter("pmid", pmids_slice)
-            query = ElasticQuery.filtered(Query.match_all(), terms_filter, sources=['pmid', 'tags'])
-
-            docs = Search(query, idx=idx, size=chunk_size).search().docs
-            json_data = ''
-
-            for doc in docs:
-                pmids_found_add(getattr(doc, 'pmid'))
-                if disease_code is not None:
-                    tags = getattr(doc, 'tags')
-                    if 'disease' in tags:
-                        disease = tags['disease']
-                    else:
-                        disease = []
-                    if disease_code not in disease:
-                        # update disease attribute
-                        disease.append(disease_code)
-                        tags['disease'] = disease
-                        idx_name = doc._meta['_index']
-                        idx_type = doc.type()
-
-                        doc_data = {"update": {"_id": doc._meta['_id'], "_type": idx_type,
-                                               "_index": idx_name, "_retry_on_conflict": 3}}
-                        json_data += json.dumps(doc_data) + '\n'
-                        json_data += json.dumps({'doc': {'tags': tags}}) + '\n'
-
-            if json_data != '':
-                Loader().bulk_load(idx_name, idx_type, json_data)
-
-        return [pmid for pmid in pmids if pmid not in pmids_found]
+    def get_new_pmids(cls, pmids, idx, disease_code=None, disease_codes=None, idx_type=None, cache_dir=None):
+        ''' Find PMIDs in a list that are not in the elastic index (see L{PmidIndex}). The
+        disease tags of the PMIDs found are updated with disease_code or, for a PMID:[disease
+        codes] dictionary (disease_codes), each with its own codes in a single bulk update. '''
+        pmid_index = PmidIndex.load(idx, cache_dir=cache_dir, idx_type=idx_type)
+        found = pmid_index.contains(pmids)
+        new_pmids = [pmid for pmid, f in zip(pmids, found) if not f]
+        if disease_code is None and disease_codes is None:
+            return new_pmids
+        if disease_code is not None:
+            disease_codes = {pmid: [disease_code] for pmid in pmids}
+
+        # only the documents found need their disease tags checked
+        pmids = [pmid for pmid, f in zip(pmids, found) if f and pmid in disease_codes]
+        writer = BulkWriter(idx, idx_type)
+        for hit in ElasticClient.get().terms(idx, "pmid", pmids, sources=['pmid', 'tags'], batch_size=800):
+            pmid = str(hit['_source']['pmid'])
+            tags = hit['_source'].get('tags', {})
+            if 'disease' in tags:
+                disease = tags['disease']
+            else:
+                disease = []
+            new_codes = [code for code in disease_codes[pmid] if code not in disease]
+            if len(new_codes) > 0:
+                # update disease attribute
+                disease.extend(new_codes)
+                tags['disease'] = disease
+                writer.update(hit['_id'], {'tags': tags}, idx=hit['_index'], idx_type=hit['_type'])
+        writer.close()
+        return new_pmids
 
     @classmethod
     def unique(cls, *args, **kwargs):
@@ -288,6 +376,20 @@ class PostProcess(object):
         stage_file = cls._get_stage_file(*args, **kwargs)
         download_file = cls._get_download_file(*args, **kwargs)
 
+        pmids = cls._gene2pubmed_pmids(download_file)
+        new_pmids = cls.get_new_pmids(list(pmids), section['index'], idx_type=section['index_type'],
+                                      cache_dir=os.path.join(args[3], 'CACHE'))
+        print(len(new_pmids))
+        options = cls._efetch_options(section, args[3])
+        try:
+            Pubs.fetch_details(new_pmids, stage_file, **options)
+        finally:
+            if 'cache' in options:
+                options['cache'].close()
+
+    @classmethod
+    def _gene2pubmed_pmids(cls, download_file):
+        ''' Get the set of human PMIDs in a gene2pubmed file. '''
         pmids = set()
         with gzip.open(download_file, 'rt') as outf:
             seen_add = pmids.add
@@ -297,9 +399,46 @@ class PostProcess(object):
                 pmid = re.split('\t', x)[2].strip()
                 if pmid not in pmids:
                     seen_add(pmid)
-        new_pmids = cls.get_new_pmids(list(pmids), section['index'])
-        print(len(new_pmids))
-        Pubs.fetch_details(new_pmids, stage_file)
+        return pmids
+
+    @classmethod
+    def medline_parse(cls, *args, **kwargs):
+        ''' Parse the MEDLINE baseline and update files (L{Medline}). If pmids_from names
+        a section with a gene2pubmed download only those PMIDs are staged. '''
+        section = kwargs['section']
+        stage_file = cls._get_stage_file(*args, **kwargs)
+        download_dir = os.path.join(args[3], 'DOWNLOAD', args[2])
+        pmids = None
+        if 'pmids_from' in section:
+            from_section = kwargs['config'][section['pmids_from']]
+            pmids = cls._gene2pubmed_pmids(os.path.join(args[3], 'DOWNLOAD', section['pmids_from'],
+                                                        from_section['files']))
+        processes = int(section['parse_workers']) if 'parse_workers' in section else 4
+        Medline.parse(download_dir, stage_file, pmids=pmids, processes=max(1, processes))
+
+    @classmethod
+    def medline_processed(cls, *args, **kwargs):
+        ''' Record the MEDLINE files staged by L{medline_parse} as processed once the
+        publications have been loaded and deleted. '''
+        Medline.record_processed(os.path.join(args[3], 'STAGE', args[2]))
+
+    @classmethod
+    def medline_delete(cls, *args, **kwargs):
+        ''' Remove the PMIDs deleted by the MEDLINE update files from the index. '''
+        section = kwargs['section']
+        deleted_file = os.path.join(os.path.dirname(cls._get_stage_file(*args, **kwargs)), Medline.DELETED_FILE)
+        if not os.path.exists(deleted_file) or not ElasticClient.get().index_exists(section['index']):
+            return
+        with open(deleted_file) as f:
+            pmids = [line.strip() for line in f if line.strip() != '']
+
+        idx = section['index']
+        idx_type = section['index_type']
+        writer = BulkWriter(idx, idx_type)
+        for pmid in pmids:
+            writer.delete(pmid)
+        writer.close()
+        logger.debug("No. publications deleted "+str(len(pmids)))
 
     @classmethod
     def zcat(cls, *args, **kwargs):
@@ -336,6 +475,12 @@ class PostProcess(object):
             config = kwargs['config']
         GenePathways.gene_pathway_parse(download_files, stage_output_file, section, config=config)
 
+    @classmethod
+    def gene_pathway_index(cls, *args, **kwargs):
+        ''' Load the gene keyed pathway index written when staging the pathways. '''
+        stage_dir = os.path.join(args[3], 'STAGE', args[2])
+        GenePathways.gene_pathway_index_load(stage_dir, kwargs['section'])
+
     @classmethod
     def xmlparse(cls, *args, **kwargs):
         ''' Parse XML from eutils. '''
@@ -346,20 +491,117 @@ class PostProcess(object):
         if download_file is None:
             return
 
-        tree = ET.parse(download_file)
-        idlist = tree.find("IdList")
-        ids = list(idlist.iter("Id"))
-        pmids = [i.text for i in ids]
+        pmids = cls._esearch_pmids(download_file)
         npmids = len(pmids)
 
         parts = section_name.rsplit(':', 1)
         disease_code = parts[1].lower()
 
-        if Search().index_exists(section['index']):
-            pmids = cls.get_new_pmids(pmids, section['index'], disease_code=disease_code)
+        if ElasticClient.get().index_exists(section['index']):
+            pmids = cls.get_new_pmids(pmids, section['index'], disease_code=disease_code,
+                                      idx_type=section['index_type'], cache_dir=os.path.join(args[3], 'CACHE'))
 
         logger.debug("Total No. of PMIDs in "+args[1]+": "+str(npmids))
-        Pubs.fetch_details(pmids, stage_file, disease_code)
+        options = cls._efetch_options(section, args[3])
+        try:
+            Pubs.fetch_details(pmids, stage_file, disease_code, **options)
+        finally:
+            if 'cache' in options:
+                options['cache'].close()
+        if 'incremental' in section and section.getboolean('incremental'):
+            EsearchWindow.fetched(download_file, len(pmids))
+
+    @classmethod
+    def xmlparse_batch(cls, *args, **kwargs):
+        ''' Parse the eutils esearch results of all the <sections>::<disease code> sections
+        together. Each PMID is looked up and fetched once and tagged with all of its disease
+        codes rather than once per section (see L{xmlparse}). '''
+        section = kwargs['section']
+        config = kwargs['config']
+        stage_file = cls._get_stage_file(*args, **kwargs)
+
+        disease_codes = {}
+        download_files = {}
+        prefix = section['sections'] + '::'
+        for section_name in config.sections():
+            if not section_name.startswith(prefix) or 'output' not in config[section_name]:
+                continue
+            download_file = os.path.join(args[3], 'DOWNLOAD', section['sections'],
+                                         config[section_name]['output'])
+            if not os.path.exists(download_file):
+                logger.warn('File does not exist: '+download_file)
+                continue
+            disease_code = section_name.rsplit(':', 1)[1].lower()
+            download_files[disease_code] = download_file
+            pmids = cls._esearch_pmids(download_file)
+            logger.debug("Total No. of PMIDs in "+section_name+": "+str(len(pmids)))
+            for pmid in pmids:
+                codes = disease_codes.setdefault(pmid, [])
+                if disease_code not in codes:
+                    codes.append(disease_code)
+
+        pmids = list(disease_codes.keys())
+        logger.debug("Total No. of unique PMIDs: "+str(len(pmids)))
+        if ElasticClient.get().index_exists(section['index']):
+            pmids = cls.get_new_pmids(pmids, section['index'], disease_codes=disease_codes,
+                                      idx_type=section['index_type'], cache_dir=os.path.join(args[3], 'CACHE'))
+
+        options = cls._efetch_options(section, args[3])
+        try:
+            Pubs.fetch_details(pmids, stage_file, disease_codes=disease_codes, **options)
+        finally:
+            if 'cache' in options:
+                options['cache'].close()
+        parent = config[section['sections']]
+        if 'incremental' in parent and parent.getboolean('incremental'):
+            for disease_code, download_file in download_files.items():
+                EsearchWindow.fetched(download_file, len([p for p in pmids if disease_code in disease_codes[p]]))
+
+    @classmethod
+    def esearch_record(cls, *args, **kwargs):
+        ''' Record the EDAT windows of incremental esearch downloads (L{EsearchWindow}) once
+        the publications fetched by L{xmlparse} or L{xmlparse_batch} have been loaded. '''
+        section = kwargs['section']
+        config = kwargs['config']
+        if 'sections' in section:
+            parent = config[section['sections']]
+            prefix = section['sections'] + '::'
+            download_files = [os.path.join(args[3], 'DOWNLOAD', section['sections'], config[name]['output'])
+                              for name in config.sections() if name.startswith(prefix) and 'output' in config[name]]
+        else:
+            parent = section
+            download_files = [cls._get_download_file(*args, **kwargs)] if 'output' in section else []
+        if 'incremental' not in parent or not parent.getboolean('incremental'):
+            return
+        for download_file in download_files:
+            if os.path.exists(download_file):
+                EsearchWindow.record(download_file)
+
+    @classmethod
+    def _esearch_pmids(cls, download_file):
+        ''' Get the list of PMIDs in an eutils esearch result. '''
+        tree = ET.parse(download_file)
+        idlist = tree.find("IdList")
+        return [i.text for i in idlist.iter("Id")]
+
+    @classmethod
+    def _efetch_options(cls, section, base_dir_path):
+        ''' Get the eutils API key, number of concurrent efetch requests and XML parsing
+        processes and the local publication cache (L{PubCache}) from the section. '''
+        options = {}
+        if 'pub_cache' in section and section['pub_cache'].strip() != '':
+            cache_file = os.path.join(base_dir_path, 'CACHE', section['pub_cache'].strip())
+            max_age = None
+            if 'pub_cache_max_age' in section and section['pub_cache_max_age'].strip() != '':
+                max_age = float(section['pub_cache_max_age'])
+            options['cache'] = PubCache(cache_file, max_age=max_age)
+        if 'api_key' in section and section['api_key'].strip() != '':
+            options['api_key'] = section['api_key'].strip()
+        if 'efetch_workers' in section:
+            options['workers'] = int(section['efetch_workers'])
+        if 'parse_workers' in section:
+            options['parse_workers'] = int(section['parse_workers'])
+        return options
 
 
 class IniParser(object):
@@ -21,8 +21,10 @@ setup(
                                     'tests/data/DOWNLOAD/GENE_INFO/*gz',
                                     'tests/data/DOWNLOAD/GENE_PUBS/*gz',
                                     'tests/data/DOWNLOAD/DBSNP/*gz',
+                                    'tests/data/DOWNLOAD/DBSNP/*tbi',
                                     'tests/data/DOWNLOAD/RSMERGEARCH/*gz',
                                     'tests/data/DOWNLOAD/DISEASE/*txt',
+                                    'tests/data/DOWNLOAD/PUBMED/*xml',
                                     'tests/data/DOWNLOAD/ENSMART_HOMOLOG/*out',
                                     'tests/data/DOWNLOAD/ENSEMBL2MGI/*.rpt',
                                     'tests/*.ini'], },
@@ -31,7 +33,7 @@ setup(
     url='http://github.com/D-I-L/django-data-pipeline',
     description='A data pipeline app.',
     long_description=open(os.path.join(ROOT, 'README.rst')).read(),
-    install_requires=["requests>=2.7.0", "Django>=1.8.2,<1.9", "ftputil>=3.2"],
+    install_requires=["requests>=2.7.0", "Django>=1.8.2,<1.9", "ftputil>=3.2", "numpy>=1.9"],
     classifiers=[
         'Environment :: Web Environment',
         'Framework :: Django',